@@ -0,0 +1,151 @@
+"""Concurrent-request capacity of one CreatorsAI API worker, sync vs cooperative.
+
+Starts the stand-in Gemini upstream (gemini_standin.py), which answers
+generateContent after a fixed delay, then runs app.py under gunicorn with
+ONE worker, once per mode (sync workers, then CREATORSAI_ASYNC=true
+eventlet workers), pointed at the stand-in through GEMINI_API_BASE. For each concurrency level it
+keeps that many clients posting to /respond and reports requests/sec and
+latency percentiles. With a 1s upstream, a sync worker tops out near
+1 req/s whatever the concurrency, and a cooperative worker scales with
+the client count until its CPU is the limit.
+
+    python api_benchmark.py --latency 1 --concurrency 1,10,50,100 --duration 10
+    python api_benchmark.py --modes async --concurrency 200,500 --json bench.json
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import threading
+import subprocess
+import requests
+
+import gemini_standin
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+# ------------------------
+# API under test
+# ------------------------
+def spawn_api(mode, port, upstream, workdir, connections):
+    env = dict(os.environ,
+               PORT=str(port),
+               WEB_CONCURRENCY='1',
+               WORKER_CONNECTIONS=str(connections),
+               CREATORSAI_ASYNC='true' if mode == 'async' else 'false',
+               GEMINI='benchmark-key',
+               GEMINI_API_BASE=upstream,
+               DATABASE_URL=f'sqlite:///{os.path.join(workdir, "bench.db")}',
+               HASHTAG_TRENDS_DIR=os.path.join(workdir, 'trends'),
+               RETENTION_ENABLED='false')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(HERE, 'gunicorn.conf.py'), 'app:app'],
+                              cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(150):
+        try:
+            requests.get(url + '/', timeout=1)
+            return server, url
+        except requests.RequestException:
+            if server.poll() is not None:
+                raise RuntimeError(f'{mode} API exited during startup')
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f'{mode} API did not come up')
+
+
+def run_level(url, clients, duration, timeout):
+    stop = time.time() + duration
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        while time.time() < stop:
+            started = time.perf_counter()
+            try:
+                ok = session.post(url + '/respond', json={'prompt': 'Say hi'},
+                                  timeout=timeout).status_code == 200
+            except requests.RequestException:
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(clients)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    return {
+        'clients': clients,
+        'requests_per_sec': round(len(latencies) / elapsed, 2),
+        'p50_ms': round((percentile(latencies, 50) or 0) * 1000, 1),
+        'p95_ms': round((percentile(latencies, 95) or 0) * 1000, 1),
+        'completed': len(latencies),
+        'errors': errors[0]
+    }
+
+
+def run(args):
+    upstream = gemini_standin.start(args.upstream_port, args.latency)
+    upstream_url = f'http://127.0.0.1:{args.upstream_port}'
+    report = {}
+    with tempfile.TemporaryDirectory(prefix='creatorsai-bench-') as workdir:
+        for mode in args.modes:
+            server, url = spawn_api(mode, args.port, upstream_url, workdir, max(args.concurrency) + 10)
+            try:
+                print(f'{mode}: one gunicorn worker, upstream latency {args.latency:.2f}s')
+                rows = report[mode] = []
+                for clients in args.concurrency:
+                    row = run_level(url, clients, args.duration, args.latency * 10 + 30)
+                    rows.append(row)
+                    print(f"  {clients:5d} clients  {row['requests_per_sec']:8.2f} req/s  p50 {row['p50_ms']:8.1f}ms  "
+                          f"p95 {row['p95_ms']:8.1f}ms  errors {row['errors']}")
+            finally:
+                server.terminate()
+                server.wait()
+    upstream.shutdown()
+    if 'sync' in report and 'async' in report:
+        best = {mode: max(row['requests_per_sec'] for row in rows) for mode, rows in report.items()}
+        ratio = best['async'] / best['sync'] if best['sync'] else float('inf')
+        print(f"Peak per-worker throughput: sync {best['sync']:.2f} req/s, async {best['async']:.2f} req/s ({ratio:.1f}x)")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'latency': args.latency, 'duration': args.duration, 'modes': report}, f, indent=2)
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='CreatorsAI API per-worker capacity benchmark')
+    parser.add_argument('--modes', default='sync,async', help='comma separated: sync, async')
+    parser.add_argument('--concurrency', default='1,10,50,100', help='concurrent clients per level')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per level')
+    parser.add_argument('--latency', type=float, default=1.0, help='stand-in Gemini response delay in seconds')
+    parser.add_argument('--port', type=int, default=5077)
+    parser.add_argument('--upstream-port', type=int, default=5078)
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args(argv)
+    args.modes = [mode for mode in args.modes.split(',') if mode]
+    if set(args.modes) - {'sync', 'async'}:
+        parser.error('--modes takes sync and/or async')
+    args.concurrency = [int(c) for c in args.concurrency.split(',') if c]
+    return args
+
+
+if __name__ == '__main__':
+    run(parse_args())
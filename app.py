@@ -1,15 +1,26 @@
+# Cooperative mode (CREATORSAI_ASYNC=true) must patch the stdlib before anything else imports it
+from coop import monkey_patch, offload
+monkey_patch()
+
 import os
 import io
+import csv
 import time
+import atexit
+import threading
 import uuid
 import base64
 import requests
 import json
 import random 
+import hmac
+from functools import wraps
 from PIL import Image
-from flask import Flask, request, jsonify, send_from_directory, redirect, url_for, render_template_string
+from flask import Flask, request, jsonify, send_from_directory, redirect, url_for, render_template_string, Response, stream_with_context
 from flask_cors import CORS, cross_origin 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text, update, select, bindparam
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 from flask_bcrypt import Bcrypt
 from flask_jwt_extended import (
     create_access_token,
@@ -28,6 +39,14 @@ from flask_mail import Mail, Message
 # CRITICAL FIX: Import the Client directly from the correct location
 from google.genai import Client as GenAIClient
 
+from retention import RetentionSweeper, parse_quotas
+from hashtag_engine import HashtagEngine
+from hashtag_trends import TrendCounter
+from gemini_keys import KeyPool, NoKeyAvailable, retryable, tokens_from
+from prompt_templates import IMAGE_TEMPLATE, render_prompt, pack_params, parse_prompt
+from request_profiler import RequestProfiler
+from gemini_files import FilesClient, FileUploadError, key_fingerprint
+
 # ------------------------
 # Helper for optional JWT
 # ------------------------
@@ -39,6 +58,22 @@ def get_jwt_identity_optional():
     except (NoAuthorizationError, ExpiredSignatureError):
         return None
 
+def is_admin_request():
+    """True when the request carries the ADMIN_TOKEN shared secret (never when it is unset)."""
+    expected = os.environ.get("ADMIN_TOKEN")
+    supplied = request.headers.get("X-Admin-Token", "")
+    # Bytes, not str: compare_digest rejects non-ASCII str, and headers arrive decoded as latin-1
+    return bool(expected) and hmac.compare_digest(supplied.encode(), expected.encode())
+
+def admin_required(fn):
+    """Guards operator endpoints with the ADMIN_TOKEN shared secret (disabled when unset)."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not is_admin_request():
+            return jsonify({"error": "Forbidden"}), 403
+        return fn(*args, **kwargs)
+    return wrapper
+
 # ------------------------
 # Flask App Setup
 # ------------------------
@@ -75,10 +110,41 @@ app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", f"sqlite:
 # Google API Configuration
 # ------------------------
 MODEL_NAME = "gemini-2.5-flash-image" 
-GOOGLE_API_KEY1 = os.environ.get("GEMINI")
-if not GOOGLE_API_KEY1:
-    print("[FATAL ERROR] GEMINI (for Image API) is not set.")
-API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{MODEL_NAME}:generateContent?key={GOOGLE_API_KEY1}"
+# Keys from GEMINI, GEMINI_KEYS and GEMINI_1..N; each request takes the least-loaded key, 429s eject a key for a while
+gemini_keys = KeyPool.from_env()
+if not len(gemini_keys):
+    print("[FATAL ERROR] No Gemini API key is set (GEMINI, GEMINI_KEYS or GEMINI_1..N).")
+# Overridable so staging and benchmarks can point at a stand-in upstream
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip("/")
+API_URL = f"{GEMINI_API_BASE}/v1beta/models/{MODEL_NAME}:generateContent"
+genai_clients = {}
+
+def genai_client(api_key):
+    """One GenAIClient per key, reused across requests."""
+    client = genai_clients.get(api_key)
+    if client is None: client = genai_clients[api_key] = GenAIClient(api_key=api_key, http_options={"base_url": GEMINI_API_BASE + "/"})
+    return client
+
+# Reference photos go up once through the Files API and later requests send the handle instead of the image.
+# Handles last 48h in the uploading key's project; they are re-uploaded GEMINI_FILE_REFRESH_MINUTES before expiry.
+REFERENCE_UPLOADS = os.environ.get("GEMINI_FILE_UPLOADS", "True").lower() == "true"
+REFERENCE_REFRESH_MARGIN = timedelta(minutes=int(os.environ.get("GEMINI_FILE_REFRESH_MINUTES", 60)))
+gemini_files = FilesClient(GEMINI_API_BASE)
+
+# --- Local hashtag engine: answers confident cases itself, hints the model otherwise, and is the fallback ---
+hashtag_engine = HashtagEngine.load()
+HASHTAG_COUNT = 7
+HASHTAG_LOCAL_CONFIDENCE = float(os.environ.get("HASHTAG_LOCAL_CONFIDENCE", 0.7))
+
+# --- Trending hashtags: every /generate result feeds rolling sketch counters shared by all workers on disk ---
+hashtag_trends = TrendCounter(
+    path=os.environ.get("HASHTAG_TRENDS_DIR", os.path.abspath(os.path.join("data", "hashtag_trends"))),
+    bucket_seconds=int(os.environ.get("HASHTAG_TRENDS_BUCKET_SECONDS", 300)),
+    buckets=int(os.environ.get("HASHTAG_TRENDS_BUCKETS", 12)),
+    interval=int(os.environ.get("HASHTAG_TRENDS_FLUSH_SECONDS", 60)),
+)
+hashtag_trends.start()
+atexit.register(hashtag_trends.flush)
 
 # ------------------------
 # Database & Add-on Setup
@@ -88,6 +154,15 @@ bcrypt = Bcrypt(app)
 jwt = JWTManager(app)
 mail = Mail(app)
 oauth = OAuth(app)
+# Opt-in profiling: requests with "X-Profile: 1" plus the admin token, or a PROFILE_SAMPLE_RATE share of all requests
+profiler = RequestProfiler(
+    directory=os.environ.get("PROFILE_DIR", os.path.join("/tmp", "creatorsai-profiles")),
+    ring_size=int(os.environ.get("PROFILE_RING_SIZE", 50)),
+    sample_rate=float(os.environ.get("PROFILE_SAMPLE_RATE", 0)),
+    interval=float(os.environ.get("PROFILE_INTERVAL_MS", 5)) / 1000,
+    authorize=is_admin_request,
+    enabled=os.environ.get("REQUEST_PROFILING", "False").lower() == "true",
+)
 # In-memory storage for chat history/context
 chat_histories = {} 
 
@@ -135,26 +210,136 @@ class User(db.Model):
 class SearchHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
+    # Empty for templated rows: image generations store prompt_template + prompt_params (JSON) instead
     prompt_content = db.Column(db.Text, nullable=False)
+    prompt_template = db.Column(db.String(40), nullable=True)
+    prompt_params = db.Column(db.Text, nullable=True)
     generated_result = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
-    def to_dict(self):
-        return {
+    def prompt(self):
+        """Full prompt text, rendered from the template for templated rows."""
+        if self.prompt_template: return render_prompt(self.prompt_template, json.loads(self.prompt_params or "{}"))
+        return self.prompt_content
+
+    def to_dict(self, render=True):
+        item = {
             'id': self.id,
             'title': self.title,
-            'prompt_content': self.prompt_content,
+            'prompt_content': self.prompt() if render or not self.prompt_template else None,
             'generated_result': self.generated_result,
             'timestamp': self.timestamp.isoformat()
         }
+        # The compact form replaces the rendered text; the default form stays what it always was
+        if self.prompt_template and not render:
+            item['prompt_template'] = self.prompt_template
+            item['prompt_params'] = json.loads(self.prompt_params or "{}")
+        return item
+
+class ReferenceUpload(db.Model):
+    """Gemini Files API handle of an uploaded reference photo, one per (file, API key)."""
+    __table_args__ = (db.UniqueConstraint('filename', 'key_id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255), nullable=False, index=True)
+    key_id = db.Column(db.String(16), nullable=False)
+    # "<size>-<mtime_ns>" of the local file; a replaced file gets a fresh upload
+    source_stamp = db.Column(db.String(64), nullable=False)
+    file_name = db.Column(db.String(100), nullable=False)
+    file_uri = db.Column(db.String(500), nullable=False)
+    mime_type = db.Column(db.String(50), nullable=False, default='image/jpeg')
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    uploaded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 # ------------------------
 # Create Tables & JWT Config 
 # ------------------------
+def migrate_search_history_schema():
+    """Adds SearchHistory columns newer than the table; create_all() never alters existing tables."""
+    columns = {column["name"] for column in inspect(db.engine).get_columns(SearchHistory.__tablename__)}
+    for name, ddl in (("prompt_template", "VARCHAR(40)"), ("prompt_params", "TEXT")):
+        if name in columns: continue
+        try:
+            db.session.execute(text(f"ALTER TABLE {SearchHistory.__tablename__} ADD COLUMN {name} {ddl}")); db.session.commit()
+            print(f"[INFO] Added column {SearchHistory.__tablename__}.{name}")
+        except SQLAlchemyError:
+            db.session.rollback()  # Another worker added it first
+
 with app.app_context():
     print("[INFO] Initializing database tables...")
     db.create_all()
+    migrate_search_history_schema()
     print("[INFO] Database tables initialized.")
+    profiler.init_app(app, db.engine)
+
+# ------------------------
+# Upload Retention
+# ------------------------
+def referenced_generated_files():
+    """Filenames in GENERATED_FOLDER still linked from SearchHistory; these are never evicted."""
+    with app.app_context():
+        rows = db.session.query(SearchHistory.generated_result).filter(SearchHistory.generated_result.like("/generated/%")).yield_per(1000)
+        names = {os.path.basename(row[0]) for row in rows}
+        db.session.close()
+    return names
+
+def plans_for_users(user_ids):
+    user_ids = list(user_ids); plans = {}
+    with app.app_context():
+        for i in range(0, len(user_ids), 500):
+            rows = db.session.query(User.id, User.plan).filter(User.id.in_(user_ids[i:i + 500])).all()
+            plans.update({user_id: plan for user_id, plan in rows})
+        db.session.close()
+    return plans
+
+retention_sweeper = RetentionSweeper(
+    folders={"uploads": app.config['UPLOAD_FOLDER'], "generated": app.config['GENERATED_FOLDER']},
+    max_age={
+        "uploads": float(os.environ.get("RETENTION_UPLOAD_MAX_AGE_HOURS", 72)) * 3600,
+        "generated": float(os.environ.get("RETENTION_GENERATED_MAX_AGE_HOURS", 720)) * 3600,
+    },
+    quotas=parse_quotas(os.environ.get("RETENTION_QUOTAS_MB")),
+    referenced_files=referenced_generated_files,
+    plan_lookup=plans_for_users,
+    interval=int(os.environ.get("RETENTION_INTERVAL_SECONDS", 900)),
+    dry_run=os.environ.get("RETENTION_DRY_RUN", "False").lower() == "true",
+    lock_path=os.path.join("/tmp", "creatorsai-retention.lock"),
+)
+if os.environ.get("RETENTION_ENABLED", "True").lower() == "true":
+    retention_sweeper.start()
+
+@app.route("/admin/retention/report", methods=["GET"])
+@admin_required
+def retention_report():
+    """Dry-run: lists what the next sweep would delete and why."""
+    return jsonify(retention_sweeper.report()), 200
+
+@app.route("/admin/retention/metrics", methods=["GET"])
+@admin_required
+def retention_metrics():
+    return jsonify(retention_sweeper.stats), 200
+
+@app.route("/admin/gemini/keys", methods=["GET"])
+@admin_required
+def gemini_key_health():
+    """Per-key health and usage; keys are shown by their last four characters only."""
+    return jsonify(gemini_keys.health()), 200
+
+@app.route("/admin/profiles", methods=["GET"])
+@admin_required
+def list_profiles():
+    """Profiles still in the ring, newest first (stage breakdown only)."""
+    return jsonify(profiler.list() if profiler.enabled else []), 200
+
+@app.route("/admin/profiles/<profile_id>", methods=["GET"])
+@admin_required
+def get_profile(profile_id):
+    record = profiler.load(profile_id) if profiler.enabled else None
+    if not record: return jsonify({"error": "Profile not found"}), 404
+    if request.args.get("format") == "folded":
+        # flamegraph.pl / speedscope input
+        return Response(profiler.folded(record), mimetype="text/plain",
+                        headers={"Content-Disposition": f"attachment; filename=profile-{profile_id}.folded"})
+    return jsonify(record), 200
 
 @jwt.user_lookup_loader
 def user_lookup_callback(_jwt_header, jwt_data):
@@ -190,9 +375,9 @@ def register_send_otp():
         return jsonify({"msg": "An account with this email already exists via social login. Please use the Google sign-in button."}), 400
 
     otp = str(random.randint(100000, 999999))
-    hashed_otp = bcrypt.generate_password_hash(otp).decode("utf-8")
+    hashed_otp = offload(bcrypt.generate_password_hash, otp).decode("utf-8")
     otp_expiration = datetime.utcnow() + timedelta(minutes=10)
-    hashed_password = bcrypt.generate_password_hash(password).decode("utf-8")
+    hashed_password = offload(bcrypt.generate_password_hash, password).decode("utf-8")
 
     if user:
         user.password = hashed_password
@@ -233,7 +418,7 @@ def register_verify_otp():
     if user.is_verified: return jsonify({"msg": "User is already verified. Please log in."}), 400
     if not user.verification_otp or not user.otp_expires_at: return jsonify({"msg": "No pending verification. Please sign up again."}), 400
     if datetime.utcnow() > user.otp_expires_at: return jsonify({"msg": "Your OTP has expired. Please sign up again to get a new one."}), 401
-    if not bcrypt.check_password_hash(user.verification_otp, otp): return jsonify({"msg": "Invalid OTP."}), 401
+    if not offload(bcrypt.check_password_hash, user.verification_otp, otp): return jsonify({"msg": "Invalid OTP."}), 401
     user.is_verified = True; user.verification_otp = None; user.otp_expires_at = None; db.session.commit()
     access_token = create_access_token(identity=str(user.id))
     user_info = { "id": user.id, "email": user.email, "plan": user.plan, "credits": user.credits, 'access_token': access_token }
@@ -251,7 +436,7 @@ def login():
     user = User.query.filter_by(email=email).first()
     if not user: return jsonify({"msg": "Invalid credentials"}), 401
     if not user.password: return jsonify({"msg": "This account was created via social login. Please use the Google sign-in button."}), 401
-    if not bcrypt.check_password_hash(user.password, password): return jsonify({"msg": "Invalid credentials"}), 401
+    if not offload(bcrypt.check_password_hash, user.password, password): return jsonify({"msg": "Invalid credentials"}), 401
     if not user.is_verified: return jsonify({"msg": "Please verify your email address before logging in."}), 401
     token = create_access_token(identity=str(user.id))
     user_info = { "id": user.id, "email": user.email, "plan": user.plan, "credits": user.credits, 'access_token': token }
@@ -294,6 +479,10 @@ def google_callback():
 # All other routes
 # ------------------------
 
+def hashtag_result(hashtags, source):
+    hashtag_trends.record(hashtags)
+    return jsonify(hashtags=hashtags, source=source)
+
 # Conversation History and Context Management
 @app.route("/generate", methods=["POST"])
 @cross_origin()
@@ -302,27 +491,48 @@ def generate():
     content = (data.get("post") or "").strip()
     if not content: return jsonify(error="Content required (must be sent as 'post')"), 400
     
-    chat_prompt = ("You are an expert social media strategist.\n" + f"Your task is to extract exactly 7 SEO-optimized hashtags for: \"{content}\".\n" + "RULES:\n1. Return ONLY the hashtags.\n2. Each hashtag must start with a #.\n3. Separate each hashtag with a comma.\n4. Do not include any other text, titles, or explanations.\n")
+    local_tags, confidence = hashtag_engine.suggest(content, HASHTAG_COUNT)
+    if len(local_tags) == HASHTAG_COUNT and confidence >= HASHTAG_LOCAL_CONFIDENCE:
+        return hashtag_result(local_tags, "local")
+
+    chat_prompt = ("You are an expert social media strategist.\n" + f"Your task is to extract exactly 7 SEO-optimized hashtags for: \"{content}\".\n" + HashtagEngine.hint(local_tags) + "RULES:\n1. Return ONLY the hashtags.\n2. Each hashtag must start with a #.\n3. Separate each hashtag with a comma.\n4. Do not include any other text, titles, or explanations.\n")
 
     try:
-        GOOGLE_API_KEY = os.environ.get("GEMINI")
-        if not GOOGLE_API_KEY:
-            print("[FATAL ERROR] GOOGLE_API_KEY is not set. Please add it in Render Environment Variables.")
+        if not len(gemini_keys):
+            print("[FATAL ERROR] No Gemini API key is set. Please add GEMINI (or GEMINI_KEYS) in Render Environment Variables.")
+            if local_tags: return hashtag_result(local_tags, "local-fallback")
             return jsonify({"error": "API Key not configured"}), 500
         
-        client = GenAIClient(api_key=GOOGLE_API_KEY) 
-        
-        response = client.models.generate_content(model="gemini-2.5-flash", contents=chat_prompt)
+        with profiler.span("upstream"):
+            response = gemini_keys.call(lambda key: genai_client(key).models.generate_content(model="gemini-2.5-flash", contents=chat_prompt))
         model_output = response.text.strip() if response.text else ""
         hashtags = [h.strip() for h in model_output.split(",") if h.strip().startswith("#")]
         if not hashtags:
             print(f"Model returned unexpected output: {model_output}")
+            if local_tags: return hashtag_result(local_tags, "local-fallback")
             return jsonify(error="Failed to parse hashtags from model response", model_output=model_output), 500
-        return jsonify(hashtags=hashtags)
+        return hashtag_result(hashtags, "model")
     except Exception as e:
+        # Upstream down or rate-limited (429): degrade to the local candidates
         print(f"[ERROR] /generate: {e}")
+        if local_tags: return hashtag_result(local_tags, "local-fallback")
         return jsonify({"error": str(e)}), 500
 
+@app.route("/hashtags/trending", methods=["GET"])
+@cross_origin()
+def trending_hashtags():
+    """Most generated hashtags across creators over ?window= seconds (default 1 hour), served from memory."""
+    try:
+        window = int(request.args.get("window", 3600)); limit = min(int(request.args.get("limit", 20)), 100)
+    except ValueError:
+        return jsonify({"error": "window and limit must be integers"}), 400
+    return jsonify(hashtag_trends.trending(window, max(limit, 1))), 200
+
+@app.route("/admin/hashtags/trending/metrics", methods=["GET"])
+@admin_required
+def trending_hashtags_metrics():
+    return jsonify(hashtag_trends.stats), 200
+
 
 @app.route("/respond", methods=["POST"])
 @cross_origin()
@@ -360,18 +570,17 @@ USER QUESTION:
 """
     
     try:
-        GEMINI_API_KEY = os.environ.get("GEMINI")
-        if not GEMINI_API_KEY: raise RuntimeError("GEMINI API key is not set in environment variables.")
-        
-        client = GenAIClient(api_key=GEMINI_API_KEY) 
-        
-        response = client.models.generate_content(model="gemini-2.5-flash", contents=[chat_prompt])
+        with profiler.span("upstream"):
+            response = gemini_keys.call(lambda key: genai_client(key).models.generate_content(model="gemini-2.5-flash", contents=[chat_prompt]))
         result_text = response.text.strip() if response.text else ""
         
         # Append AI's response to maintain continuity
         chat_histories[chat_id].append({"role": "ai", "text": result_text})
         
         return jsonify({"result": result_text, "meta": {"chat_id": chat_id, "max_sentences": max_sentences}}), 200 
+    except NoKeyAvailable as e:
+        print(f"[ERROR] /respond: {e}")
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(int(e.retry_after or 60))}
     except Exception as e:
         print(f"[ERROR] /respond: {e}")
         return jsonify({"error": str(e)}), 500
@@ -395,9 +604,191 @@ def save_history():
 @cross_origin() 
 def get_history():
     user_id = get_jwt_identity()
+    # Image prompts come back as rendered text; ?render=false sends template + params instead
+    render = request.args.get("render", "true").lower() != "false"
     items = SearchHistory.query.filter_by(user_id=user_id).order_by(SearchHistory.timestamp.desc()).all()
+    history = [item.to_dict(render=render) for item in items]
     db.session.close()
-    return jsonify([item.to_dict() for item in items]), 200
+    return jsonify(history), 200
+
+# --- History export / bulk import: both stream, so memory stays bounded whatever the history size ---
+HISTORY_FIELDS = ["id", "title", "prompt_content", "generated_result", "timestamp", "prompt_template", "prompt_params"]
+HISTORY_CHUNK_ROWS = int(os.environ.get("HISTORY_CHUNK_ROWS", 500))
+HISTORY_IMPORT_MAX_LINE = 1024 * 1024
+
+def iter_history_rows(user_id):
+    """Yields the user's history oldest first, fetched from a server-side cursor HISTORY_CHUNK_ROWS at a time."""
+    query = (db.session.query(*[getattr(SearchHistory, field) for field in HISTORY_FIELDS])
+             .filter(SearchHistory.user_id == user_id).order_by(SearchHistory.id)
+             .execution_options(stream_results=True, yield_per=HISTORY_CHUNK_ROWS))
+    try:
+        for row in query:
+            yield row
+    finally:
+        db.session.close()
+
+def history_ndjson(rows, flush_every=100):
+    lines = []
+    for row in rows:
+        record = dict(zip(HISTORY_FIELDS, row)); record["timestamp"] = row.timestamp.isoformat()
+        if row.prompt_template:
+            # Exports are self-contained: the prompt is rendered, the params are kept for re-import
+            record["prompt_params"] = json.loads(row.prompt_params or "{}")
+            record["prompt_content"] = render_prompt(row.prompt_template, record["prompt_params"])
+        lines.append(json.dumps(record) + "\n")
+        if len(lines) >= flush_every:
+            yield "".join(lines); lines.clear()
+    if lines: yield "".join(lines)
+
+def history_csv(rows, flush_every=100):
+    buffer = io.StringIO(); writer = csv.writer(buffer)
+    writer.writerow(HISTORY_FIELDS)
+    for count, row in enumerate(rows, 1):
+        prompt = render_prompt(row.prompt_template, json.loads(row.prompt_params or "{}")) if row.prompt_template else row.prompt_content
+        writer.writerow([row.id, row.title, prompt, row.generated_result, row.timestamp.isoformat(), row.prompt_template, row.prompt_params])
+        if count % flush_every == 0:
+            yield buffer.getvalue(); buffer.seek(0); buffer.truncate()
+    yield buffer.getvalue()
+
+@app.route("/api/history/export", methods=["GET"])
+@jwt_required()
+@cross_origin()
+def export_history():
+    fmt = request.args.get("format", "ndjson").lower()
+    if fmt not in ("ndjson", "csv"): return jsonify({"error": "format must be ndjson or csv"}), 400
+    rows = iter_history_rows(int(get_jwt_identity()))
+    body = history_csv(rows) if fmt == "csv" else history_ndjson(rows)
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename=history.{fmt}"})
+
+def history_import_row(record, user_ids):
+    """Validates one NDJSON record; user_ids caches email/id lookups (cleared when it grows large)."""
+    if not isinstance(record, dict): raise ValueError("record must be a JSON object")
+    if record.get("email"):
+        key = ("email", record["email"])
+    elif record.get("user_id") is not None:
+        key = ("id", int(record["user_id"]))
+    else:
+        raise ValueError("email or user_id required")
+    if key not in user_ids:
+        if len(user_ids) >= 10000: user_ids.clear()
+        column = User.email if key[0] == "email" else User.id
+        user = db.session.query(User.id).filter(column == key[1]).first()
+        user_ids[key] = user[0] if user else None
+    if user_ids[key] is None: raise ValueError(f"unknown user {key[1]}")
+    title = record.get("title"); prompt = record.get("prompt_content"); result = record.get("generated_result")
+    template = record.get("prompt_template"); params = record.get("prompt_params")
+    if template:
+        # Templated rows stay compact; the rendered prompt_content of an export is not stored again
+        if not isinstance(params, dict): raise ValueError("prompt_params must be an object")
+        render_prompt(template, params); prompt = ""; params = pack_params(params)
+    elif not prompt: raise ValueError("prompt_content or prompt_template required")
+    else: template = params = None
+    if not title or not result: raise ValueError("title and generated_result required")
+    timestamp = datetime.fromisoformat(record["timestamp"]) if record.get("timestamp") else datetime.utcnow()
+    return {"title": str(title)[:100], "prompt_content": str(prompt), "prompt_template": template, "prompt_params": params,
+            "generated_result": str(result), "timestamp": timestamp, "user_id": user_ids[key]}
+
+@app.route("/admin/history/import", methods=["POST"])
+@admin_required
+def import_history():
+    """Bulk-loads NDJSON history (e.g. exported from the log.py deployment), one transaction per HISTORY_CHUNK_ROWS rows.
+
+    Each line needs "email" (or "user_id"), "title", "generated_result" and either "prompt_content" or
+    "prompt_template" + "prompt_params"; "timestamp" is optional and "id" is ignored. Bad lines are skipped and reported; batches already committed stay committed.
+    """
+    stream = request.stream
+    batch, user_ids, errors = [], {}, []
+    imported = skipped = line_no = 0
+
+    def flush():
+        nonlocal imported
+        if batch:
+            db.session.execute(SearchHistory.__table__.insert(), batch); db.session.commit()
+            imported += len(batch); batch.clear()
+
+    try:
+        while True:
+            line = stream.readline(HISTORY_IMPORT_MAX_LINE + 1)
+            if not line: break
+            line_no += 1
+            try:
+                if len(line) > HISTORY_IMPORT_MAX_LINE:
+                    while line and not line.endswith(b"\n"): line = stream.readline(HISTORY_IMPORT_MAX_LINE)
+                    raise ValueError(f"line longer than {HISTORY_IMPORT_MAX_LINE} bytes")
+                if not line.strip(): continue
+                batch.append(history_import_row(json.loads(line), user_ids))
+            except (ValueError, TypeError) as e:
+                skipped += 1
+                if len(errors) < 20: errors.append({"line": line_no, "error": str(e)})
+                continue
+            if len(batch) >= HISTORY_CHUNK_ROWS: flush()
+        flush()
+    except Exception as e:
+        db.session.rollback()
+        print(f"[ERROR] /admin/history/import at line {line_no}: {e}")
+        return jsonify({"error": str(e), "imported": imported, "line": line_no}), 500
+    finally:
+        db.session.close()
+    print(f"[INFO] History import: {imported} rows imported, {skipped} skipped.")
+    return jsonify({"imported": imported, "skipped": skipped, "errors": errors}), 200
+
+def compact_image_prompts(batch=HISTORY_CHUNK_ROWS):
+    """Rewrites stored image prompts as IMAGE_TEMPLATE + params, one transaction per batch.
+
+    Only rows whose text renders back byte for byte from the parsed params are converted; anything else
+    (older wordings, hand-edited rows) keeps its prompt_content. Safe to re-run and to run from several workers.
+    """
+    stats = {"converted": 0, "kept": 0, "bytes_saved": 0}
+    table = SearchHistory.__table__
+    statement = (update(table).where(table.c.id == bindparam("row_id"))
+                 .values(prompt_content="", prompt_template=IMAGE_TEMPLATE, prompt_params=bindparam("packed")))
+    last_id = 0
+    try:
+        while True:
+            rows = (db.session.query(SearchHistory.id, SearchHistory.prompt_content)
+                    .filter(SearchHistory.id > last_id, SearchHistory.prompt_template.is_(None),
+                            SearchHistory.generated_result.like("/generated/%"))
+                    .order_by(SearchHistory.id).limit(batch).all())
+            if not rows: break
+            updates = []
+            for row_id, prompt in rows:
+                params = parse_prompt(IMAGE_TEMPLATE, prompt)
+                if params is None: stats["kept"] += 1; continue
+                packed = pack_params(params)
+                updates.append({"row_id": row_id, "packed": packed})
+                stats["bytes_saved"] += len(prompt.encode("utf-8")) - len(packed.encode("utf-8"))
+            if updates: db.session.execute(statement, updates)
+            db.session.commit()
+            stats["converted"] += len(updates)
+            last_id = rows[-1][0]
+    finally:
+        db.session.close()
+    return stats
+
+def compact_image_prompts_in_background():
+    with app.app_context():
+        try:
+            stats = compact_image_prompts()
+            if stats["converted"]: print(f"[INFO] Compacted {stats['converted']} image prompts, {stats['bytes_saved']} bytes saved.")
+        except Exception as e:
+            print(f"[ERROR] Image prompt compaction failed: {e}")
+
+# Existing rows are migrated in the background at startup; new image generations are stored compact already
+if os.environ.get("HISTORY_COMPACT_PROMPTS", "True").lower() == "true":
+    threading.Thread(target=compact_image_prompts_in_background, name="history-prompt-compaction", daemon=True).start()
+
+@app.route("/admin/history/compact-prompts", methods=["POST"])
+@admin_required
+def compact_history_prompts():
+    """Runs the prompt migration now; ?vacuum=true then reclaims the freed space (SQLite/Postgres)."""
+    stats = compact_image_prompts()
+    if request.args.get("vacuum", "false").lower() == "true" and db.engine.dialect.name in ("sqlite", "postgresql"):
+        with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.exec_driver_sql("VACUUM")
+        stats["vacuumed"] = True
+    return jsonify(stats), 200
 
 @app.route('/upload-reference', methods=['POST'])
 @jwt_required(optional=True)
@@ -407,7 +798,10 @@ def upload_reference():
         if 'file' not in request.files: return jsonify({"error": "No file uploaded"}), 400
         file = request.files['file']
         if file.filename == '': return jsonify({"error": "Empty filename"}), 400
-        filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
+        # The owner prefix lets the retention sweeper apply the uploader's plan quota
+        user_id = get_jwt_identity()
+        owner_prefix = f"u{user_id}_" if user_id else ""
+        filename = f"{owner_prefix}{uuid.uuid4().hex}_{secure_filename(file.filename)}"
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(file_path)
         return jsonify({"message": "File uploaded successfully", "filename": filename, "url": f"/uploads/{filename}"}), 200
@@ -415,6 +809,89 @@ def upload_reference():
         print(f"[ERROR] Upload failed: {e}")
         return jsonify({"error": str(e)}), 500
 
+def reference_image_jpeg(path):
+    """Downscaled JPEG of the reference photo for the Gemini request (CPU-bound)."""
+    with Image.open(path) as img:
+        buffer = io.BytesIO()
+        img.thumbnail((1024, 1024))
+        img.convert("RGB").save(buffer, format="JPEG", quality=90)
+        return buffer.getvalue()
+
+def inline_image_part(path):
+    with profiler.span("pil"):
+        data = offload(reference_image_jpeg, path)
+    return {"inline_data": {"mime_type": "image/jpeg", "data": base64.b64encode(data).decode("utf-8")}}
+
+def reference_image_part(secret, filename, path):
+    """Request part for the reference photo and the id of the handle it uses (None when inline).
+
+    Reuses this key's live handle for the file, uploads it when there is none (or it is close to
+    expiry, or the file changed) and falls back to inline data when uploads are off or fail."""
+    if not REFERENCE_UPLOADS: return inline_image_part(path), None
+    stat = os.stat(path)
+    stamp = f"{stat.st_size}-{stat.st_mtime_ns}"
+    key_id = key_fingerprint(secret)
+    handle = ReferenceUpload.query.filter_by(filename=filename, key_id=key_id).first()
+    if handle and handle.source_stamp == stamp and handle.expires_at > datetime.utcnow() + REFERENCE_REFRESH_MARGIN:
+        return {"file_data": {"mime_type": handle.mime_type, "file_uri": handle.file_uri}}, handle.id
+    with profiler.span("pil"):
+        data = offload(reference_image_jpeg, path)
+    try:
+        with profiler.span("upload"):
+            uploaded = gemini_files.upload(secret, data, "image/jpeg", filename)
+    except (FileUploadError, requests.RequestException) as e:
+        print(f"[WARN] Reference upload failed, sending it inline: {e}")
+        return {"inline_data": {"mime_type": "image/jpeg", "data": base64.b64encode(data).decode("utf-8")}}, None
+    part = {"file_data": {"mime_type": uploaded["mime_type"], "file_uri": uploaded["uri"]}}
+    handle = handle or ReferenceUpload(filename=filename, key_id=key_id)
+    handle.source_stamp = stamp; handle.file_name = uploaded["name"]; handle.file_uri = uploaded["uri"]
+    handle.mime_type = uploaded["mime_type"]; handle.expires_at = uploaded["expires_at"]; handle.uploaded_at = datetime.utcnow()
+    try:
+        db.session.add(handle)
+        ReferenceUpload.query.filter(ReferenceUpload.expires_at < datetime.utcnow()).delete()
+        db.session.commit()
+        return part, handle.id
+    except IntegrityError:
+        # A concurrent request stored its own upload of this file first; this one is still valid for now
+        db.session.rollback()
+        return part, None
+
+def request_image(prompt, ref_path):
+    """POSTs the image request and returns (response, JSON body or None).
+
+    As in gemini_keys.call, a 429 or 5xx moves on to the next key; the last answer is returned
+    once every key has been tried or none is left outside its cooldown."""
+    attempts = max(1, len(gemini_keys))
+    for attempt in range(attempts):
+        try:
+            lease = gemini_keys.lease()
+        except NoKeyAvailable:
+            if attempt == 0: raise
+            return response, result
+        with lease:
+            headers = {"Content-Type": "application/json", "x-goog-api-key": lease.secret}
+            image_part, handle_id = reference_image_part(lease.secret, os.path.basename(ref_path), ref_path)
+            # Hand the DB connection back to the pool while Gemini works; the caller's rows reload afterwards
+            db.session.rollback()
+            with profiler.span("upstream"):
+                response = requests.post(API_URL, headers=headers, json={"contents": [{"parts": [{"text": prompt}, image_part]}]}, timeout=(10, 180))
+            if handle_id and response.status_code in (400, 403, 404):
+                # The handle is gone upstream (deleted, expired early, key moved projects): drop it and send the photo inline
+                print(f"[WARN] Gemini rejected reference handle ({response.status_code}), retrying inline")
+                ReferenceUpload.query.filter_by(id=handle_id).delete(); db.session.commit()
+                image_part = inline_image_part(ref_path)
+                with profiler.span("upstream"):
+                    response = requests.post(API_URL, headers=headers, json={"contents": [{"parts": [{"text": prompt}, image_part]}]}, timeout=(10, 180))
+            with profiler.span("json"):
+                result = response.json() if response.status_code == 200 else None
+            lease.record(tokens=result and tokens_from(result), status=response.status_code, retry_after=response.headers.get("Retry-After"))
+        if not retryable(response.status_code): break
+        if attempt < attempts - 1: print(f"[WARN] Gemini image request answered {response.status_code}, trying the next key")
+    return response, result
+
+def write_generated_image(path, data_b64):
+    with open(path, "wb") as f: f.write(base64.b64decode(data_b64))
+
 @app.route('/generate-image', methods=['POST'])
 @jwt_required()
 @cross_origin()
@@ -422,57 +899,41 @@ def generate_image():
     IMAGE_COST = 10
     current_user = db.session.get(User, int(get_jwt_identity()))
     if not current_user: return jsonify({"error": "User not found"}), 404
+    # Early answer only: the upstream call is slow, so the charge below re-checks atomically
     if current_user.credits < IMAGE_COST: return jsonify({"error": "Not enough credits"}), 403
     try:
         data = request.json
         ref_filename = data.get("reference_filename"); category = data.get("category"); theme = data.get("theme"); look = data.get("look"); color_tone = data.get("color_tone"); usage = data.get("usage"); custom_prompt = data.get("custom_prompt")
         if not all([ref_filename, category, theme, look, usage]): return jsonify({"error": "Missing required fields"}), 400
-        artist = "a world-class digital artist and photo-manipulation expert"
         ref_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(ref_filename))
         if not os.path.exists(ref_path): return jsonify({"error": "Reference image not found"}), 404
-        with Image.open(ref_path) as img:
-            buffer = io.BytesIO()
-            img.thumbnail((1024, 1024))
-            img.convert("RGB").save(buffer, format="JPEG", quality=90)
-            img_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
-        
-        prompt = (
-            f"You are {artist}.\n"
-            f"Your task is to transform the person in the reference photo according to the user's request. "
-            f"**The most important rule is to strictly maintain their exact face, features, expression, and identity. DO NOT change their face.**\n\n"
-            f"--- Main Category ---\n"
-            f"The desired category is: **{category}**.\n\n"
-            f"--- Main Theme ---\n"
-            f"The desired theme is: **{theme}**.\n\n"
-            f"--- Desired Look ---\n"
-            f"The final image must have a **{look}** look.\n\n"
-            f"--- Color & Tone ---\n"
-            f"Apply this specific color grade and mood: **{color_tone}**.\n\n"
-            f"--- Image Usage ---\n"
-            f"The image will be used for: **{usage}**.\n\n"
-            + (f"--- Additional User Instructions ---\n{custom_prompt}\n\n" if custom_prompt else "") +
-            f"--- Final Instruction ---\n"
-            f"Combine all elements. Change the clothing and background to be 100% appropriate for the **{theme}** and **{look}**. "
-            f"**Repeat: Keep the subject's original face and identity perfectly recognizable.**"
-        )
-
-        payload = {"contents": [{"parts": [{"text": prompt}, {"inline_data": {"mime_type": "image/jpeg", "data": img_base64}}]}]}
-        headers = {"Content-Type": "application/json"}
-        
-        response = requests.post(API_URL, headers=headers, json=payload, timeout=(10, 180))
+        image_params = {"category": category, "theme": theme, "look": look, "color_tone": color_tone, "usage": usage, "custom_prompt": custom_prompt}
+        prompt = render_prompt(IMAGE_TEMPLATE, image_params)
+
+        response, result = request_image(prompt, ref_path)
         if response.status_code != 200: return jsonify({"error": f"Gemini API returned {response.status_code}", "details": response.text}), response.status_code
-        result = response.json()
         
-        gen_b64 = next((part.get("inline_data", {}).get("data") for part in result.get("candidates", [])[0].get("content", {}).get("parts", []) if "inline_data" in part), None)
+        # The REST API answers in camelCase (inlineData); snake_case is accepted as well
+        gen_b64 = next(((part.get("inlineData") or part.get("inline_data") or {}).get("data") for part in result.get("candidates", [])[0].get("content", {}).get("parts", []) if "inlineData" in part or "inline_data" in part), None)
         if not gen_b64: return jsonify({"error": "Gemini returned no image data"}), 400
-        generated_filename = f"gen_{int(time.time())}_{secure_filename(theme.split(' ')[0])}.jpg"
+        generated_filename = f"gen_u{current_user.id}_{int(time.time())}_{secure_filename(theme.split(' ')[0])}.jpg"
         generated_path = os.path.join(app.config['GENERATED_FOLDER'], generated_filename)
-        with open(generated_path, "wb") as f: f.write(base64.b64decode(gen_b64))
+        with profiler.span("base64"):
+            offload(write_generated_image, generated_path, gen_b64)
         generated_url = f"/generated/{generated_filename}"
-        current_user.credits -= IMAGE_COST
-        new_history_item = SearchHistory(title=f"{theme.title()} ({look.title()})", prompt_content=prompt, generated_result=generated_url, author=current_user)
+        # One conditional UPDATE: concurrent requests cannot both pass a stale balance check
+        charged = db.session.execute(update(User.__table__).where(User.id == current_user.id, User.credits >= IMAGE_COST).values(credits=User.credits - IMAGE_COST))
+        if charged.rowcount != 1:
+            db.session.rollback(); db.session.close(); os.remove(generated_path)
+            return jsonify({"error": "Not enough credits"}), 403
+        new_credits = db.session.scalar(select(User.credits).where(User.id == current_user.id))
+        new_history_item = SearchHistory(title=f"{theme.title()} ({look.title()})", prompt_content="", prompt_template=IMAGE_TEMPLATE, prompt_params=pack_params(image_params), generated_result=generated_url, author=current_user)
         db.session.add(new_history_item); db.session.commit(); db.session.close()
-        return jsonify({"message": "Image generated successfully", "generated_image_url": generated_url, "new_credit_count": current_user.credits}), 200
+        return jsonify({"message": "Image generated successfully", "generated_image_url": generated_url, "new_credit_count": new_credits}), 200
+    except NoKeyAvailable as e:
+        print(f"[ERROR] Generation failed: {e}")
+        db.session.close()
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(int(e.retry_after or 60))}
     except Exception as e:
         print(f"[ERROR] Generation failed: {e}")
         db.session.rollback(); db.session.close()
@@ -481,11 +942,16 @@ def generate_image():
 
 @app.route('/uploads/<path:filename>')
 def serve_upload(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # send_from_directory raises NotFound first, so only files that exist are touched
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    retention_sweeper.touch("uploads", filename)
+    return response
 
 @app.route('/generated/<path:filename>')
 def serve_generated(filename):
-    return send_from_directory(app.config['GENERATED_FOLDER'], filename)
+    response = send_from_directory(app.config['GENERATED_FOLDER'], filename)
+    retention_sweeper.touch("generated", filename)
+    return response
 
 # ------------------------
 # Server Runner
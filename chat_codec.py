@@ -0,0 +1,129 @@
+"""Compact wire encoding for high-volume iSightU chat events.
+
+Clients opt in when connecting (``auth={'codec': 'msgpack'}`` or
+``?codec=msgpack``); everyone else keeps receiving plain JSON. For opted-in
+clients, new_message, user_typing and user_status_changed go out as a
+binary Socket.IO attachment:
+
+    1 flag byte (0 = MessagePack, 1 = zlib-compressed MessagePack) + body
+
+The body is a map with the short keys from FIELD_KEYS, ISO timestamps as
+integer epoch milliseconds and uuids as 16 raw bytes. GET /api/codec
+returns the key tables so clients never hard-code them.
+
+Since one emit cannot carry two encodings, a compact client joins the
+mirror room ``<room>#mp`` instead of ``<room>``, and deliver() in clone.py
+emits each room event once per codec.
+"""
+import zlib
+import uuid
+from datetime import datetime
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'json'
+COMPACT = 'msgpack'
+COMPACT_ROOM_SUFFIX = '#mp'
+
+FLAG_PLAIN = 0
+FLAG_ZLIB = 1
+
+FIELD_KEYS = {
+    'new_message': {
+        'id': 'i', 'chat_id': 'c', 'sender_phone': 's', 'sender_name': 'n',
+        'content': 'b', 'timestamp': 't', 'type': 'y', 'seq': 'q'
+    },
+    'user_typing': {
+        'chat_id': 'c', 'user_phone': 'u', 'user_name': 'n', 'is_typing': 'k'
+    },
+    'user_status_changed': {
+        'phone': 'p', 'is_online': 'o', 'name': 'n', 'last_seen': 'l'
+    }
+}
+TIMESTAMP_FIELDS = {'timestamp', 'last_seen'}
+UUID_FIELDS = {'id'}
+
+
+def available_codecs():
+    return [COMPACT, JSON] if msgpack else [JSON]
+
+
+def negotiate(requested):
+    """Picks the codec for a client: compact only when asked for and msgpack is installed."""
+    return COMPACT if requested == COMPACT and msgpack else JSON
+
+
+def _to_millis(value):
+    try:
+        return int(datetime.fromisoformat(value).timestamp() * 1000)
+    except (TypeError, ValueError):
+        return value
+
+
+def _to_uuid_bytes(value):
+    try:
+        return uuid.UUID(value).bytes
+    except (TypeError, ValueError, AttributeError):
+        return value
+
+
+def compact(event, payload):
+    """Short keys, integer timestamps and binary uuids; unknown fields keep their names."""
+    keys = FIELD_KEYS[event]
+    packed = {}
+    for field, value in payload.items():
+        if value is None:
+            continue
+        if field in TIMESTAMP_FIELDS:
+            value = _to_millis(value)
+        elif field in UUID_FIELDS:
+            value = _to_uuid_bytes(value)
+        packed[keys.get(field, field)] = value
+    return packed
+
+
+def expand(event, packed):
+    """Inverse of compact(); timestamps come back as local ISO strings."""
+    names = {short: field for field, short in FIELD_KEYS[event].items()}
+    payload = {}
+    for short, value in packed.items():
+        field = names.get(short, short)
+        if field in TIMESTAMP_FIELDS and isinstance(value, int):
+            value = datetime.fromtimestamp(value / 1000).isoformat()
+        elif field in UUID_FIELDS and isinstance(value, bytes) and len(value) == 16:
+            value = str(uuid.UUID(bytes=value))
+        payload[field] = value
+    return payload
+
+
+def encode(event, payload, compress_min=512):
+    """Binary frame for a compact client; bodies of compress_min bytes or more are zlib'd when that helps."""
+    body = msgpack.packb(compact(event, payload), use_bin_type=True)
+    if compress_min and len(body) >= compress_min:
+        deflated = zlib.compress(body, 6)
+        if len(deflated) < len(body):
+            return bytes([FLAG_ZLIB]) + deflated
+    return bytes([FLAG_PLAIN]) + body
+
+
+def decode(event, frame):
+    """Client-side reference decoder (also used by the load generator)."""
+    body = frame[1:]
+    if frame[0] == FLAG_ZLIB:
+        body = zlib.decompress(body)
+    return expand(event, msgpack.unpackb(body, raw=False))
+
+
+def describe():
+    """Key tables and framing for GET /api/codec."""
+    return {
+        'codecs': available_codecs(),
+        'room_suffix': COMPACT_ROOM_SUFFIX,
+        'flags': {'msgpack': FLAG_PLAIN, 'msgpack+zlib': FLAG_ZLIB},
+        'fields': FIELD_KEYS,
+        'timestamps': 'epoch milliseconds',
+        'uuids': '16 raw bytes'
+    }
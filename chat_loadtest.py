@@ -0,0 +1,438 @@
+"""Load generator for the iSightU chat server (clone.py).
+
+Registers simulated users over REST, wires them up as contacts, creates
+direct and group chats, then connects one python-socketio client per user
+(spread over several worker processes) and drives send_message,
+typing_start/typing_stop and presence traffic. The offered load is stepped
+up and each step reports messages/sec, end-to-end delivery latency
+percentiles, server CPU/RSS and hub lag; the first step that breaches the
+latency SLO (or where senders can no longer keep up) is reported as the
+degradation point.
+
+    # start a throwaway server and ramp 1000 clients from 0.05 to 1 msg/s each
+    python chat_loadtest.py --spawn-server --clients 1000 --rates 0.05,0.1,0.25,0.5,1
+
+    # against an already running server (pass its pid for CPU/RSS)
+    python chat_loadtest.py --url http://127.0.0.1:5000 --server-pid 12345
+
+Latency is measured from the sender's clock to the receiver's clock, so
+clients and server should run on the same host. The websocket transport is
+used when websocket-client is installed, long-polling otherwise.
+"""
+import os
+import sys
+import time
+import json
+import queue
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import socketio
+
+try:
+    import websocket  # noqa: F401  (websocket-client, enables the websocket transport)
+    TRANSPORTS = ['websocket']
+except ImportError:
+    TRANSPORTS = ['polling']
+
+try:
+    import chat_codec
+except ImportError:
+    chat_codec = None
+
+LATENCY_MARK = 'lt '
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+# ------------------------
+# Server process probes
+# ------------------------
+def process_cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime and stime are fields 14 and 15 of /proc/<pid>/stat
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def process_rss_mb(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+    return None
+
+
+def scrape_gauge(url, name):
+    """Reads one unlabelled gauge from the server's /metrics, None if unavailable."""
+    try:
+        text = requests.get(f'{url}/metrics', timeout=2).text
+    except requests.RequestException:
+        return None
+    for line in text.splitlines():
+        if line.startswith(name + ' '):
+            return float(line.split()[1])
+    return None
+
+
+def spawn_server(port, workdir):
+    # Everything the server persists stays in workdir, so runs never see each other's data
+    env = dict(os.environ,
+               PORT=str(port),
+               CHAT_STATE_URL='memory://' + os.path.join(workdir, 'state'),
+               MESSAGE_LOG_DIR=os.path.join(workdir, 'messages'),
+               MESSAGE_INDEX_PATH=os.path.join(workdir, 'message_index.bin'),
+               MEDIA_DIR=os.path.join(workdir, 'media'),
+               CHAT_LOG_SAMPLE_RATE=os.environ.get('CHAT_LOG_SAMPLE_RATE', '0'))
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clone.py')],
+                              cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.get(url + '/', timeout=1)
+            return server, url
+        except requests.RequestException:
+            if server.poll() is not None:
+                raise RuntimeError('chat server exited during startup')
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('chat server did not come up')
+
+
+# ------------------------
+# Setup over REST
+# ------------------------
+def user_phone(run_id, index):
+    return f'+19{run_id:03d}{index:06d}'
+
+
+def setup_world(url, args):
+    """Registers users, adds direct-chat partners as contacts and creates all chats.
+
+    Returns {phone: [chat_id, ...]} for every simulated user.
+    """
+    phones = [user_phone(args.run_id, i) for i in range(args.clients)]
+    session = requests.Session()
+
+    def register(phone):
+        session.post(f'{url}/api/auth/register', json={'phone': phone, 'name': f'Load {phone[-6:]}'}, timeout=30)
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(register, phones))
+
+    shuffled = phones[:]
+    random.Random(args.run_id).shuffle(shuffled)
+    pairs = [(shuffled[i], shuffled[i + 1]) for i in range(0, len(shuffled) - 1, 2)]
+
+    def befriend(pair):
+        a, b = pair
+        session.post(f'{url}/api/contacts/add', json={'user_phone': a, 'contact_phone': b}, timeout=30)
+        session.post(f'{url}/api/contacts/add', json={'user_phone': b, 'contact_phone': a}, timeout=30)
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(befriend, pairs))
+
+    groups = []
+    group_count = int(args.clients * args.group_fraction / max(1, args.group_size))
+    rng = random.Random(args.run_id + 1)
+    for _ in range(group_count):
+        groups.append(rng.sample(phones, min(args.group_size, len(phones))))
+
+    created = []
+    done = threading.Event()
+    expected = len(pairs) + len(groups)
+    setup_client = socketio.Client(reconnection=False)
+
+    @setup_client.on('chat_created')
+    def on_chat_created(chat):
+        created.append(chat)
+        if len(created) >= expected:
+            done.set()
+
+    setup_client.connect(url, transports=TRANSPORTS)
+    for a, b in pairs:
+        setup_client.call('create_chat', {'participants': [a, b], 'name': 'Direct Chat'}, timeout=30)
+    for index, members in enumerate(groups):
+        setup_client.call('create_chat', {'participants': members, 'name': f'Load group {index}'}, timeout=30)
+    done.wait(timeout=30)
+    setup_client.disconnect()
+
+    memberships = {phone: [] for phone in phones}
+    for chat in created:
+        for participant in chat['participants']:
+            if participant in memberships:
+                memberships[participant].append(chat['id'])
+    return memberships
+
+
+# ------------------------
+# Worker processes
+# ------------------------
+class StepCounters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.latencies = []
+
+    def drain(self):
+        with self.lock:
+            snapshot = (self.sent, self.received, self.errors, self.latencies)
+            self.sent = self.received = self.errors = 0
+            self.latencies = []
+        return snapshot
+
+
+def run_client(phone, chat_ids, url, codec, rate, step, stop, counters, ready, mix):
+    client = socketio.Client(reconnection=False)
+
+    def on_message(payload):
+        if isinstance(payload, bytes):
+            payload = chat_codec.decode('new_message', payload)
+        content = payload.get('content') or ''
+        if content.startswith(LATENCY_MARK):
+            latency = time.time() - float(content.split()[1])
+            with counters.lock:
+                counters.received += 1
+                counters.latencies.append(latency)
+
+    client.on('new_message', on_message)
+    try:
+        client.connect(url, transports=TRANSPORTS, auth={'codec': codec})
+        client.emit('user_online', {'phone': phone})
+        for chat_id in chat_ids:
+            client.emit('join_chat', {'chat_id': chat_id, 'user_phone': phone})
+    except Exception:
+        with counters.lock:
+            counters.errors += 1
+        ready.put(False)
+        return
+    ready.put(True)
+
+    message_cut = mix['message']
+    typing_cut = message_cut + mix['typing']
+    try:
+        while not stop.is_set():
+            per_client = rate.value
+            if per_client <= 0 or step.value < 0 or not chat_ids:
+                time.sleep(0.2)
+                continue
+            time.sleep(random.expovariate(per_client))
+            chat_id = random.choice(chat_ids)
+            roll = random.random()
+            if roll < message_cut:
+                padding = 'x' * random.randint(0, mix['max_padding'])
+                client.emit('send_message', {
+                    'chat_id': chat_id,
+                    'sender_phone': phone,
+                    'content': f'{LATENCY_MARK}{time.time():.6f} {padding}'
+                })
+                with counters.lock:
+                    counters.sent += 1
+            elif roll < typing_cut:
+                client.emit('typing_start', {'chat_id': chat_id, 'user_phone': phone})
+                client.emit('typing_stop', {'chat_id': chat_id, 'user_phone': phone})
+            else:
+                client.emit('user_offline', {'phone': phone})
+                client.emit('user_online', {'phone': phone})
+    except Exception:
+        with counters.lock:
+            counters.errors += 1
+    finally:
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+
+
+def worker_main(worker, slice_, url, codec, rate, step, stop, results, mix):
+    counters = StepCounters()
+    ready = queue.Queue()
+    threads = []
+    started = time.time()
+    for phone, chat_ids in slice_:
+        thread = threading.Thread(target=run_client,
+                                  args=(phone, chat_ids, url, codec, rate, step, stop, counters, ready, mix),
+                                  daemon=True)
+        thread.start()
+        threads.append(thread)
+    connected = sum(1 for _ in threads if ready.get())
+    results.put(('ready', connected, time.time() - started))
+
+    while not stop.is_set():
+        time.sleep(1.0)
+        sent, received, errors, latencies = counters.drain()
+        results.put(('sample', worker, step.value, sent, received, errors, latencies))
+    for thread in threads:
+        thread.join(timeout=2)
+
+
+# ------------------------
+# Coordinator
+# ------------------------
+def run(args):
+    server = None
+    url = args.url
+    server_pid = args.server_pid
+    if args.spawn_server:
+        workdir = tempfile.mkdtemp(prefix='isightu-load-')
+        server, url = spawn_server(args.port, workdir)
+        server_pid = server.pid
+        print(f'Started chat server pid {server_pid} at {url} (data in {workdir})')
+
+    try:
+        started = time.time()
+        memberships = setup_world(url, args)
+        chats = len({c for ids in memberships.values() for c in ids})
+        print(f'Setup: {args.clients} users, {chats} chats in {time.time() - started:.1f}s')
+
+        rate = mp.Value('d', 0.0)
+        step = mp.Value('i', -1)
+        stop = mp.Event()
+        results = mp.Queue()
+        mix = {'message': args.message_share, 'typing': args.typing_share, 'max_padding': args.max_padding}
+        items = list(memberships.items())
+        procs = []
+        for index in range(args.procs):
+            slice_ = items[index::args.procs]
+            proc = mp.Process(target=worker_main,
+                              args=(index, slice_, url, args.codec, rate, step, stop, results, mix),
+                              daemon=True)
+            proc.start()
+            procs.append(proc)
+
+        connected = 0
+        connect_time = 0.0
+        for _ in procs:
+            kind, count, seconds = results.get()
+            connected += count
+            connect_time = max(connect_time, seconds)
+        print(f'Connected {connected}/{args.clients} clients in {connect_time:.1f}s '
+              f'(transport {TRANSPORTS[0]}, codec {args.codec})')
+
+        report = []
+        for index, per_client in enumerate(args.rates):
+            cpu_before = process_cpu_seconds(server_pid) if server_pid else None
+            rate.value = per_client
+            step.value = index
+            step_started = time.time()
+            time.sleep(args.duration)
+            rate.value = 0.0
+            time.sleep(args.drain)
+            elapsed = time.time() - step_started
+            step.value = -1
+            cpu_after = process_cpu_seconds(server_pid) if server_pid else None
+
+            # Every worker flushes once per second; the step is complete once each
+            # of them has reported a sample taken after the step ended
+            sent = received = errors = 0
+            latencies = []
+            flushed = set()
+            while len(flushed) < len(procs):
+                message = results.get()
+                if message[0] != 'sample':
+                    continue
+                _, worker, sample_step, sample_sent, sample_received, sample_errors, sample_latencies = message
+                if sample_step == -1:
+                    flushed.add(worker)
+                elif sample_step == index:
+                    sent += sample_sent
+                    received += sample_received
+                    errors += sample_errors
+                    latencies.extend(sample_latencies)
+            row = {
+                'step': index,
+                'offered': per_client * connected * args.message_share,
+                'sent_per_sec': sent / args.duration,
+                'delivered_per_sec': received / elapsed,
+                'p50_ms': (percentile(latencies, 50) or 0) * 1000,
+                'p95_ms': (percentile(latencies, 95) or 0) * 1000,
+                'p99_ms': (percentile(latencies, 99) or 0) * 1000,
+                'errors': errors,
+                'cpu_pct': 100.0 * (cpu_after - cpu_before) / elapsed if server_pid else None,
+                'rss_mb': process_rss_mb(server_pid) if server_pid else None,
+                'hub_lag_ms': (scrape_gauge(url, 'eventloop_lag_seconds') or 0) * 1000
+            }
+            report.append(row)
+            print_row(row)
+
+        stop.set()
+        for proc in procs:
+            proc.join(timeout=5)
+        summarize(report, args)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+        return report
+    finally:
+        if server:
+            server.terminate()
+            server.wait(timeout=10)
+
+
+def print_row(row):
+    cpu = f"{row['cpu_pct']:6.1f}%" if row['cpu_pct'] is not None else '     - '
+    rss = f"{row['rss_mb']:7.1f}MB" if row['rss_mb'] is not None else '       - '
+    print(f"step {row['step']:2d}  offered {row['offered']:8.1f}/s  sent {row['sent_per_sec']:8.1f}/s  "
+          f"delivered {row['delivered_per_sec']:9.1f}/s  p50 {row['p50_ms']:7.1f}ms  p95 {row['p95_ms']:7.1f}ms  "
+          f"p99 {row['p99_ms']:7.1f}ms  cpu {cpu}  rss {rss}  lag {row['hub_lag_ms']:6.1f}ms  errors {row['errors']}")
+
+
+def summarize(report, args):
+    for row in report:
+        reasons = []
+        if row['p95_ms'] > args.slo_ms:
+            reasons.append(f"p95 {row['p95_ms']:.0f}ms > {args.slo_ms:.0f}ms SLO")
+        if row['offered'] and row['sent_per_sec'] < 0.9 * row['offered']:
+            reasons.append(f"senders reached only {row['sent_per_sec']:.0f} of {row['offered']:.0f} msg/s")
+        if reasons:
+            print(f"Latency degrades at step {row['step']} ({row['offered']:.0f} msg/s offered): " + '; '.join(reasons))
+            return row
+    print(f'No degradation up to {report[-1]["offered"]:.0f} msg/s offered' if report else 'No steps run')
+    return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='iSightU chat load generator')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='chat server base URL')
+    parser.add_argument('--spawn-server', action='store_true', help='start clone.py on --port for the run')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--server-pid', type=int, help='pid of an external server, for CPU/RSS')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--procs', type=int, default=max(1, min(8, os.cpu_count() or 1)))
+    parser.add_argument('--group-size', type=int, default=20)
+    parser.add_argument('--group-fraction', type=float, default=0.5,
+                        help='share of users that also sit in one group chat')
+    parser.add_argument('--rates', default='0.05,0.1,0.25,0.5,1',
+                        help='per-client actions/sec for each step')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds per step')
+    parser.add_argument('--drain', type=float, default=2.0, help='seconds to wait for in-flight deliveries')
+    parser.add_argument('--message-share', type=float, default=0.8)
+    parser.add_argument('--typing-share', type=float, default=0.15)
+    parser.add_argument('--max-padding', type=int, default=200, help='extra message characters')
+    parser.add_argument('--codec', choices=['json', 'msgpack'], default='json')
+    parser.add_argument('--slo-ms', type=float, default=250.0, help='p95 delivery latency SLO')
+    parser.add_argument('--run-id', type=int, default=random.randint(0, 999))
+    parser.add_argument('--json', help='write the per-step report to this file')
+    args = parser.parse_args(argv)
+    args.rates = [float(r) for r in args.rates.split(',') if r]
+    if args.codec == 'msgpack' and (chat_codec is None or chat_codec.msgpack is None):
+        parser.error('--codec msgpack needs the msgpack package')
+    return args
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,223 @@
+"""Event-loop instrumentation for the iSightU chat server.
+
+InstrumentedSocketIO is a drop-in SocketIO that times every @socketio.on
+handler, counts handler errors and records how many clients each emit
+reaches. A background probe measures event-loop (hub) lag, and room sizes
+and connected clients are read straight from the Socket.IO manager when
+/metrics is scraped, so they cost nothing between scrapes.
+
+EventLog replaces per-event prints: records are sampled, serialized as
+one JSON object per line and written by a background listener, so a
+handler never blocks on stdout.
+"""
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import logging.handlers
+from functools import wraps
+from collections import defaultdict
+
+from flask_socketio import SocketIO
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000, 5000)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Minimal counter/gauge/histogram registry rendered in Prometheus text format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[self._key(name, labels)] += value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def collector(self, fn):
+        """Registers fn() -> [(name, labels, value)], evaluated at scrape time as gauges."""
+        self.collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        return '{' + ','.join(f'{k}="{str(v)}"' for k, v in items) + '}'
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            snapshots = [(key, h.buckets, list(h.counts), h.sum, h.count) for key, h in histograms]
+        for fn in self.collectors:
+            try:
+                gauges.extend((self._key(name, labels), value) for name, labels, value in fn())
+            except Exception as e:
+                lines.append(f'# collector error: {e}')
+        for (name, labels), value in counters:
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), value in gauges:
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), buckets, counts, total, count in snapshots:
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_bucket{self._labels(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_sum{self._labels(labels)} {total}')
+            lines.append(f'{name}_count{self._labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+class InstrumentedSocketIO(SocketIO):
+    """SocketIO that records handler latency, handler errors and emit fan-out."""
+
+    def __init__(self, app=None, metrics=None, **kwargs):
+        self.metrics = metrics or Metrics()
+        super().__init__(app, **kwargs)
+
+    def on(self, message, namespace=None):
+        register = super().on(message, namespace=namespace)
+
+        def decorator(handler):
+            @wraps(handler)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return handler(*args, **kwargs)
+                except Exception:
+                    self.metrics.inc('socketio_handler_errors_total', event=message)
+                    raise
+                finally:
+                    self.metrics.observe('socketio_handler_seconds', time.perf_counter() - start, event=message)
+            return register(timed)
+        return decorator
+
+    def _room_size(self, namespace, room):
+        rooms = self.server.manager.rooms.get(namespace or '/', {})
+        return len(rooms.get(room, ()))
+
+    def emit(self, event, *args, **kwargs):
+        namespace = kwargs.get('namespace') or '/'
+        to = kwargs.get('to', kwargs.get('room'))
+        try:
+            targets = to if isinstance(to, (list, tuple, set)) else [to]
+            recipients = sum(self._room_size(namespace, room) for room in targets)
+            skip = kwargs.get('skip_sid')
+            if skip:
+                recipients -= len(skip) if isinstance(skip, (list, tuple, set)) else 1
+            recipients = max(0, recipients)
+            self.metrics.inc('socketio_emits_total', event=event)
+            self.metrics.inc('socketio_emit_recipients_total', recipients, event=event)
+            self.metrics.observe('socketio_emit_recipients', recipients, buckets=FANOUT_BUCKETS)
+        except Exception:
+            pass
+        return super().emit(event, *args, **kwargs)
+
+    def room_stats(self, namespace='/'):
+        """(connected clients, room count, largest room) from the local manager, for /metrics."""
+        rooms = self.server.manager.rooms.get(namespace, {})
+        connected = len(rooms.get(None, ()))
+        # Every client also sits in a room named after its own sid; leave those out
+        named = [len(members) for room, members in rooms.items() if room is not None and room not in members]
+        return [
+            ('socketio_connected_clients', {}, connected),
+            ('socketio_rooms', {}, len(named)),
+            ('socketio_room_size_max', {}, max(named, default=0)),
+            ('socketio_room_members_total', {}, sum(named)),
+        ]
+
+    def start_lag_probe(self, interval=0.5):
+        """Measures how late the hub wakes a sleeping green thread; sustained lag means blocking code."""
+        def probe():
+            while True:
+                start = time.perf_counter()
+                self.sleep(interval)
+                lag = max(0.0, time.perf_counter() - start - interval)
+                self.metrics.set('eventloop_lag_seconds', lag)
+                self.metrics.observe('eventloop_lag', lag)
+        return self.start_background_task(probe)
+
+
+class EventLog:
+    """Sampled, asynchronous structured logging (one JSON object per line)."""
+
+    def __init__(self, name='isightu', sample_rate=0.01, stream=None, filename=None):
+        self.sample_rate = sample_rate
+        self.logger = logging.getLogger(name)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        target = logging.FileHandler(filename) if filename else logging.StreamHandler(stream or sys.stderr)
+        target.setFormatter(logging.Formatter('%(message)s'))
+        records = queue.Queue(maxsize=10000)
+        self.logger.addHandler(_DroppingQueueHandler(records))
+        self.listener = logging.handlers.QueueListener(records, target)
+        self.listener.start()
+
+    def _write(self, level, event, fields):
+        fields = dict(fields, ts=round(time.time(), 3), event=event, level=level)
+        self.logger.log(logging.ERROR if level == 'error' else logging.INFO, json.dumps(fields, default=str))
+
+    def event(self, event, **fields):
+        """High-volume events: only a sample_rate fraction is written."""
+        if self.sample_rate >= 1 or random.random() < self.sample_rate:
+            self._write('info', event, dict(fields, sample_rate=self.sample_rate))
+
+    def info(self, event, **fields):
+        self._write('info', event, fields)
+
+    def error(self, event, **fields):
+        self._write('error', event, fields)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the caller: when the writer falls behind, records are dropped."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
@@ -0,0 +1,321 @@
+"""Pluggable message-queue backends for broadcasting Socket.IO rooms across workers.
+
+Select one with the CHAT_MESSAGE_QUEUE environment variable:
+
+    (unset)                 single process, rooms live in memory
+    local:///tmp/isightu    every worker on this host, over Unix datagram sockets
+    redis://host:6379/0     any Redis-protocol server (needs the `redis` package)
+
+For testing the Redis path without a real Redis, run the stand-in:
+
+    python chat_pubsub.py --standin 6379
+
+All workers must share CHAT_STATE_URL (see chat_state.py) and, when clients
+use the polling transport, the load balancer needs sticky sessions.
+"""
+import os
+import pickle
+import socket
+import argparse
+import threading
+from importlib import metadata
+
+import socketio
+
+# Largest event payload a local datagram can carry; bigger events are dropped with an error
+MAX_DATAGRAM = 200 * 1024
+# Reserved event name for room joins carried over the queue; it is never sent to clients
+ROOM_SYNC_EVENT = '__isightu_enter_rooms'
+
+
+def _enter_local(manager, pairs, namespace):
+    rooms = manager.rooms.get(namespace, {})
+    for source, target in pairs:
+        for sid in list(rooms.get(source, ())):
+            manager.enter_room(sid, namespace, target)
+
+
+class RoomSyncMixin:
+    """enter_rooms() for pub/sub managers: the join travels through the queue like an emit
+    and every worker, this one included, applies it to the connections it holds."""
+
+    def enter_rooms(self, pairs, namespace='/'):
+        self._publish({'method': 'emit', 'event': ROOM_SYNC_EVENT, 'data': [list(pair) for pair in pairs],
+                       'namespace': namespace, 'room': None, 'skip_sid': None, 'callback': None,
+                       'host_id': self.host_id})
+
+    def _handle_emit(self, message):
+        if message.get('event') == ROOM_SYNC_EVENT:
+            _enter_local(self, message['data'], message.get('namespace') or '/')
+            return
+        super()._handle_emit(message)
+
+
+class RedisRoomSyncManager(RoomSyncMixin, socketio.RedisManager):
+    pass
+
+
+def enter_rooms(server, pairs, namespace='/'):
+    """Joins every connection in each (source room, target room) pair's source to its target, on all workers."""
+    if isinstance(server.manager, RoomSyncMixin):
+        server.manager.enter_rooms(pairs, namespace)
+    else:
+        _enter_local(server.manager, pairs, namespace)
+
+
+class LocalSocketManager(RoomSyncMixin, socketio.PubSubManager):
+    """Host-local pub/sub: each worker binds a datagram socket in a shared directory
+    and publishing sends the pickled event to every socket found there."""
+    name = 'local'
+
+    def __init__(self, path, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = os.path.join(path, channel)
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        self.address = os.path.join(self.path, f'{os.getpid()}-{self.host_id[:8]}.sock')
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.settimeout(1.0)
+
+    def _publish(self, data):
+        payload = pickle.dumps(data)
+        if len(payload) > MAX_DATAGRAM:
+            self._get_logger().error(f'local pubsub: dropping {len(payload)} byte event')
+            return
+        for name in os.listdir(self.path):
+            if not name.endswith('.sock'):
+                continue
+            target = os.path.join(self.path, name)
+            try:
+                self.sender.sendto(payload, target)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # The worker behind this socket has exited
+                try:
+                    os.unlink(target)
+                except FileNotFoundError:
+                    pass
+            except OSError as e:
+                self._get_logger().error(f'local pubsub: send to {name} failed: {e}')
+
+    def _listen(self):
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        receiver.bind(self.address)
+        try:
+            receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        except OSError:
+            pass
+        try:
+            while True:
+                yield receiver.recv(MAX_DATAGRAM)
+        finally:
+            receiver.close()
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+
+
+def install_encode_once(server):
+    """Makes a room emit encode its packet once instead of once per recipient.
+
+    The manager fans an emit out by calling server._emit_internal for every
+    participant with the same event and payload objects, and the stock
+    implementation re-serializes the payload each time. The last encoded
+    packet is reused while those objects stay the same, which turns a
+    large-group emit into one json.dumps plus a send per connection. The
+    cache is dropped after every emit, so it never outlives one fan-out.
+
+    _emit_internal is private, so this is only installed on the python-socketio
+    release line it was written against (5.x, pinned in requirements.txt).
+    """
+    from socketio import packet
+
+    try:
+        version = metadata.version('python-socketio')
+    except metadata.PackageNotFoundError:
+        version = ''
+    if not version.startswith('5.') or not hasattr(server, '_emit_internal'):
+        print(f'[WARN] encode-once disabled: untested python-socketio {version or "(unknown)"}')
+        return server
+
+    last = [None]
+
+    def emit_internal(eio_sid, event, data, namespace=None, id=None):
+        cached = last[0]
+        if id is None and cached and cached[0] == event and cached[1] is data and cached[2] == namespace:
+            pkt, encoded = cached[3], cached[4]
+        else:
+            if isinstance(data, tuple):
+                args = list(data)
+            elif data is not None:
+                args = [data]
+            else:
+                args = []
+            pkt = server.packet_class(packet.EVENT, namespace=namespace, data=[event] + args, id=id)
+            encoded = pkt.encode()
+            if id is None:
+                last[0] = (event, data, namespace, pkt, encoded)
+        if '_send_packet' in vars(server):
+            # Replaced on the instance (Flask-SocketIO's test client captures packets there)
+            server._send_packet(eio_sid, pkt)
+            return
+        for part in encoded if isinstance(encoded, list) else [encoded]:
+            server.eio.send(eio_sid, part)
+
+    def scoped(fan_out):
+        def wrapper(*args, **kwargs):
+            try:
+                return fan_out(*args, **kwargs)
+            finally:
+                last[0] = None
+        return wrapper
+
+    server._emit_internal = emit_internal
+    # Local emits fan out inside server.emit, queued ones inside the manager's _handle_emit
+    server.emit = scoped(server.emit)
+    if hasattr(server.manager, '_handle_emit'):
+        server.manager._handle_emit = scoped(server.manager._handle_emit)
+    return server
+
+
+def make_client_manager(url, channel='isightu'):
+    """Builds the Socket.IO client manager for a CHAT_MESSAGE_QUEUE value (None = in-process)."""
+    if not url:
+        return None
+    if url.startswith('local://'):
+        return LocalSocketManager(url[len('local://'):], channel=channel)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisRoomSyncManager(url, channel=channel)
+    raise ValueError(f'Unsupported CHAT_MESSAGE_QUEUE: {url}')
+
+
+# ------------------------
+# Redis stand-in for tests
+# ------------------------
+class RespStandIn:
+    """Tiny Redis-protocol server implementing just HELLO/PING/SUBSCRIBE/UNSUBSCRIBE/PUBLISH.
+
+    Enough for socketio.RedisManager, so the Redis backend can be exercised
+    locally and in CI without a Redis install. Speaks RESP2, or RESP3 after
+    HELLO 3 (pub/sub frames then go out as push messages). Unknown commands
+    answer +OK.
+    """
+
+    def __init__(self, host='127.0.0.1', port=6379):
+        self.host = host
+        self.port = port
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.listener = None
+
+    @staticmethod
+    def _bulk(value):
+        if isinstance(value, str):
+            value = value.encode()
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def _array(self, *items, push=False):
+        return (b'>' if push else b'*') + b'%d\r\n' % len(items) + b''.join(
+            b':%d\r\n' % item if isinstance(item, int) else self._bulk(item) for item in items
+        )
+
+    @staticmethod
+    def _read_command(reader):
+        line = reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(reader.readline()[1:])
+            args.append(reader.read(size + 2)[:-2])
+        return args
+
+    def _send(self, conn, payload):
+        try:
+            conn.sendall(payload)
+        except OSError:
+            pass
+
+    def _serve_client(self, conn):
+        reader = conn.makefile('rb')
+        channels = set()
+        resp3 = False
+        try:
+            while True:
+                args = self._read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                command = args[0].upper()
+                if command == b'HELLO':
+                    resp3 = len(args) > 1 and args[1] == b'3'
+                    if resp3:
+                        self._send(conn, b'%2\r\n' + self._bulk('server') + self._bulk('standin')
+                                   + self._bulk('proto') + b':3\r\n')
+                    else:
+                        self._send(conn, self._array(b'server', b'standin', b'proto', 2))
+                elif command == b'PING':
+                    self._send(conn, b'+PONG\r\n')
+                elif command == b'SUBSCRIBE':
+                    for channel in args[1:]:
+                        channels.add(channel)
+                        with self.lock:
+                            self.subscribers.setdefault(channel, {})[conn] = resp3
+                        self._send(conn, self._array(b'subscribe', channel, len(channels), push=resp3))
+                elif command == b'UNSUBSCRIBE':
+                    for channel in args[1:] or list(channels):
+                        channels.discard(channel)
+                        with self.lock:
+                            self.subscribers.get(channel, {}).pop(conn, None)
+                        self._send(conn, self._array(b'unsubscribe', channel, len(channels), push=resp3))
+                elif command == b'PUBLISH':
+                    channel, message = args[1], args[2]
+                    with self.lock:
+                        targets = list(self.subscribers.get(channel, {}).items())
+                    for target, target_resp3 in targets:
+                        self._send(target, self._array(b'message', channel, message, push=target_resp3))
+                    self._send(conn, b':%d\r\n' % len(targets))
+                else:
+                    self._send(conn, b'+OK\r\n')
+        finally:
+            with self.lock:
+                for channel in channels:
+                    self.subscribers.get(channel, {}).pop(conn, None)
+            conn.close()
+
+    def start(self):
+        """Starts accepting connections in a background thread; returns the bound port."""
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(128)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self.port
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+
+    def stop(self):
+        if self.listener:
+            self.listener.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='iSightU pub/sub utilities')
+    parser.add_argument('--standin', type=int, metavar='PORT', help='run the Redis-protocol stand-in on PORT')
+    args = parser.parse_args()
+    if args.standin is None:
+        parser.error('nothing to do (try --standin 6379)')
+    standin = RespStandIn(port=args.standin)
+    print(f'Redis stand-in listening on 127.0.0.1:{standin.start()}')
+    threading.Event().wait()
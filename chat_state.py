@@ -0,0 +1,897 @@
+"""Shared state behind the iSightU chat server.
+
+clone.py talks to a StateStore instead of module-level dicts so several
+worker processes (or nodes sharing a volume) can serve the same users and
+rooms. Two backends are provided:
+
+    memory://                 plain dicts, single process, lost on restart
+    memory://path/to/dir      the same dicts, persisted as snapshots plus a journal in dir
+    sqlite:////path/state.db  one SQLite file in WAL mode, shared by every worker on the host
+
+Pick one with the CHAT_STATE_URL environment variable.
+"""
+import os
+import re
+import json
+import time
+import bisect
+import uuid
+import pickle
+import socket
+import sqlite3
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from itertools import islice
+
+# Search keys are "p:<digits>" for phone numbers and "n:<lowercase text>" for names
+_NON_DIGITS = re.compile(r'\D')
+_PHONE_QUERY = re.compile(r'^[\d\s()+.-]+$')
+# Upper bound for prefix range scans over sorted keys
+_KEY_MAX = '\U0010ffff'
+
+
+def normalize_phone(value):
+    """Digits only, with an international 00 prefix folded into the plain form."""
+    digits = _NON_DIGITS.sub('', value or '')
+    return digits[2:] if digits.startswith('00') else digits
+
+
+def user_search_keys(user):
+    """Every key a user can be found under: the phone digits, the full name and each name word."""
+    keys = {'p:' + normalize_phone(user['phone'])}
+    name = ' '.join((user.get('name') or '').lower().split())
+    if name:
+        keys.add('n:' + name)
+        keys.update('n:' + word for word in name.split())
+    return keys
+
+
+def query_search_key(query):
+    """Maps type-ahead input to the key prefix to scan, or None for an empty query."""
+    query = (query or '').strip()
+    if not query:
+        return None
+    if _PHONE_QUERY.match(query):
+        digits = normalize_phone(query)
+        return 'p:' + digits if digits else None
+    return 'n:' + ' '.join(query.lower().split())
+
+
+class StateStore:
+    """Interface every backend implements. All values are plain JSON-able dicts."""
+
+    # --- Users -----------------------------------------------------------
+    def get_user(self, phone):
+        raise NotImplementedError
+
+    def add_user(self, user):
+        """Stores a new user; returns False if the phone is already registered."""
+        raise NotImplementedError
+
+    def update_user(self, phone, **fields):
+        """Updates fields of an existing user and returns it (None if unknown)."""
+        raise NotImplementedError
+
+    def list_users(self):
+        raise NotImplementedError
+
+    def get_users(self, phones):
+        """Batched lookup: {phone: user} for the phones that exist."""
+        raise NotImplementedError
+
+    def search_users(self, query, limit=20):
+        """Type-ahead search by phone-number or name prefix."""
+        raise NotImplementedError
+
+    def match_phones(self, phones):
+        """Address-book matching: {input number: user} for the numbers that are registered."""
+        raise NotImplementedError
+
+    # --- Presence --------------------------------------------------------
+    def set_online(self, phone, is_online, last_seen=None):
+        raise NotImplementedError
+
+    def online_users(self):
+        raise NotImplementedError
+
+    def add_device(self, phone, sid):
+        """Registers a connection for phone; returns how many it now has."""
+        raise NotImplementedError
+
+    def remove_device(self, phone, sid):
+        """Forgets a connection; returns how many phone still has (0 = offline everywhere)."""
+        raise NotImplementedError
+
+    def heartbeat(self):
+        """Marks this worker's connections alive and drops those of workers that stopped
+        heartbeating; returns the users that went offline because of it."""
+        return []
+
+    # --- Contacts --------------------------------------------------------
+    def get_contacts(self, phone):
+        raise NotImplementedError
+
+    def is_contact(self, phone, contact_phone):
+        raise NotImplementedError
+
+    def add_contact(self, phone, contact_phone):
+        """Returns False if the contact was already present."""
+        raise NotImplementedError
+
+    def remove_contact(self, phone, contact_phone):
+        """Returns False if there was nothing to remove."""
+        raise NotImplementedError
+
+    def get_watchers(self, phone):
+        """Reverse contact index: phones of users who have `phone` as a contact."""
+        raise NotImplementedError
+
+    # --- Chats -----------------------------------------------------------
+    def get_chat(self, chat_id):
+        raise NotImplementedError
+
+    def create_chat(self, chat):
+        """Stores a new chat; returns False if the id already exists."""
+        raise NotImplementedError
+
+    def touch_chat(self, chat_id):
+        """Moves a chat to the top of every participant's chat list."""
+        raise NotImplementedError
+
+    def user_chats(self, phone, offset=0, limit=50):
+        """Returns (chats most recently active first, total chat count for the user)."""
+        raise NotImplementedError
+
+    def get_chat_summary(self, chat_id):
+        raise NotImplementedError
+
+    def set_chat_summary(self, chat_id, summary):
+        raise NotImplementedError
+
+    # --- Delivery acknowledgements ----------------------------------------
+    def ack(self, phone, chat_id, seq):
+        """Records that phone has received chat_id up to seq (never moves backwards)."""
+        raise NotImplementedError
+
+    def get_acks(self, phone, chat_ids):
+        """{chat_id: highest acknowledged seq} for the given chats (missing = 0)."""
+        raise NotImplementedError
+
+
+class MemoryStateStore(StateStore):
+    """Single-process store backed by dicts."""
+
+    def __init__(self):
+        self.users = {}
+        # phone -> contact phones; a dict used as an insertion-ordered set
+        self.contacts = {}
+        # Sorted (search key, phone) pairs for prefix scans, plus exact digits -> phone
+        self.search_index = []
+        self.phone_digits = {}
+        # Reverse contact index: phone -> set of phones that have it as a contact
+        self.watchers = {}
+        self.chats = {}
+        self.online = set()
+        # phone -> OrderedDict of chat ids, most recently active last
+        self.user_chat_index = {}
+        self.chat_summaries = {}
+        # phone -> {chat_id: highest delivered seq}
+        self.acks = {}
+        # phone -> Socket.IO sids of the user's connected devices
+        self.devices = {}
+
+    def get_user(self, phone):
+        return self.users.get(phone)
+
+    def add_user(self, user):
+        if user['phone'] in self.users:
+            return False
+        self.users[user['phone']] = user
+        self.contacts.setdefault(user['phone'], {})
+        self._index_user(user)
+        return True
+
+    def _index_user(self, user):
+        for key in user_search_keys(user):
+            bisect.insort(self.search_index, (key, user['phone']))
+        self.phone_digits[normalize_phone(user['phone'])] = user['phone']
+
+    def update_user(self, phone, **fields):
+        user = self.users.get(phone)
+        if user:
+            user.update(fields)
+        return user
+
+    def list_users(self):
+        return list(self.users.values())
+
+    def get_users(self, phones):
+        return {phone: self.users[phone] for phone in phones if phone in self.users}
+
+    def search_users(self, query, limit=20):
+        prefix = query_search_key(query)
+        if prefix is None:
+            return []
+        found = {}
+        i = bisect.bisect_left(self.search_index, (prefix,))
+        while i < len(self.search_index) and len(found) < limit:
+            key, phone = self.search_index[i]
+            if not key.startswith(prefix):
+                break
+            found.setdefault(phone, self.users[phone])
+            i += 1
+        return list(found.values())
+
+    def match_phones(self, phones):
+        matches = {}
+        for number in phones:
+            phone = self.phone_digits.get(normalize_phone(number))
+            if phone:
+                matches[number] = self.users[phone]
+        return matches
+
+    def set_online(self, phone, is_online, last_seen=None):
+        fields = {'is_online': is_online}
+        if last_seen:
+            fields['last_seen'] = last_seen
+        user = self.update_user(phone, **fields)
+        if is_online:
+            self.online.add(phone)
+        else:
+            self.online.discard(phone)
+        return user
+
+    def online_users(self):
+        return [self.users[phone] for phone in self.online if phone in self.users]
+
+    def add_device(self, phone, sid):
+        devices = self.devices.setdefault(phone, set())
+        devices.add(sid)
+        return len(devices)
+
+    def remove_device(self, phone, sid):
+        devices = self.devices.get(phone, set())
+        devices.discard(sid)
+        if not devices:
+            self.devices.pop(phone, None)
+        return len(devices)
+
+    def get_contacts(self, phone):
+        return list(self.contacts.get(phone, {}))
+
+    def is_contact(self, phone, contact_phone):
+        return contact_phone in self.contacts.get(phone, {})
+
+    def add_contact(self, phone, contact_phone):
+        user_contacts = self.contacts.setdefault(phone, {})
+        if contact_phone in user_contacts:
+            return False
+        user_contacts[contact_phone] = True
+        self.watchers.setdefault(contact_phone, set()).add(phone)
+        return True
+
+    def remove_contact(self, phone, contact_phone):
+        user_contacts = self.contacts.get(phone, {})
+        if contact_phone not in user_contacts:
+            return False
+        del user_contacts[contact_phone]
+        self.watchers.get(contact_phone, set()).discard(phone)
+        return True
+
+    def get_watchers(self, phone):
+        return set(self.watchers.get(phone, ()))
+
+    def get_chat(self, chat_id):
+        return self.chats.get(chat_id)
+
+    def create_chat(self, chat):
+        if chat['id'] in self.chats:
+            return False
+        self.chats[chat['id']] = chat
+        return True
+
+    def touch_chat(self, chat_id):
+        chat = self.chats.get(chat_id)
+        if not chat:
+            return
+        for phone in chat['participants']:
+            index = self.user_chat_index.setdefault(phone, OrderedDict())
+            index[chat_id] = True
+            index.move_to_end(chat_id)
+
+    def user_chats(self, phone, offset=0, limit=50):
+        index = self.user_chat_index.get(phone, OrderedDict())
+        page = [self.chats[chat_id] for chat_id in islice(reversed(index), offset, offset + limit)]
+        return page, len(index)
+
+    def get_chat_summary(self, chat_id):
+        return self.chat_summaries.get(chat_id)
+
+    def set_chat_summary(self, chat_id, summary):
+        self.chat_summaries[chat_id] = summary
+
+    def ack(self, phone, chat_id, seq):
+        user_acks = self.acks.setdefault(phone, {})
+        if seq > user_acks.get(chat_id, 0):
+            user_acks[chat_id] = seq
+
+    def get_acks(self, phone, chat_ids):
+        user_acks = self.acks.get(phone, {})
+        return {chat_id: user_acks[chat_id] for chat_id in chat_ids if chat_id in user_acks}
+
+
+class JournaledMemoryStateStore(MemoryStateStore):
+    """MemoryStateStore that survives restarts: snapshots plus a write-ahead journal.
+
+    Every mutation is appended to journal.<gen> (one JSON line, flushed to the
+    OS) before it is applied. snapshot() rotates to a new journal and forks:
+    the child pickles the dicts as they were at that instant (copy-on-write)
+    while the parent keeps serving, so a snapshot costs the hub only the
+    fork. snapshot.<gen> holds everything written before journal.<gen>;
+    once it is complete, older snapshots and journals are deleted.
+
+    The fork happens in a process running threads and the eventlet hub. Only
+    the forking thread exists in the child, so it must not touch anything
+    another thread could have held locked at that instant: it only pickles
+    the dicts into its own file and leaves with os._exit() (no atexit, no
+    logging, no sockets). Where fork is unavailable the snapshot is written
+    in-process instead.
+
+    Startup bulk-loads the newest snapshot and replays the journals after
+    it. Connected devices are not persisted, so every user the restored state
+    still has online is marked offline (last seen at the restart); clients
+    re-announce on reconnect.
+    """
+
+    PERSISTENT = ('users', 'contacts', 'search_index', 'phone_digits', 'watchers', 'chats',
+                  'online', 'user_chat_index', 'chat_summaries', 'acks')
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._journal = None
+        # >0 while replaying or inside an operation that is already journaled
+        self._quiet = 0
+        self.journal_records = 0
+        self.snapshot_pid = None
+        self.stats = {'restore_seconds': 0.0, 'snapshot_loaded': None, 'replayed': 0,
+                      'snapshots': 0, 'last_fork_ms': None, 'last_snapshot_seconds': None,
+                      'last_snapshot_bytes': None}
+        self._restore()
+
+    # --- Files -----------------------------------------------------------
+    def _files(self, kind):
+        """{generation: path} for 'snapshot' or 'journal' files."""
+        found = {}
+        for name in os.listdir(self.path):
+            parts = name.split('.')
+            if len(parts) == 2 and parts[0] == kind and parts[1].isdigit():
+                found[int(parts[1])] = os.path.join(self.path, name)
+        return found
+
+    def _file(self, kind, generation):
+        return os.path.join(self.path, f'{kind}.{generation:012d}')
+
+    def _restore(self):
+        started = time.perf_counter()
+        snapshots = self._files('snapshot')
+        base = 0
+        for generation in sorted(snapshots, reverse=True):
+            try:
+                with open(snapshots[generation], 'rb') as f:
+                    state = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError) as e:
+                print(f"[ERROR] Skipping unreadable snapshot {snapshots[generation]}: {e}")
+                continue
+            for name in self.PERSISTENT:
+                setattr(self, name, state[name])
+            base = generation
+            self.stats['snapshot_loaded'] = snapshots[generation]
+            break
+        journals = self._files('journal')
+        self._quiet += 1
+        for generation in sorted(journals):
+            if generation >= base:
+                self.stats['replayed'] += self._replay(journals[generation])
+        self._quiet -= 1
+        self.generation = max([base] + list(journals)) + 1
+        self._journal = open(self._file('journal', self.generation), 'a', encoding='utf-8')
+        # No socket survived the restart, so nobody is online until they reconnect
+        last_seen = datetime.now().isoformat()
+        for phone in list(self.online):
+            self.set_online(phone, False, last_seen=last_seen)
+        self.stats['restore_seconds'] = round(time.perf_counter() - started, 3)
+
+    def _replay(self, path):
+        replayed = 0
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    op, args = json.loads(line)
+                except ValueError:
+                    # Torn final record from a crash mid-write
+                    break
+                if op == 'update_user':
+                    MemoryStateStore.update_user(self, args[0], **args[1])
+                else:
+                    getattr(MemoryStateStore, op)(self, *args)
+                replayed += 1
+        return replayed
+
+    def _log(self, op, *args):
+        if self._quiet:
+            return
+        self._journal.write(json.dumps([op, args], separators=(',', ':')) + '\n')
+        self._journal.flush()
+        self.journal_records += 1
+
+    # --- Snapshots -------------------------------------------------------
+    def snapshot(self):
+        """Starts a snapshot; returns False if one is still running or nothing changed."""
+        with self._lock:
+            if self.snapshot_pid or not self.journal_records:
+                return False
+            self._journal.close()
+            generation = self.generation = self.generation + 1
+            self._journal = open(self._file('journal', generation), 'a', encoding='utf-8')
+            self.journal_records = 0
+            started = time.perf_counter()
+            if hasattr(os, 'fork'):
+                pid = os.fork()
+                if pid == 0:
+                    code = 1
+                    try:
+                        self._write_snapshot(generation)
+                        code = 0
+                    finally:
+                        os._exit(code)
+                self.snapshot_pid = pid
+            else:
+                self._write_snapshot(generation)
+            self.stats['last_fork_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            self._snapshot_started = started
+            self._snapshot_generation = generation
+        if not self.snapshot_pid:
+            self._snapshot_done(True)
+        return True
+
+    def _write_snapshot(self, generation):
+        target = self._file('snapshot', generation)
+        partial = target + '.tmp'
+        with open(partial, 'wb') as f:
+            pickle.dump({name: getattr(self, name) for name in self.PERSISTENT}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, target)
+
+    def poll_snapshot(self):
+        """Reaps a finished snapshot child; returns True while one is still running."""
+        if not self.snapshot_pid:
+            return False
+        pid, status = os.waitpid(self.snapshot_pid, os.WNOHANG)
+        if pid == 0:
+            return True
+        self.snapshot_pid = None
+        self._snapshot_done(os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0)
+        return False
+
+    def _snapshot_done(self, ok):
+        generation = self._snapshot_generation
+        if not ok:
+            print(f"[ERROR] Snapshot {generation} failed; journals are kept")
+            return
+        self.stats['snapshots'] += 1
+        self.stats['last_snapshot_seconds'] = round(time.perf_counter() - self._snapshot_started, 3)
+        self.stats['last_snapshot_bytes'] = os.path.getsize(self._file('snapshot', generation))
+        for kind in ('snapshot', 'journal'):
+            for old, path in self._files(kind).items():
+                if old < generation:
+                    os.remove(path)
+
+    def run_snapshots(self, sleep, interval=60.0, max_records=50000):
+        """Background loop (start it with the Socket.IO server's start_background_task)."""
+        last = time.monotonic()
+        while True:
+            sleep(0.5)
+            if self.poll_snapshot():
+                continue
+            due = time.monotonic() - last >= interval
+            if (due or self.journal_records >= max_records) and self.snapshot():
+                last = time.monotonic()
+
+    def close(self):
+        """Final snapshot written in-process (used at shutdown)."""
+        with self._lock:
+            while self.snapshot_pid:
+                self.poll_snapshot()
+                time.sleep(0.05)
+            if self.journal_records:
+                self._journal.close()
+                self.generation += 1
+                self._journal = open(self._file('journal', self.generation), 'a', encoding='utf-8')
+                self.journal_records = 0
+                self._snapshot_started = time.perf_counter()
+                self._snapshot_generation = self.generation
+                self._write_snapshot(self.generation)
+                self._snapshot_done(True)
+            self._journal.close()
+            if os.path.getsize(self._journal.name) == 0:
+                os.remove(self._journal.name)
+
+    # --- Journaled mutations ---------------------------------------------
+    def add_user(self, user):
+        with self._lock:
+            self._log('add_user', user)
+            return super().add_user(user)
+
+    def update_user(self, phone, **fields):
+        with self._lock:
+            self._log('update_user', phone, fields)
+            return super().update_user(phone, **fields)
+
+    def set_online(self, phone, is_online, last_seen=None):
+        with self._lock:
+            self._log('set_online', phone, is_online, last_seen)
+            # The base implementation goes through update_user; don't journal that twice
+            self._quiet += 1
+            try:
+                return super().set_online(phone, is_online, last_seen)
+            finally:
+                self._quiet -= 1
+
+    def add_contact(self, phone, contact_phone):
+        with self._lock:
+            self._log('add_contact', phone, contact_phone)
+            return super().add_contact(phone, contact_phone)
+
+    def remove_contact(self, phone, contact_phone):
+        with self._lock:
+            self._log('remove_contact', phone, contact_phone)
+            return super().remove_contact(phone, contact_phone)
+
+    def create_chat(self, chat):
+        with self._lock:
+            self._log('create_chat', chat)
+            return super().create_chat(chat)
+
+    def touch_chat(self, chat_id):
+        with self._lock:
+            self._log('touch_chat', chat_id)
+            return super().touch_chat(chat_id)
+
+    def set_chat_summary(self, chat_id, summary):
+        with self._lock:
+            self._log('set_chat_summary', chat_id, summary)
+            return super().set_chat_summary(chat_id, summary)
+
+    def ack(self, phone, chat_id, seq):
+        with self._lock:
+            self._log('ack', phone, chat_id, seq)
+            return super().ack(phone, chat_id, seq)
+
+
+class SqliteStateStore(StateStore):
+    """Store shared by every process that opens the same SQLite file."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (phone TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS user_search (
+            key TEXT NOT NULL, phone TEXT NOT NULL, PRIMARY KEY (key, phone)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS online (phone TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS contacts (
+            phone TEXT NOT NULL, contact_phone TEXT NOT NULL, added_at REAL NOT NULL,
+            PRIMARY KEY (phone, contact_phone)
+        );
+        CREATE INDEX IF NOT EXISTS contacts_reverse ON contacts (contact_phone);
+        CREATE TABLE IF NOT EXISTS chats (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS user_chats (
+            phone TEXT NOT NULL, chat_id TEXT NOT NULL, activity REAL NOT NULL,
+            PRIMARY KEY (phone, chat_id)
+        );
+        CREATE INDEX IF NOT EXISTS user_chats_activity ON user_chats (phone, activity DESC);
+        CREATE TABLE IF NOT EXISTS chat_summaries (chat_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS acks (
+            phone TEXT NOT NULL, chat_id TEXT NOT NULL, seq INTEGER NOT NULL,
+            PRIMARY KEY (phone, chat_id)
+        );
+        CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, heartbeat REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS devices (
+            phone TEXT NOT NULL, sid TEXT NOT NULL, worker TEXT NOT NULL, PRIMARY KEY (phone, sid)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS devices_worker ON devices (worker);
+    """
+
+    def __init__(self, path, device_ttl=90):
+        self.path = path
+        # Connections belong to the worker holding the socket; a worker that stops heartbeating
+        # for device_ttl seconds has crashed and its devices are dropped by the others
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+        self.device_ttl = device_ttl
+        # One connection per process: green threads would otherwise each open their own
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        if 'worker' not in [row[1] for row in self._db.execute('PRAGMA table_info(devices)')]:
+            # Rows from before worker tracking cannot be attributed; clients re-register on reconnect
+            self._db.execute('DROP TABLE IF EXISTS devices')
+        self._db.executescript(self.SCHEMA)
+        self._lock = threading.RLock()
+        self._backfill_search_index()
+        self.heartbeat()
+
+    def _backfill_search_index(self):
+        """Indexes users stored before the search table existed."""
+        with self._conn(write=True) as conn:
+            if conn.execute('SELECT 1 FROM user_search LIMIT 1').fetchone():
+                return
+            for (data,) in conn.execute('SELECT data FROM users').fetchall():
+                user = json.loads(data)
+                conn.executemany('INSERT OR IGNORE INTO user_search (key, phone) VALUES (?, ?)',
+                                 [(key, user['phone']) for key in user_search_keys(user)])
+
+    def _conn(self, write=False):
+        return _Transaction(self._db, self._lock, write)
+
+    # --- Users -----------------------------------------------------------
+    def get_user(self, phone):
+        with self._conn() as conn:
+            row = conn.execute('SELECT data FROM users WHERE phone = ?', (phone,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add_user(self, user):
+        with self._conn(write=True) as conn:
+            cur = conn.execute('INSERT OR IGNORE INTO users (phone, data) VALUES (?, ?)',
+                               (user['phone'], json.dumps(user)))
+            if cur.rowcount != 1:
+                return False
+            conn.executemany('INSERT OR IGNORE INTO user_search (key, phone) VALUES (?, ?)',
+                             [(key, user['phone']) for key in user_search_keys(user)])
+            return True
+
+    def update_user(self, phone, **fields):
+        with self._conn(write=True) as conn:
+            row = conn.execute('SELECT data FROM users WHERE phone = ?', (phone,)).fetchone()
+            if not row:
+                return None
+            user = json.loads(row[0])
+            user.update(fields)
+            conn.execute('UPDATE users SET data = ? WHERE phone = ?', (json.dumps(user), phone))
+        return user
+
+    def list_users(self):
+        with self._conn() as conn:
+            return [json.loads(data) for (data,) in conn.execute('SELECT data FROM users')]
+
+    def get_users(self, phones):
+        phones = list(phones)
+        users = {}
+        with self._conn() as conn:
+            for i in range(0, len(phones), 500):
+                chunk = phones[i:i + 500]
+                rows = conn.execute(f'SELECT phone, data FROM users WHERE phone IN ({",".join("?" * len(chunk))})', chunk)
+                users.update((phone, json.loads(data)) for phone, data in rows)
+        return users
+
+    def search_users(self, query, limit=20):
+        prefix = query_search_key(query)
+        if prefix is None:
+            return []
+        with self._conn() as conn:
+            # A user owns a few keys (phone, full name, name words), so over-fetch and dedupe
+            rows = conn.execute(
+                'SELECT phone FROM user_search WHERE key >= ? AND key < ? ORDER BY key LIMIT ?',
+                (prefix, prefix + _KEY_MAX, limit * 4)
+            )
+            phones = list(dict.fromkeys(phone for (phone,) in rows))[:limit]
+        found = self.get_users(phones)
+        return [found[phone] for phone in phones if phone in found]
+
+    def match_phones(self, phones):
+        keys = {}
+        for number in phones:
+            keys.setdefault('p:' + normalize_phone(number), []).append(number)
+        key_list = list(keys)
+        registered = {}
+        with self._conn() as conn:
+            for i in range(0, len(key_list), 500):
+                chunk = key_list[i:i + 500]
+                rows = conn.execute(f'SELECT key, phone FROM user_search WHERE key IN ({",".join("?" * len(chunk))})', chunk)
+                registered.update(rows)
+        found = self.get_users(set(registered.values()))
+        return {
+            number: found[registered[key]]
+            for key, numbers in keys.items() if key in registered and registered[key] in found
+            for number in numbers
+        }
+
+    # --- Presence --------------------------------------------------------
+    def set_online(self, phone, is_online, last_seen=None):
+        fields = {'is_online': is_online}
+        if last_seen:
+            fields['last_seen'] = last_seen
+        with self._conn(write=True) as conn:
+            user = self.update_user(phone, **fields)
+            if is_online:
+                conn.execute('INSERT OR IGNORE INTO online (phone) VALUES (?)', (phone,))
+            else:
+                conn.execute('DELETE FROM online WHERE phone = ?', (phone,))
+        return user
+
+    def online_users(self):
+        with self._conn() as conn:
+            rows = conn.execute('SELECT u.data FROM online o JOIN users u ON u.phone = o.phone')
+            return [json.loads(data) for (data,) in rows]
+
+    def add_device(self, phone, sid):
+        with self._conn(write=True) as conn:
+            conn.execute('INSERT OR IGNORE INTO devices (phone, sid, worker) VALUES (?, ?, ?)',
+                         (phone, sid, self.worker_id))
+            return conn.execute('SELECT COUNT(*) FROM devices WHERE phone = ?', (phone,)).fetchone()[0]
+
+    def remove_device(self, phone, sid):
+        with self._conn(write=True) as conn:
+            conn.execute('DELETE FROM devices WHERE phone = ? AND sid = ?', (phone, sid))
+            return conn.execute('SELECT COUNT(*) FROM devices WHERE phone = ?', (phone,)).fetchone()[0]
+
+    def heartbeat(self):
+        now = time.time()
+        gone = []
+        with self._conn(write=True) as conn:
+            conn.execute('INSERT INTO workers (id, heartbeat) VALUES (?, ?) '
+                         'ON CONFLICT (id) DO UPDATE SET heartbeat = excluded.heartbeat', (self.worker_id, now))
+            conn.execute('DELETE FROM workers WHERE heartbeat < ?', (now - self.device_ttl,))
+            # Devices whose worker is no longer registered: it crashed or was restarted
+            dead = 'worker NOT IN (SELECT id FROM workers)'
+            phones = [phone for (phone,) in conn.execute(f'SELECT DISTINCT phone FROM devices WHERE {dead}')]
+            if not phones:
+                return gone
+            conn.execute(f'DELETE FROM devices WHERE {dead}')
+            last_seen = datetime.now().isoformat()
+            for phone in phones:
+                if conn.execute('SELECT 1 FROM devices WHERE phone = ?', (phone,)).fetchone():
+                    continue
+                user = self.set_online(phone, False, last_seen=last_seen)
+                if user:
+                    gone.append(user)
+        return gone
+
+    # --- Contacts --------------------------------------------------------
+    def get_contacts(self, phone):
+        with self._conn() as conn:
+            rows = conn.execute('SELECT contact_phone FROM contacts WHERE phone = ? ORDER BY added_at', (phone,))
+            return [contact for (contact,) in rows]
+
+    def is_contact(self, phone, contact_phone):
+        with self._conn() as conn:
+            row = conn.execute('SELECT 1 FROM contacts WHERE phone = ? AND contact_phone = ?',
+                               (phone, contact_phone)).fetchone()
+        return row is not None
+
+    def add_contact(self, phone, contact_phone):
+        with self._conn(write=True) as conn:
+            cur = conn.execute('INSERT OR IGNORE INTO contacts (phone, contact_phone, added_at) VALUES (?, ?, ?)',
+                               (phone, contact_phone, time.time()))
+            return cur.rowcount == 1
+
+    def remove_contact(self, phone, contact_phone):
+        with self._conn(write=True) as conn:
+            cur = conn.execute('DELETE FROM contacts WHERE phone = ? AND contact_phone = ?', (phone, contact_phone))
+            return cur.rowcount == 1
+
+    def get_watchers(self, phone):
+        with self._conn() as conn:
+            return {watcher for (watcher,) in conn.execute('SELECT phone FROM contacts WHERE contact_phone = ?', (phone,))}
+
+    # --- Chats -----------------------------------------------------------
+    def get_chat(self, chat_id):
+        with self._conn() as conn:
+            row = conn.execute('SELECT data FROM chats WHERE id = ?', (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def create_chat(self, chat):
+        with self._conn(write=True) as conn:
+            cur = conn.execute('INSERT OR IGNORE INTO chats (id, data) VALUES (?, ?)', (chat['id'], json.dumps(chat)))
+            return cur.rowcount == 1
+
+    def touch_chat(self, chat_id):
+        chat = self.get_chat(chat_id)
+        if not chat:
+            return
+        now = time.time()
+        with self._conn(write=True) as conn:
+            conn.executemany(
+                'INSERT INTO user_chats (phone, chat_id, activity) VALUES (?, ?, ?) '
+                'ON CONFLICT (phone, chat_id) DO UPDATE SET activity = excluded.activity',
+                [(phone, chat_id, now) for phone in chat['participants']]
+            )
+
+    def user_chats(self, phone, offset=0, limit=50):
+        with self._conn() as conn:
+            total = conn.execute('SELECT COUNT(*) FROM user_chats WHERE phone = ?', (phone,)).fetchone()[0]
+            rows = conn.execute(
+                'SELECT c.data FROM user_chats uc JOIN chats c ON c.id = uc.chat_id '
+                'WHERE uc.phone = ? ORDER BY uc.activity DESC LIMIT ? OFFSET ?',
+                (phone, limit, offset)
+            )
+            return [json.loads(data) for (data,) in rows], total
+
+    def get_chat_summary(self, chat_id):
+        with self._conn() as conn:
+            row = conn.execute('SELECT data FROM chat_summaries WHERE chat_id = ?', (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_chat_summary(self, chat_id, summary):
+        with self._conn(write=True) as conn:
+            conn.execute('INSERT OR REPLACE INTO chat_summaries (chat_id, data) VALUES (?, ?)',
+                         (chat_id, json.dumps(summary)))
+
+    # --- Delivery acknowledgements ----------------------------------------
+    def ack(self, phone, chat_id, seq):
+        with self._conn(write=True) as conn:
+            conn.execute(
+                'INSERT INTO acks (phone, chat_id, seq) VALUES (?, ?, ?) '
+                'ON CONFLICT (phone, chat_id) DO UPDATE SET seq = MAX(seq, excluded.seq)',
+                (phone, chat_id, seq)
+            )
+
+    def get_acks(self, phone, chat_ids):
+        chat_ids = list(chat_ids)
+        acks = {}
+        with self._conn() as conn:
+            for i in range(0, len(chat_ids), 500):
+                chunk = chat_ids[i:i + 500]
+                rows = conn.execute(
+                    f'SELECT chat_id, seq FROM acks WHERE phone = ? AND chat_id IN ({",".join("?" * len(chunk))})',
+                    [phone] + chunk
+                )
+                acks.update(rows)
+        return acks
+
+
+class _Transaction:
+    """BEGIN / COMMIT around an autocommit connection; nested uses join the outer transaction.
+
+    Writers take the lock up front (BEGIN IMMEDIATE) so read-modify-write
+    updates from two workers cannot deadlock on lock upgrade.
+    """
+
+    def __init__(self, conn, lock, write):
+        self.conn = conn
+        self.lock = lock
+        self.write = write
+        self.owner = False
+
+    def __enter__(self):
+        self.lock.acquire()
+        if not self.conn.in_transaction:
+            try:
+                self.conn.execute('BEGIN IMMEDIATE' if self.write else 'BEGIN')
+            except Exception:
+                self.lock.release()
+                raise
+            self.owner = True
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self.owner:
+                self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        finally:
+            self.lock.release()
+        return False
+
+
+def make_state_store(url, device_ttl=90):
+    """Builds the store named by a CHAT_STATE_URL value."""
+    if not url or url == 'memory://':
+        return MemoryStateStore()
+    if url.startswith('memory://'):
+        return JournaledMemoryStateStore(url[len('memory://'):])
+    if url.startswith('sqlite:///'):
+        return SqliteStateStore(url[len('sqlite:///'):], device_ttl=device_ttl)
+    raise ValueError(f'Unsupported CHAT_STATE_URL: {url}')
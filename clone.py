@@ -1,32 +1,282 @@
 # app.py
-from flask import Flask, request, jsonify
-from flask_socketio import SocketIO, emit, join_room, leave_room
+import os
+
+# Message-queue backends block on sockets in a background task, so the standard
+# library has to be green before anything else imports it
+if os.environ.get('CHAT_MESSAGE_QUEUE'):
+    import eventlet
+    eventlet.monkey_patch()
+
+from flask import Flask, Response, request, jsonify, send_from_directory
+from flask_socketio import emit, join_room, leave_room
 from flask_cors import CORS
 from datetime import datetime
 import uuid
 import re
-import os
+import time
+import atexit
+
+from message_log import MessageLog
+from chat_state import make_state_store, MemoryStateStore
+from chat_pubsub import make_client_manager, install_encode_once, enter_rooms
+from presence import PresenceCoalescer
+from chat_metrics import InstrumentedSocketIO, EventLog
+import chat_codec
+from message_search import MessageIndex
+from media_transcoder import TranscoderPool, TranscoderBusy, TranscodeError, UploadTooLarge
 
 # Create Flask app instance
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'isightu-secret-key-2024')
 CORS(app)
 
-# Configure SocketIO
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Configure SocketIO; CHAT_MESSAGE_QUEUE fans room broadcasts out to every worker
+# Handlers, emits and hub lag are measured and served on /metrics
+socketio = InstrumentedSocketIO(app, cors_allowed_origins="*",
+                                client_manager=make_client_manager(os.environ.get('CHAT_MESSAGE_QUEUE')))
+# Room emits serialize their payload once, not once per recipient
+install_encode_once(socketio.server)
+metrics = socketio.metrics
+metrics.collector(socketio.room_stats)
+if os.environ.get('CHAT_LAG_PROBE', '1') != '0':
+    socketio.start_lag_probe(float(os.environ.get('CHAT_LAG_PROBE_SECONDS', 0.5)))
+
+# Per-event logs are sampled and written off the hub; message content is never logged
+log = EventLog(
+    sample_rate=float(os.environ.get('CHAT_LOG_SAMPLE_RATE', 0.01)),
+    filename=os.environ.get('CHAT_LOG_FILE')
+)
+
+# Users, contacts, chats and presence: in memory with snapshots + journal under chat_data/state
+# by default, memory:// for throwaway state, sqlite:///... to share between workers
+# Shared stores drop the connections of a worker that has not heartbeated for CHAT_DEVICE_TTL seconds
+CHAT_DEVICE_TTL = float(os.environ.get('CHAT_DEVICE_TTL', 90))
+store = make_state_store(os.environ.get('CHAT_STATE_URL', 'memory://' + os.path.join('chat_data', 'state')),
+                         device_ttl=CHAT_DEVICE_TTL)
+SHARED_STATE = not isinstance(store, MemoryStateStore)
+if hasattr(store, 'run_snapshots'):
+    log.info('state_restored', **store.stats)
+    socketio.start_background_task(
+        store.run_snapshots,
+        socketio.sleep,
+        interval=float(os.environ.get('STATE_SNAPSHOT_SECONDS', 60)),
+        max_records=int(os.environ.get('STATE_SNAPSHOT_RECORDS', 50000))
+    )
+    atexit.register(store.close)
+    metrics.collector(lambda: [
+        ('state_restore_seconds', {}, store.stats['restore_seconds']),
+        ('state_journal_records', {}, store.journal_records),
+        ('state_snapshots_total', {}, store.stats['snapshots']),
+        ('state_snapshot_fork_ms', {}, store.stats['last_fork_ms'] or 0),
+        ('state_snapshot_seconds', {}, store.stats['last_snapshot_seconds'] or 0)
+    ])
+
+# Wire codec negotiated per connection (sid -> codec); see chat_codec.py
+if chat_codec.msgpack is None:
+    log.info('compact_codec_unavailable', reason='msgpack is not installed; every client gets JSON')
+client_codecs = {}
+# Phone each local connection announced with user_online (sid -> phone)
+sid_phones = {}
+COMPRESS_MIN_BYTES = int(os.environ.get('CHAT_COMPRESS_MIN_BYTES', 512))
+
+def codec_room(room):
+    """The room the current client should join: compact clients use the mirror room"""
+    if client_codecs.get(request.sid) == chat_codec.COMPACT:
+        return room + chat_codec.COMPACT_ROOM_SUFFIX
+    return room
+
+def deliver(event, payload, rooms, skip_sid=None):
+    """Sends an event to one room or a list of rooms, once per codec: JSON to the rooms,
+    binary frames to their compact mirrors. A connection in several of the rooms gets it once."""
+    socketio.emit(event, payload, to=rooms, skip_sid=skip_sid)
+    if chat_codec.msgpack is None:
+        return
+    if event in chat_codec.FIELD_KEYS:
+        compact = chat_codec.encode(event, payload, COMPRESS_MIN_BYTES)
+    else:
+        compact = payload
+    if isinstance(rooms, str):
+        mirrors = rooms + chat_codec.COMPACT_ROOM_SUFFIX
+    else:
+        mirrors = [room + chat_codec.COMPACT_ROOM_SUFFIX for room in rooms]
+    socketio.emit(event, compact, to=mirrors, skip_sid=skip_sid)
+
+def members_room(chat_id):
+    return chat_id + MEMBERS_ROOM_SUFFIX
+
+def is_large_group(chat):
+    return len(chat.get('participants') or ()) > LARGE_GROUP_SIZE
+
+def chat_rooms(chat_id, chat=None):
+    """Rooms a chat event goes to: the chat room (clients that opened it) plus every
+    participant's personal room, or the members room for large groups"""
+    if not chat:
+        return chat_id
+    if is_large_group(chat):
+        return [chat_id, members_room(chat_id)]
+    return [chat_id] + list(chat['participants'])
+
+def enter_members_room(chat):
+    """Adds the participants' connections on every worker to a large group's members room"""
+    enter_rooms(socketio.server, [
+        (participant + suffix, members_room(chat['id']) + suffix)
+        for participant in chat['participants']
+        for suffix in ('', chat_codec.COMPACT_ROOM_SUFFIX)
+    ])
+
+def device_gone(sid):
+    """Drops a connection; the user goes offline once their last device has gone"""
+    phone = sid_phones.pop(sid, None)
+    if not phone or store.remove_device(phone, sid):
+        return
+    user = store.set_online(phone, False, last_seen=datetime.now().isoformat())
+    if user:
+        log.event('user_offline', phone=phone)
+        presence.update(phone, {
+            'phone': phone,
+            'is_online': False,
+            'name': user['name'],
+            'last_seen': user['last_seen']
+        })
+
+def publish_presence(phone, payload):
+    """Sends a presence change only to the personal rooms of users who have phone as a contact"""
+    watchers = list(store.get_watchers(phone))
+    if watchers:
+        deliver('user_status_changed', payload, watchers)
+
+def presence_failed(phone, error):
+    metrics.inc('chat_errors_total', event='presence')
+    log.error('presence_publish_failed', phone=phone, error=str(error))
+
+# Presence flaps within the window collapse into one update (or none)
+presence = PresenceCoalescer(
+    publish_presence,
+    socketio.start_background_task,
+    socketio.sleep,
+    window=float(os.environ.get('PRESENCE_COALESCE_SECONDS', 2.0)),
+    on_error=presence_failed
+)
+
+def heartbeat_devices():
+    """Keeps this worker's connections registered and takes users of crashed workers offline"""
+    while True:
+        try:
+            for user in store.heartbeat():
+                log.event('user_offline', phone=user['phone'], reason='worker_gone')
+                presence.update(user['phone'], {
+                    'phone': user['phone'],
+                    'is_online': False,
+                    'name': user['name'],
+                    'last_seen': user['last_seen']
+                })
+        except Exception as e:
+            log.error('device_heartbeat_failed', error=str(e))
+        socketio.sleep(CHAT_DEVICE_TTL / 3)
+
+if SHARED_STATE:
+    socketio.start_background_task(heartbeat_devices)
+
+CHAT_PAGE_SIZE = 50
+CHAT_PAGE_MAX = 200
+SUMMARY_PREVIEW_CHARS = 120
+SYNC_MESSAGES_PER_CHAT = 100
+SYNC_MAX_CHATS = 500
+SEARCH_LIMIT_MAX = 50
+# Groups above this size fan out through one members room instead of per-member personal rooms
+LARGE_GROUP_SIZE = int(os.environ.get('CHAT_LARGE_GROUP_SIZE', 50))
+MEMBERS_ROOM_SUFFIX = '#members'
+MATCH_MAX_PHONES = 5000
+MESSAGE_SEARCH_PAGE_SIZE = 20
+MESSAGE_SEARCH_PAGE_MAX = 100
+MESSAGE_SEARCH_MAX_CHATS = 5000
+
+# Durable message storage: per-chat append-only segments, only a hot tail stays in RAM
+MESSAGE_LOG_DIR = os.environ.get('MESSAGE_LOG_DIR', os.path.join('chat_data', 'messages'))
+MESSAGE_PAGE_SIZE = 50
+MESSAGE_PAGE_MAX = 200
+message_log = MessageLog(
+    MESSAGE_LOG_DIR,
+    segment_max_messages=int(os.environ.get('MESSAGE_SEGMENT_SIZE', 4096)),
+    hot_tail=int(os.environ.get('MESSAGE_HOT_TAIL', MESSAGE_PAGE_SIZE)),
+    max_open_chats=int(os.environ.get('MESSAGE_OPEN_CHATS', 4096)),
+    shared=SHARED_STATE
+)
+
+# Voice notes: uploads are piped through a bounded pool of ffmpeg processes into MEDIA_DIR
+MEDIA_DIR = os.path.abspath(os.environ.get('MEDIA_DIR', os.path.join('chat_data', 'media')))
+os.makedirs(MEDIA_DIR, exist_ok=True)
+VOICE_CHUNK_BYTES = 64 * 1024
 
-# In-memory storage
-users = {}
-chats = {}
-messages = {}
-online_users = set()
-contacts = {}
+def offload(fn, *args):
+    """Runs a blocking call in eventlet's OS thread pool when the hub runs over an unpatched
+    stdlib (no CHAT_MESSAGE_QUEUE); once patched, pipes and threads are green already"""
+    if socketio.async_mode == 'eventlet':
+        from eventlet import patcher, tpool
+        if not patcher.is_monkey_patched('thread'):
+            return tpool.execute(fn, *args)
+    return fn(*args)
+
+voice_pool = TranscoderPool(
+    socketio.sleep,
+    workers=int(os.environ.get('VOICE_TRANSCODE_WORKERS', 2)),
+    max_queue=int(os.environ.get('VOICE_TRANSCODE_QUEUE', 8)),
+    ffmpeg=os.environ.get('FFMPEG_PATH', 'ffmpeg'),
+    max_seconds=int(os.environ.get('VOICE_MAX_SECONDS', 300)),
+    max_bytes=int(os.environ.get('VOICE_MAX_UPLOAD_MB', 10)) * 1024 * 1024,
+    offload=offload
+)
+metrics.collector(voice_pool.metrics)
+
+# Full-text search: inverted index snapshot on disk, topped up from the message log at startup
+MESSAGE_INDEX_PATH = os.environ.get('MESSAGE_INDEX_PATH', os.path.join('chat_data', 'message_index.bin'))
+MESSAGE_INDEX_SAVE_SECONDS = float(os.environ.get('MESSAGE_INDEX_SAVE_SECONDS', 60))
+message_index = MessageIndex(MESSAGE_INDEX_PATH)
+
+def load_message_index():
+    started = time.perf_counter()
+    loaded = message_index.load()
+    indexed = message_index.catch_up(message_log)
+    log.info('message_index_ready', snapshot=loaded, docs=len(message_index), caught_up=indexed,
+             seconds=round(time.perf_counter() - started, 3))
+    if indexed:
+        message_index.save()
+
+def save_message_index_periodically():
+    while True:
+        socketio.sleep(MESSAGE_INDEX_SAVE_SECONDS)
+        try:
+            # Only the worker owning the snapshot writes it; it yields between chats
+            message_index.save(pause=lambda: socketio.sleep(0))
+        except Exception as e:
+            log.error('message_index_save_failed', error=str(e))
+
+load_message_index()
+socketio.start_background_task(save_message_index_periodically)
+atexit.register(message_index.save)
 
 def validate_phone_number(phone):
     """Validate phone number format"""
     pattern = r'^\+?1?\d{9,15}$'
     return re.match(pattern, phone) is not None
 
+def summarize_message(message):
+    """Compact copy of a message for chat list previews"""
+    content = message.get('content') or ''
+    if not content and message.get('type') == 'voice':
+        content = 'Voice message'
+    if len(content) > SUMMARY_PREVIEW_CHARS:
+        content = content[:SUMMARY_PREVIEW_CHARS] + '…'
+    return {
+        'id': message['id'],
+        'sender_phone': message['sender_phone'],
+        'sender_name': message['sender_name'],
+        'content': content,
+        'timestamp': message['timestamp'],
+        'type': message['type'],
+        'seq': message.get('seq')
+    }
+
 @app.route('/')
 def home():
     return jsonify({
@@ -49,11 +299,8 @@ def register_user():
         if not validate_phone_number(phone):
             return jsonify({"error": "Invalid phone number format"}), 400
         
-        if phone in users:
-            return jsonify({"error": "User already exists"}), 400
-        
         user_id = f"user_{uuid.uuid4().hex[:8]}"
-        users[phone] = {
+        user = {
             "id": user_id,
             "phone": phone,
             "name": name,
@@ -64,11 +311,12 @@ def register_user():
             "profile_status": "Available"
         }
         
-        contacts[phone] = []
+        if not store.add_user(user):
+            return jsonify({"error": "User already exists"}), 400
         
         return jsonify({
             "success": True,
-            "user": users[phone],
+            "user": user,
             "message": "Registration successful"
         })
         
@@ -84,14 +332,10 @@ def login_user():
         if not phone:
             return jsonify({"error": "Phone number is required"}), 400
         
-        user = users.get(phone)
+        user = store.set_online(phone, True, last_seen=datetime.now().isoformat())
         if not user:
             return jsonify({"error": "User not found. Please register first."}), 404
         
-        user['last_seen'] = datetime.now().isoformat()
-        user['is_online'] = True
-        online_users.add(phone)
-        
         return jsonify({
             "success": True,
             "user": user,
@@ -103,7 +347,22 @@ def login_user():
 
 @app.route('/api/users', methods=['GET'])
 def get_users():
-    return jsonify(list(users.values()))
+    return jsonify(store.list_users())
+
+@app.route('/api/users/search', methods=['GET'])
+def search_users():
+    """Type-ahead search over phone-number and name prefixes"""
+    query = request.args.get('q', '')
+    current_user = request.args.get('current_user')
+    limit = max(1, min(request.args.get('limit', 20, type=int), SEARCH_LIMIT_MAX))
+    
+    results = []
+    for user in store.search_users(query, limit=limit):
+        if user['phone'] == current_user:
+            continue
+        results.append(dict(user, is_contact=bool(current_user) and store.is_contact(current_user, user['phone'])))
+    
+    return jsonify(results)
 
 @app.route('/api/users/search/<phone>', methods=['GET'])
 def search_user(phone):
@@ -112,11 +371,11 @@ def search_user(phone):
     if not validate_phone_number(phone):
         return jsonify({"error": "Invalid phone number format"}), 400
     
-    user = users.get(phone)
+    user = store.get_user(phone)
     if not user:
         return jsonify({"found": False, "message": "User not found on iSightU"})
     
-    is_contact = phone in contacts.get(current_user, [])
+    is_contact = store.is_contact(current_user, phone)
     
     return jsonify({
         "found": True,
@@ -127,8 +386,7 @@ def search_user(phone):
 
 @app.route('/api/users/online', methods=['GET'])
 def get_online_users():
-    online_list = [users[phone] for phone in online_users if phone in users]
-    return jsonify(online_list)
+    return jsonify(store.online_users())
 
 @app.route('/api/contacts', methods=['GET'])
 def get_contacts():
@@ -136,14 +394,27 @@ def get_contacts():
     if not user_phone:
         return jsonify([])
     
-    user_contacts = []
-    for contact_phone in contacts.get(user_phone, []):
-        contact_user = users.get(contact_phone)
-        if contact_user:
-            user_contacts.append(contact_user)
+    contact_phones = store.get_contacts(user_phone)
+    found = store.get_users(contact_phones)
+    user_contacts = [found[phone] for phone in contact_phones if phone in found]
     
     return jsonify(user_contacts)
 
+def presence_snapshot(user_phone):
+    """Online state of every contact of user_phone, in one batched lookup"""
+    found = store.get_users(store.get_contacts(user_phone))
+    return {
+        phone: {'is_online': user['is_online'], 'last_seen': user['last_seen']}
+        for phone, user in found.items()
+    }
+
+@app.route('/api/presence', methods=['GET'])
+def get_presence():
+    user_phone = request.args.get('user_phone')
+    if not user_phone:
+        return jsonify({})
+    return jsonify(presence_snapshot(user_phone))
+
 @app.route('/api/contacts/add', methods=['POST'])
 def add_contact():
     try:
@@ -154,21 +425,49 @@ def add_contact():
         if not user_phone or not contact_phone:
             return jsonify({"error": "User phone and contact phone are required"}), 400
         
-        if contact_phone not in users:
+        contact_user = store.get_user(contact_phone)
+        if not contact_user:
             return jsonify({"error": "Contact user not found"}), 404
         
-        if user_phone not in contacts:
-            contacts[user_phone] = []
-        
-        if contact_phone in contacts[user_phone]:
+        if not store.add_contact(user_phone, contact_phone):
             return jsonify({"error": "Contact already added"}), 400
         
-        contacts[user_phone].append(contact_phone)
-        
         return jsonify({
             "success": True,
             "message": "Contact added successfully",
-            "contact": users[contact_phone]
+            "contact": contact_user
+        })
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/contacts/match', methods=['POST'])
+def match_contacts():
+    """Bulk address-book matching: returns which of the given numbers are on iSightU"""
+    try:
+        data = request.get_json() or {}
+        user_phone = data.get('user_phone')
+        phones = data.get('phones') or []
+        
+        if not isinstance(phones, list):
+            return jsonify({"error": "phones must be a list"}), 400
+        
+        if len(phones) > MATCH_MAX_PHONES:
+            return jsonify({"error": f"At most {MATCH_MAX_PHONES} phone numbers per request"}), 400
+        
+        matches = store.match_phones(str(p) for p in phones)
+        added = 0
+        if user_phone and data.get('add'):
+            for user in {u['phone']: u for u in matches.values()}.values():
+                if user['phone'] != user_phone and store.add_contact(user_phone, user['phone']):
+                    added += 1
+        
+        return jsonify({
+            "success": True,
+            "checked": len(phones),
+            "matched": len(matches),
+            "added": added,
+            "matches": [{"input": number, "user": user} for number, user in matches.items()]
         })
         
     except Exception as e:
@@ -181,8 +480,7 @@ def remove_contact():
         user_phone = data.get('user_phone')
         contact_phone = data.get('contact_phone')
         
-        if user_phone in contacts and contact_phone in contacts[user_phone]:
-            contacts[user_phone].remove(contact_phone)
+        if store.remove_contact(user_phone, contact_phone):
             return jsonify({"success": True, "message": "Contact removed successfully"})
         else:
             return jsonify({"error": "Contact not found"}), 404
@@ -196,81 +494,274 @@ def get_chats():
     if not user_phone:
         return jsonify([])
     
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = request.args.get('limit', CHAT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, CHAT_PAGE_MAX))
+    
+    # Most recently active first; cost depends on the page, not on the total number of chats
+    page, total = store.user_chats(user_phone, offset=offset, limit=limit)
+    acks = store.get_acks(user_phone, [chat_data['id'] for chat_data in page])
     user_chats = []
-    for chat_id, chat_data in chats.items():
-        if user_phone in chat_data['participants']:
-            chat_messages = messages.get(chat_id, [])
-            last_message = chat_messages[-1] if chat_messages else None
-            
-            other_participants = [p for p in chat_data['participants'] if p != user_phone]
-            other_user = users.get(other_participants[0]) if other_participants and len(other_participants) == 1 else None
-            
-            user_chats.append({
-                'id': chat_id,
-                'name': chat_data['name'],
-                'participants': chat_data['participants'],
-                'last_message': last_message,
-                'is_group': chat_data.get('is_group', False),
-                'other_user': other_user
-            })
+    for chat_data in page:
+        chat_id = chat_data['id']
+        summary = store.get_chat_summary(chat_id)
+        latest_seq = (summary or {}).get('seq') or 0
+        other_participants = [p for p in chat_data['participants'] if p != user_phone]
+        other_user = store.get_user(other_participants[0]) if other_participants and len(other_participants) == 1 else None
+        
+        user_chats.append({
+            'id': chat_id,
+            'name': chat_data['name'],
+            'participants': chat_data['participants'],
+            'last_message': summary,
+            'is_group': chat_data.get('is_group', False),
+            'other_user': other_user,
+            'unread': max(0, latest_seq - acks.get(chat_id, 0))
+        })
     
-    return jsonify(user_chats)
+    response = jsonify(user_chats)
+    if offset + limit < total:
+        response.headers['X-Next-Offset'] = str(offset + limit)
+        response.headers['Access-Control-Expose-Headers'] = 'X-Next-Offset'
+    return response
 
 @app.route('/api/chats/<chat_id>/messages', methods=['GET'])
 def get_chat_messages(chat_id):
-    return jsonify(messages.get(chat_id, []))
+    """Newest page of messages (oldest first); pass X-Next-Before back as ?before= for older ones"""
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', MESSAGE_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MESSAGE_PAGE_MAX))
+    
+    try:
+        page, next_before = message_log.read(chat_id, before=before, limit=limit)
+    except ValueError:
+        return jsonify({"error": "Invalid chat id"}), 400
+    
+    response = jsonify(page)
+    if next_before is not None:
+        response.headers['X-Next-Before'] = str(next_before)
+        response.headers['Access-Control-Expose-Headers'] = 'X-Next-Before'
+    return response
+
+@app.route('/api/messages/search', methods=['GET'])
+def search_messages():
+    """Full-text search over the chats user_phone belongs to, newest first.
+    The last word matches as a prefix; page with offset/limit (X-Next-Offset).
+    X-Search-Truncated: true means the prefix matched too many words and only some were searched."""
+    user_phone = request.args.get('user_phone')
+    query = (request.args.get('q') or '').strip()
+    if not user_phone or not query:
+        return jsonify({"error": "user_phone and q are required"}), 400
+    
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = request.args.get('limit', MESSAGE_SEARCH_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MESSAGE_SEARCH_PAGE_MAX))
+    
+    chats, _ = store.user_chats(user_phone, 0, MESSAGE_SEARCH_MAX_CHATS)
+    chat_ids = [chat_data['id'] for chat_data in chats]
+    if request.args.get('chat_id'):
+        chat_ids = [chat_id for chat_id in chat_ids if chat_id == request.args.get('chat_id')]
+    if SHARED_STATE:
+        # Other workers append too; pick up whatever they wrote to these chats
+        message_index.catch_up(message_log, chat_ids)
+    
+    hits, total, truncated = message_index.search(query, chat_ids, offset=offset, limit=limit)
+    results = []
+    for chat_id, seq in hits:
+        page, _ = message_log.read_since(chat_id, seq - 1, 1)
+        if page:
+            results.append(page[0])
+    
+    response = jsonify(results)
+    response.headers['X-Total-Count'] = str(total)
+    exposed = ['X-Total-Count']
+    if offset + len(hits) < total:
+        response.headers['X-Next-Offset'] = str(offset + len(hits))
+        exposed.append('X-Next-Offset')
+    if truncated:
+        response.headers['X-Search-Truncated'] = 'true'
+        exposed.append('X-Search-Truncated')
+    response.headers['Access-Control-Expose-Headers'] = ', '.join(exposed)
+    return response
+
+@app.route('/api/chats/<chat_id>/voice', methods=['POST'])
+def upload_voice_message(chat_id):
+    """Voice note upload: the raw audio body (or multipart field "audio") is transcoded
+    to Opus and posted to the chat as a voice message. sender_phone comes as a query arg.
+    Raw bodies stream straight into ffmpeg; multipart files are spooled by werkzeug first."""
+    try:
+        user_phone = request.args.get('sender_phone') or request.form.get('sender_phone')
+        if not user_phone or not store.get_user(user_phone):
+            return jsonify({"error": "Valid sender_phone is required"}), 400
+        # Checked before ffmpeg spends anything on the upload
+        chat = store.get_chat(chat_id)
+        if not chat:
+            return jsonify({"error": "Chat not found"}), 404
+        if user_phone not in chat['participants']:
+            return jsonify({"error": "Sender is not in this chat"}), 403
+        
+        if request.mimetype == 'multipart/form-data':
+            if 'audio' not in request.files:
+                return jsonify({"error": "No audio file"}), 400
+            stream = request.files['audio'].stream
+        else:
+            stream = request.stream
+        
+        message_id = str(uuid.uuid4())
+        filename = f"{message_id}.ogg"
+        output = os.path.join(MEDIA_DIR, filename)
+        media = voice_pool.transcode(iter(lambda: stream.read(VOICE_CHUNK_BYTES), b''), output)
+        
+        try:
+            message = post_message(chat_id, user_phone, '', message_type='voice', message_id=message_id, media={
+                'url': f"/api/media/{filename}",
+                'mime': 'audio/ogg; codecs=opus',
+                'bytes': media['bytes'],
+                'duration': media['duration']
+            })
+        except Exception:
+            # No message points at the file, so nothing would ever serve or clean it up
+            try:
+                os.remove(output)
+            except OSError:
+                pass
+            raise
+        return jsonify({"success": True, "message": message})
+        
+    except TranscoderBusy:
+        response = jsonify({"error": "Voice transcoding is busy, try again shortly"})
+        response.headers['Retry-After'] = '2'
+        return response, 503
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except TranscodeError as e:
+        log.error('voice_transcode_failed', chat_id=chat_id, error=str(e))
+        return jsonify({"error": "Could not convert audio"}), 422
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/media/<path:filename>', methods=['GET'])
+def get_media(filename):
+    return send_from_directory(MEDIA_DIR, filename, mimetype='audio/ogg', max_age=86400)
+
+def build_sync_delta(user_phone, cursors, limit=SYNC_MESSAGES_PER_CHAT):
+    """Everything user_phone missed, across all of their chats, in one batch.
+    
+    cursors maps chat_id -> last seq the client has. Chats the client has never
+    seen come back with their metadata and their newest messages.
+    """
+    page, _ = store.user_chats(user_phone, offset=0, limit=SYNC_MAX_CHATS)
+    acks = store.get_acks(user_phone, [chat_data['id'] for chat_data in page])
+    delta = []
+    for chat_data in page:
+        chat_id = chat_data['id']
+        latest_seq = (store.get_chat_summary(chat_id) or {}).get('seq') or 0
+        known = chat_id in cursors
+        cursor = int(cursors[chat_id] or 0) if known else max(0, latest_seq - limit)
+        if known and cursor >= latest_seq:
+            continue
+        
+        missed, has_more = message_log.read_since(chat_id, cursor, limit=limit)
+        entry = {
+            'chat_id': chat_id,
+            'latest_seq': latest_seq,
+            'unread': max(0, latest_seq - acks.get(chat_id, 0)),
+            # chat_id is implied by the enclosing entry
+            'messages': [{k: v for k, v in m.items() if k != 'chat_id'} for m in missed],
+            'has_more': has_more
+        }
+        if not known:
+            entry['chat'] = chat_data
+        delta.append(entry)
+    
+    return {'chats': delta, 'server_time': datetime.now().isoformat()}
+
+@app.route('/api/sync', methods=['POST'])
+def sync_chats():
+    try:
+        data = request.get_json() or {}
+        user_phone = data.get('user_phone')
+        if not user_phone:
+            return jsonify({"error": "User phone is required"}), 400
+        
+        limit = max(1, min(int(data.get('limit', SYNC_MESSAGES_PER_CHAT)), MESSAGE_PAGE_MAX))
+        return jsonify(build_sync_delta(user_phone, data.get('cursors') or {}, limit))
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition of handler latency, fan-out, rooms and hub lag"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/codec', methods=['GET'])
+def get_codec():
+    """Compact wire format description for clients that negotiate it"""
+    return jsonify(chat_codec.describe())
 
 @socketio.on('connect')
-def handle_connect():
-    print('Client connected to iSightU')
-    emit('connected', {'data': 'Connected to iSightU successfully'})
+def handle_connect(auth=None):
+    requested = (auth or {}).get('codec') if isinstance(auth, dict) else None
+    codec = chat_codec.negotiate(requested or request.args.get('codec'))
+    client_codecs[request.sid] = codec
+    log.event('connect', sid=request.sid, codec=codec)
+    emit('connected', {'data': 'Connected to iSightU successfully', 'codec': codec})
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    print('Client disconnected from iSightU')
+    device_gone(request.sid)
+    client_codecs.pop(request.sid, None)
+    log.event('disconnect', sid=request.sid)
 
 @socketio.on('user_online')
 def handle_user_online(data):
     phone = data.get('phone')
-    if phone and phone in users:
-        users[phone]['is_online'] = True
-        online_users.add(phone)
-        print(f'User {phone} is now online')
-        emit('user_status_changed', {
-            'phone': phone,
-            'is_online': True,
-            'name': users[phone]['name']
-        }, broadcast=True)
+    user = store.set_online(phone, True) if phone else None
+    if user:
+        # Personal room: every device of the user receives per-user events addressed to the phone
+        join_room(codec_room(phone))
+        sid_phones[request.sid] = phone
+        devices = store.add_device(phone, request.sid)
+        chats, _ = store.user_chats(phone, 0, SYNC_MAX_CHATS)
+        for chat in chats:
+            if is_large_group(chat):
+                join_room(codec_room(members_room(chat['id'])))
+        log.event('user_online', phone=phone, devices=devices)
+        if devices == 1:
+            # Further devices do not change what watchers see
+            presence.update(phone, {
+                'phone': phone,
+                'is_online': True,
+                'name': user['name']
+            })
 
 @socketio.on('user_offline')
 def handle_user_offline(data):
-    phone = data.get('phone')
-    if phone and phone in users:
-        users[phone]['is_online'] = False
-        users[phone]['last_seen'] = datetime.now().isoformat()
-        if phone in online_users:
-            online_users.remove(phone)
-        print(f'User {phone} is now offline')
-        emit('user_status_changed', {
-            'phone': phone,
-            'is_online': False,
-            'name': users[phone]['name'],
-            'last_seen': users[phone]['last_seen']
-        }, broadcast=True)
+    # Only this device goes away; the user stays online while another device is connected
+    if data.get('phone') and sid_phones.get(request.sid) == data.get('phone'):
+        device_gone(request.sid)
+
+@socketio.on('presence_snapshot')
+def handle_presence_snapshot(data):
+    user_phone = data.get('user_phone')
+    snapshot = presence_snapshot(user_phone) if user_phone else {}
+    emit('presence_snapshot', snapshot)
+    return snapshot
 
 @socketio.on('join_chat')
 def handle_join_chat(data):
     chat_id = data.get('chat_id')
     user_phone = data.get('user_phone')
-    join_room(chat_id)
-    print(f'User {user_phone} joined chat {chat_id}')
+    join_room(codec_room(chat_id))
+    log.event('join_chat', chat_id=chat_id, user_phone=user_phone)
 
 @socketio.on('leave_chat')
 def handle_leave_chat(data):
     chat_id = data.get('chat_id')
     user_phone = data.get('user_phone')
-    leave_room(chat_id)
-    print(f'User {user_phone} left chat {chat_id}')
+    leave_room(codec_room(chat_id))
+    log.event('leave_chat', chat_id=chat_id, user_phone=user_phone)
 
 @socketio.on('create_chat')
 def handle_create_chat(data):
@@ -283,27 +774,57 @@ def handle_create_chat(data):
         else:
             chat_id = str(uuid.uuid4())
         
-        if chat_id not in chats:
-            chats[chat_id] = {
-                'id': chat_id,
-                'name': chat_name,
-                'participants': participants,
-                'created_at': datetime.now().isoformat(),
-                'is_group': len(participants) > 2
-            }
-            
-            if chat_id not in messages:
-                messages[chat_id] = []
+        chat = {
+            'id': chat_id,
+            'name': chat_name,
+            'participants': participants,
+            'created_at': datetime.now().isoformat(),
+            'is_group': len(participants) > 2
+        }
+        if store.create_chat(chat):
+            store.touch_chat(chat_id)
+        else:
+            chat = store.get_chat(chat_id)
         
-        emit('chat_created', chats[chat_id])
+        emit('chat_created', chat)
         
-        for participant in participants:
-            emit('chat_created', chats[chat_id], room=participant)
+        # One emit reaches every device of every participant (except this one)
+        if is_large_group(chat):
+            enter_members_room(chat)
+        deliver('chat_created', chat, list(chat['participants']), skip_sid=request.sid)
                 
     except Exception as e:
-        print(f"Error creating chat: {e}")
+        metrics.inc('chat_errors_total', event='create_chat')
+        log.error('create_chat_failed', error=str(e))
         emit('error', {'message': 'Failed to create chat'})
 
+def post_message(chat_id, user_phone, content, message_type='text', media=None, message_id=None):
+    """Stores a message, updates the chat list and delivers it; shared by text and media messages"""
+    message = {
+        'id': message_id or str(uuid.uuid4()),
+        'chat_id': chat_id,
+        'sender_phone': user_phone,
+        'sender_name': (store.get_user(user_phone) or {}).get('name', 'Unknown'),
+        'content': content,
+        'timestamp': datetime.now().isoformat(),
+        'type': message_type
+    }
+    if media:
+        message['media'] = media
+    
+    message_log.append(chat_id, message)
+    if not message_index.add(message):
+        message_index.catch_up(message_log, [chat_id])
+    store.set_chat_summary(chat_id, summarize_message(message))
+    store.touch_chat(chat_id)
+    
+    deliver('new_message', message, chat_rooms(chat_id, store.get_chat(chat_id)))
+    
+    metrics.inc('chat_messages_total', type=message_type)
+    log.event('message_sent', chat_id=chat_id, sender_phone=user_phone, type=message_type,
+              seq=message.get('seq'), chars=len(content))
+    return message
+
 @socketio.on('send_message')
 def handle_send_message(data):
     try:
@@ -314,49 +835,83 @@ def handle_send_message(data):
         if not chat_id or not user_phone or not content:
             return
         
-        message_id = str(uuid.uuid4())
-        message = {
-            'id': message_id,
-            'chat_id': chat_id,
-            'sender_phone': user_phone,
-            'sender_name': users.get(user_phone, {}).get('name', 'Unknown'),
-            'content': content,
-            'timestamp': datetime.now().isoformat(),
-            'type': 'text'
-        }
+        post_message(chat_id, user_phone, content)
         
-        if chat_id not in messages:
-            messages[chat_id] = []
-        
-        messages[chat_id].append(message)
+    except Exception as e:
+        metrics.inc('chat_errors_total', event='send_message')
+        log.error('send_message_failed', chat_id=data.get('chat_id'), error=str(e))
+
+@socketio.on('sync')
+def handle_sync(data):
+    """Reconnect catch-up: {user_phone, cursors: {chat_id: last_seq}} -> sync_delta"""
+    try:
+        user_phone = data.get('user_phone')
+        if not user_phone:
+            return
         
-        emit('new_message', message, room=chat_id)
+        limit = max(1, min(int(data.get('limit', SYNC_MESSAGES_PER_CHAT)), MESSAGE_PAGE_MAX))
+        delta = build_sync_delta(user_phone, data.get('cursors') or {}, limit)
+        emit('sync_delta', delta)
+        return delta
         
-        print(f'Message sent in chat {chat_id} by {user_phone}: {content}')
+    except Exception as e:
+        metrics.inc('chat_errors_total', event='sync')
+        log.error('sync_failed', error=str(e))
+        emit('error', {'message': 'Failed to sync chats'})
+
+def parse_seq(value):
+    """A client-sent sequence number as a non-negative int, or None if it is not one"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    return value if isinstance(value, int) and value >= 0 else None
+
+@socketio.on('ack')
+def handle_ack(data):
+    """Delivery acknowledgement: {user_phone, chat_id, seq} or {user_phone, acks: {chat_id: seq}}"""
+    try:
+        user_phone = data.get('user_phone')
+        if not user_phone:
+            return
         
+        acks = data.get('acks')
+        # Copied so the client's payload is never modified
+        acks = dict(acks) if isinstance(acks, dict) else {}
+        if data.get('chat_id') is not None:
+            acks[data['chat_id']] = data.get('seq')
+        for chat_id, seq in list(acks.items())[:SYNC_MAX_CHATS]:
+            seq = parse_seq(seq)
+            if seq is None or not isinstance(chat_id, str):
+                continue
+            chat = store.get_chat(chat_id)
+            if chat and user_phone in chat['participants']:
+                store.ack(user_phone, chat_id, seq)
+                
     except Exception as e:
-        print(f"Error sending message: {e}")
+        metrics.inc('chat_errors_total', event='ack')
+        log.error('ack_failed', error=str(e))
 
 @socketio.on('typing_start')
 def handle_typing_start(data):
     chat_id = data.get('chat_id')
     user_phone = data.get('user_phone')
-    emit('user_typing', {
+    deliver('user_typing', {
         'chat_id': chat_id,
         'user_phone': user_phone,
-        'user_name': users.get(user_phone, {}).get('name', 'Unknown'),
+        'user_name': (store.get_user(user_phone) or {}).get('name', 'Unknown'),
         'is_typing': True
-    }, room=chat_id)
+    }, chat_id)
 
 @socketio.on('typing_stop')
 def handle_typing_stop(data):
     chat_id = data.get('chat_id')
     user_phone = data.get('user_phone')
-    emit('user_typing', {
+    deliver('user_typing', {
         'chat_id': chat_id,
         'user_phone': user_phone,
         'is_typing': False
-    }, room=chat_id)
+    }, chat_id)
 
 # Create demo users
 def create_demo_users():
@@ -370,9 +925,9 @@ def create_demo_users():
     ]
     
     for user_data in demo_users:
-        if user_data['phone'] not in users:
+        if not store.get_user(user_data['phone']):
             user_id = f"user_{uuid.uuid4().hex[:8]}"
-            users[user_data['phone']] = {
+            store.add_user({
                 "id": user_id,
                 "phone": user_data['phone'],
                 "name": user_data['name'],
@@ -381,18 +936,20 @@ def create_demo_users():
                 "is_online": True,
                 "created_at": datetime.now().isoformat(),
                 "profile_status": user_data['status']
-            }
-            contacts[user_data['phone']] = []
-            online_users.add(user_data['phone'])
+            })
+            store.set_online(user_data['phone'], True)
 
 create_demo_users()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     print(f"🚀 iSightU Chat Server starting on port {port}")
+    if hasattr(store, 'stats'):
+        print(f"💾 State restored in {store.stats['restore_seconds']}s "
+              f"({store.stats['replayed']} journal records replayed)")
     print("📞 Demo users created:")
-    for phone, user in users.items():
-        print(f"   - {user['name']}: {phone} ({user['status']})")
+    for user in store.list_users():
+        print(f"   - {user['name']}: {user['phone']} ({user['status']})")
     print("💬 Ready for real-time messaging with contact management!")
     
     socketio.run(app, host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,68 @@
+"""Cooperative (eventlet) serving mode for the CreatorsAI API.
+
+With CREATORSAI_ASYNC=true, app.py monkey-patches the standard library
+before importing anything else, and gunicorn.conf.py picks eventlet
+workers. After that, every upstream call is cooperative: requests (Gemini
+images, OAuth metadata), the google.genai client (httpx), smtplib
+(Flask-Mail) and the SQLAlchemy connection pool locks all go through
+patched sockets and locks. A worker then waits on hundreds of slow Gemini
+calls at once instead of one.
+
+What patching cannot make cooperative, offload() runs in eventlet's
+OS-thread pool:
+- CPU-heavy calls: PIL resizing and bcrypt hashing.
+- C database drivers. Postgres is made green through psycogreen when it
+  is installed. SQLite queries are short local calls and run inline.
+
+Without the flag, offload() is a plain call, and sync workers behave
+exactly as before.
+"""
+import os
+
+ASYNC_MODE = os.environ.get("CREATORSAI_ASYNC", "false").lower() in ("1", "true", "eventlet")
+
+# Imported before patching: httpcore (under google.genai) pulls in trio when it is installed, and trio
+# needs select.epoll at import time, which eventlet removes. Their sockets and locks are looked up at
+# call time, so they still end up green.
+IMPORT_BEFORE_PATCHING = ("httpcore",)
+
+
+def prepare():
+    """Imports the modules that break when first imported under eventlet (gunicorn.conf.py calls this in the master)."""
+    for name in IMPORT_BEFORE_PATCHING:
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+
+
+def monkey_patch():
+    """Patches the stdlib for eventlet when CREATORSAI_ASYNC is set; must run before other imports."""
+    if not ASYNC_MODE:
+        return False
+    prepare()
+    import eventlet
+    eventlet.monkey_patch()
+    try:
+        from psycogreen.eventlet import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        pass
+    return True
+
+
+def cooperative():
+    """True once sockets are patched, whether by monkey_patch() or by a gunicorn eventlet worker."""
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return False
+    return patcher.is_monkey_patched("socket")
+
+
+def offload(fn, *args, **kwargs):
+    """Runs fn in a real OS thread when serving cooperatively so it cannot stall other requests."""
+    if cooperative():
+        from eventlet import tpool
+        return tpool.execute(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
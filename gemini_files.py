@@ -0,0 +1,83 @@
+import hashlib
+from datetime import datetime, timedelta
+
+import requests
+
+# ------------------------
+# Gemini Files API
+# ------------------------
+# Uploaded files live for 48 hours in the project of the key that uploaded them, so a handle
+# is only usable with that same key: callers keep one handle per (file, key_fingerprint()).
+DEFAULT_TTL = timedelta(hours=48)
+
+
+class FileUploadError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def key_fingerprint(secret):
+    """Stable, non-reversible id for an API key, safe to store next to its handles."""
+    return hashlib.sha256(secret.encode("utf-8")).hexdigest()[:16]
+
+
+def parse_expiry(value):
+    """RFC 3339 "2024-05-01T12:00:00.123456789Z" -> naive UTC datetime (fractions beyond microseconds dropped)."""
+    if not value:
+        return None
+    value = value.rstrip("Z")
+    if "." in value:
+        whole, fraction = value.split(".", 1)
+        value = f"{whole}.{fraction[:6]}"
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+class FilesClient:
+    """Minimal client for the resumable upload flow of the Gemini Files API (start, then upload+finalize)."""
+
+    def __init__(self, base_url, timeout=(10, 60)):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def upload(self, api_key, data, mime_type, display_name):
+        """Uploads bytes; returns {"name", "uri", "mime_type", "expires_at"} (expires_at naive UTC)."""
+        start = requests.post(
+            f"{self.base_url}/upload/v1beta/files",
+            headers={
+                "x-goog-api-key": api_key,
+                "X-Goog-Upload-Protocol": "resumable",
+                "X-Goog-Upload-Command": "start",
+                "X-Goog-Upload-Header-Content-Length": str(len(data)),
+                "X-Goog-Upload-Header-Content-Type": mime_type,
+                "Content-Type": "application/json",
+            },
+            json={"file": {"display_name": display_name[:200]}},
+            timeout=self.timeout,
+        )
+        upload_url = start.headers.get("X-Goog-Upload-URL")
+        if start.status_code != 200 or not upload_url:
+            raise FileUploadError(f"upload start returned {start.status_code}: {start.text[:200]}", start.status_code)
+        finish = requests.post(
+            upload_url,
+            headers={
+                "x-goog-api-key": api_key,
+                "Content-Length": str(len(data)),
+                "X-Goog-Upload-Offset": "0",
+                "X-Goog-Upload-Command": "upload, finalize",
+            },
+            data=data,
+            timeout=self.timeout,
+        )
+        if finish.status_code != 200:
+            raise FileUploadError(f"upload returned {finish.status_code}: {finish.text[:200]}", finish.status_code)
+        try:
+            uploaded = finish.json()["file"]
+            handle = {"name": uploaded["name"], "uri": uploaded["uri"], "mime_type": uploaded.get("mimeType") or mime_type}
+        except (ValueError, KeyError, TypeError):
+            raise FileUploadError(f"unexpected upload response: {finish.text[:200]}")
+        handle["expires_at"] = parse_expiry(uploaded.get("expirationTime")) or datetime.utcnow() + DEFAULT_TTL
+        return handle
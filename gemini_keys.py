@@ -0,0 +1,238 @@
+import os
+import re
+import time
+import threading
+from collections import deque
+
+# ------------------------
+# Key Pool Configuration
+# ------------------------
+RATE_WINDOW = 60  # seconds of history behind the per-minute request/token figures
+NUMBERED_KEY = re.compile(r"^GEMINI_(\d+)$")
+
+
+class NoKeyAvailable(RuntimeError):
+    """No key is configured, or every key is ejected after a 429; retry_after says when one returns."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def status_of(error):
+    """HTTP status carried by a google.genai APIError or a requests HTTPError, if any."""
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code
+    response = getattr(error, "response", None)
+    code = getattr(response, "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+def retryable(status):
+    """429 (this key is rate-limited) and 5xx (upstream trouble) are worth another key; other errors are not."""
+    return status == 429 or (status is not None and status >= 500)
+
+
+def retry_after_of(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def tokens_from(response):
+    """Total tokens billed for a google.genai response or a REST generateContent JSON body."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        return getattr(usage, "total_token_count", None) or 0
+    if isinstance(response, dict):
+        return (response.get("usageMetadata") or {}).get("totalTokenCount") or 0
+    return 0
+
+
+def parse_key(raw):
+    """ "AIza...:2" -> ("AIza...", 2.0); the weight is optional and defaults to 1."""
+    secret, _, weight = raw.strip().partition(":")
+    try:
+        return secret, max(float(weight), 0.01) if weight else 1.0
+    except ValueError:
+        print(f"[WARN] Ignoring invalid Gemini key weight: {weight!r}")
+        return secret, 1.0
+
+
+class ApiKey:
+    def __init__(self, name, secret, weight=1.0):
+        self.name = name
+        self.secret = secret
+        self.weight = weight
+        self.in_flight = 0
+        self.requests = 0
+        self.tokens = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.ejected_until = 0.0
+        self.recent_requests = deque()
+        self.recent_tokens = deque()
+
+    def _trim(self, now):
+        for recent in (self.recent_requests, self.recent_tokens):
+            while recent and recent[0][0] < now - RATE_WINDOW:
+                recent.popleft()
+
+    def load(self, now):
+        """Weighted (in-flight, requests in the last minute); lower is less loaded."""
+        self._trim(now)
+        return (self.in_flight / self.weight, len(self.recent_requests) / self.weight)
+
+    def health(self, now):
+        self._trim(now)
+        return {
+            "name": self.name,
+            "key": "..." + self.secret[-4:],
+            "weight": self.weight,
+            "healthy": self.ejected_until <= now,
+            "ejected_for_seconds": round(max(0.0, self.ejected_until - now), 1),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "requests_last_minute": len(self.recent_requests),
+            "tokens": self.tokens,
+            "tokens_last_minute": sum(count for _, count in self.recent_tokens),
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+        }
+
+
+class Lease:
+    """One request's hold on a key; on exit the pool books its tokens and any 429."""
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.tokens = 0
+        self.status = None
+        self.retry_after = None
+
+    @property
+    def secret(self):
+        return self.key.secret
+
+    def record(self, tokens=0, status=None, retry_after=None):
+        """For callers that see the HTTP status instead of an exception (requests.post)."""
+        self.tokens += tokens or 0
+        self.status = status
+        try:
+            self.retry_after = float(retry_after) if retry_after is not None else None
+        except ValueError:
+            self.retry_after = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        status = self.status
+        retry_after = self.retry_after
+        if exc is not None:
+            status = status_of(exc) or status or 0
+            retry_after = retry_after_of(exc) or retry_after
+        self.pool.release(self.key, self.tokens, status, retry_after)
+        return False
+
+
+class KeyPool:
+    """Gemini API keys with per-key accounting, least-loaded weighted selection and 429 ejection.
+
+    Keys come from GEMINI, GEMINI_KEYS (comma separated) and GEMINI_1..GEMINI_N; any of them can
+    carry a ":weight" suffix. A key answering 429 sits out for its Retry-After (or `cooldown`
+    seconds) while the others take its traffic.
+    """
+
+    def __init__(self, keys, cooldown=60):
+        self.keys = keys
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, environ=None, cooldown=None):
+        environ = os.environ if environ is None else environ
+        raw = []
+        if environ.get("GEMINI"):
+            raw.append(("GEMINI", environ["GEMINI"]))
+        for index, item in enumerate(filter(None, (environ.get("GEMINI_KEYS") or "").split(","))):
+            raw.append((f"GEMINI_KEYS[{index}]", item))
+        numbered = sorted((int(match.group(1)), name) for name in environ for match in [NUMBERED_KEY.match(name)] if match)
+        raw.extend((name, environ[name]) for _, name in numbered if environ[name])
+        keys, seen = [], set()
+        for name, item in raw:
+            secret, weight = parse_key(item)
+            if secret and secret not in seen:
+                seen.add(secret)
+                keys.append(ApiKey(name, secret, weight))
+        if cooldown is None:
+            cooldown = float(environ.get("GEMINI_KEY_COOLDOWN_SECONDS", 60))
+        return cls(keys, cooldown)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def acquire(self):
+        now = time.time()
+        with self._lock:
+            ready = [key for key in self.keys if key.ejected_until <= now]
+            if not ready:
+                if not self.keys:
+                    raise NoKeyAvailable("No Gemini API key is configured")
+                retry_after = min(key.ejected_until for key in self.keys) - now
+                raise NoKeyAvailable("Every Gemini API key is rate-limited", retry_after=round(retry_after, 1))
+            key = min(ready, key=lambda candidate: candidate.load(now))
+            key.in_flight += 1
+            key.requests += 1
+            key.recent_requests.append((now, 1))
+            return key
+
+    def release(self, key, tokens=0, status=None, retry_after=None):
+        now = time.time()
+        with self._lock:
+            key.in_flight -= 1
+            if tokens:
+                key.tokens += tokens
+                key.recent_tokens.append((now, tokens))
+            if status == 429:
+                key.rate_limited += 1
+                key.ejected_until = now + (retry_after or self.cooldown)
+                print(f"[WARN] Gemini key {key.name} rate-limited; ejected for {retry_after or self.cooldown:.0f}s")
+            elif status is not None and status != 200:
+                key.errors += 1
+
+    def lease(self):
+        return Lease(self, self.acquire())
+
+    def call(self, fn, attempts=None):
+        """Runs fn(secret) on the least-loaded key, moving to the next key when one answers 429 or 5xx.
+
+        Only a 429 ejects the key; once no key is left to try, the last upstream error is raised."""
+        attempts = attempts or max(1, len(self.keys))
+        last_error = None
+        for attempt in range(attempts):
+            try:
+                lease = self.lease()
+            except NoKeyAvailable:
+                if last_error is None:
+                    raise
+                raise last_error
+            try:
+                with lease:
+                    result = fn(lease.secret)
+                    lease.record(tokens=tokens_from(result))
+                    return result
+            except Exception as e:
+                if not retryable(status_of(e)) or attempt == attempts - 1:
+                    raise
+                last_error = e
+
+    def health(self):
+        now = time.time()
+        with self._lock:
+            keys = [key.health(now) for key in self.keys]
+        return {"keys": keys, "healthy": sum(1 for key in keys if key["healthy"]), "total": len(keys)}
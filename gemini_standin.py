@@ -0,0 +1,196 @@
+"""Local stand-in for the Gemini REST API, for tests and benchmarks.
+
+Point the app at it with GEMINI_API_BASE=http://127.0.0.1:<port>. It
+implements the calls app.py makes:
+
+* POST /v1beta/models/<model>:generateContent. Models with "image" in
+  their name answer with an inlineData image, the rest with text. Replies
+  are delayed by ``latency``.
+* The Files API resumable upload (POST /upload/v1beta/files, start, then
+  upload+finalize) and GET /v1beta/files/<id>.
+
+As in the real service, files expire after ``file_ttl`` seconds and are
+visible only to the API key that uploaded them. generateContent answers
+403 for an unknown, expired or foreign file_uri. GET /stats reports
+request counts and request bytes, so payload savings can be measured.
+
+    python gemini_standin.py --port 5078 --latency 1
+"""
+import json
+import time
+import uuid
+import base64
+import argparse
+import threading
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Smallest JPEG-looking payload; the app only base64-decodes and stores it
+STANDIN_IMAGE = base64.b64encode(b"\xff\xd8\xff\xe0\x00\x10JFIF\x00standin\xff\xd9").decode()
+
+
+def _expiry(seconds):
+    return (datetime.utcnow() + timedelta(seconds=seconds)).isoformat(timespec="microseconds") + "123Z"
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, latency, file_ttl):
+        super().__init__(address, _Handler)
+        self.latency = latency
+        self.file_ttl = file_ttl
+        self.lock = threading.Lock()
+        self.files = {}
+        self.pending = {}
+        self.stats = {"generate_requests": 0, "generate_bytes": 0, "uploads": 0, "upload_bytes": 0, "file_refs": 0, "rejected": 0}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message, reason):
+        self._send(status, {"error": {"code": status, "message": message, "status": reason}})
+
+    def _api_key(self, query):
+        return self.headers.get("x-goog-api-key") or (query.get("key") or [None])[0]
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        server = self.server
+        if parts.path == "/stats":
+            with server.lock:
+                return self._send(200, dict(server.stats, files=len(server.files)))
+        if parts.path.startswith("/v1beta/files/"):
+            with server.lock:
+                stored = server.files.get(parts.path[len("/v1beta/"):])
+            if not stored or stored["key"] != self._api_key(parse_qs(parts.query)) or stored["expires"] < time.time():
+                return self._error(404, "File not found.", "NOT_FOUND")
+            return self._send(200, stored["file"])
+        self._error(404, "Not found.", "NOT_FOUND")
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        api_key = self._api_key(query)
+        if not api_key:
+            return self._error(403, "Method doesn't allow unregistered callers.", "PERMISSION_DENIED")
+        if parts.path == "/upload/v1beta/files":
+            return self._upload(query, body, api_key)
+        if parts.path.startswith("/v1beta/models/") and parts.path.endswith(":generateContent"):
+            return self._generate(parts.path[len("/v1beta/models/"):-len(":generateContent")], body, api_key)
+        self._error(404, "Not found.", "NOT_FOUND")
+
+    def _upload(self, query, body, api_key):
+        server = self.server
+        command = self.headers.get("X-Goog-Upload-Command", "")
+        if command == "start":
+            upload_id = uuid.uuid4().hex
+            try:
+                display_name = json.loads(body or b"{}").get("file", {}).get("display_name", "")
+            except ValueError:
+                display_name = ""
+            with server.lock:
+                server.pending[upload_id] = {
+                    "key": api_key,
+                    "display_name": display_name,
+                    "mime_type": self.headers.get("X-Goog-Upload-Header-Content-Type", "application/octet-stream"),
+                }
+            return self._send(200, {}, {"X-Goog-Upload-URL": f"{server.url}/upload/v1beta/files?upload_id={upload_id}",
+                                        "X-Goog-Upload-Status": "active"})
+        if "finalize" in command:
+            with server.lock:
+                pending = server.pending.pop((query.get("upload_id") or [""])[0], None)
+            if not pending or pending["key"] != api_key:
+                return self._error(404, "Upload session not found.", "NOT_FOUND")
+            name = f"files/{uuid.uuid4().hex[:12]}"
+            file = {
+                "name": name,
+                "displayName": pending["display_name"],
+                "mimeType": pending["mime_type"],
+                "sizeBytes": str(len(body)),
+                "expirationTime": _expiry(server.file_ttl),
+                "uri": f"{server.url}/v1beta/{name}",
+                "state": "ACTIVE",
+            }
+            with server.lock:
+                server.files[name] = {"key": api_key, "file": file, "expires": time.time() + server.file_ttl}
+                server.stats["uploads"] += 1
+                server.stats["upload_bytes"] += len(body)
+            return self._send(200, {"file": file}, {"X-Goog-Upload-Status": "final"})
+        self._error(400, "Unsupported upload command.", "INVALID_ARGUMENT")
+
+    def _generate(self, model, body, api_key):
+        server = self.server
+        try:
+            request = json.loads(body)
+        except ValueError:
+            return self._error(400, "Invalid JSON payload.", "INVALID_ARGUMENT")
+        with server.lock:
+            server.stats["generate_requests"] += 1
+            server.stats["generate_bytes"] += len(body)
+        for content in request.get("contents") or []:
+            for part in content.get("parts") or []:
+                file_data = part.get("file_data") or part.get("fileData")
+                if not file_data:
+                    continue
+                uri = file_data.get("file_uri") or file_data.get("fileUri") or ""
+                with server.lock:
+                    stored = server.files.get("files/" + uri.rsplit("/files/", 1)[-1])
+                    usable = stored and stored["key"] == api_key and stored["expires"] >= time.time()
+                    server.stats["file_refs" if usable else "rejected"] += 1
+                if not usable:
+                    return self._error(403, f"You do not have permission to access the File {uri} or it may not exist.",
+                                       "PERMISSION_DENIED")
+        time.sleep(server.latency)
+        if "image" in model:
+            part = {"inlineData": {"mimeType": "image/jpeg", "data": STANDIN_IMAGE}}
+        else:
+            part = {"text": "Stand-in reply."}
+        self._send(200, {
+            "candidates": [{"content": {"role": "model", "parts": [part]}, "finishReason": "STOP"}],
+            "usageMetadata": {"promptTokenCount": 40, "candidatesTokenCount": 3, "totalTokenCount": 43}
+        })
+
+
+def start(port=0, latency=0.0, file_ttl=48 * 3600, host="127.0.0.1"):
+    """Serves the stand-in from a daemon thread; port 0 picks a free port (see .url)."""
+    server = StandinServer((host, port), latency, file_ttl)
+    threading.Thread(target=server.serve_forever, name="gemini-standin", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Gemini API stand-in")
+    parser.add_argument("--port", type=int, default=5078)
+    parser.add_argument("--latency", type=float, default=0.0, help="generateContent delay in seconds")
+    parser.add_argument("--file-ttl", type=float, default=48 * 3600, help="uploaded file lifetime in seconds")
+    args = parser.parse_args()
+    standin = start(args.port, args.latency, args.file_ttl)
+    print(f"[INFO] Gemini stand-in listening on {standin.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        standin.shutdown()
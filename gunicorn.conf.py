@@ -0,0 +1,23 @@
+"""Gunicorn settings for the CreatorsAI API:  gunicorn -c gunicorn.conf.py app:app
+
+CREATORSAI_ASYNC=true switches to eventlet workers (see coop.py): each worker
+then serves up to WORKER_CONNECTIONS requests concurrently while they wait on
+Gemini, instead of one.
+"""
+import os
+
+from coop import ASYNC_MODE, prepare
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+if ASYNC_MODE:
+    # Workers patch the stdlib before loading the app; some imports have to happen before that
+    prepare()
+    worker_class = "eventlet"
+    worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 500))
+else:
+    worker_class = "sync"
+# Image generation waits up to 190s on Gemini
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 240))
+graceful_timeout = 30
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG")
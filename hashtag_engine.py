@@ -0,0 +1,96 @@
+"""Local hashtag candidates for /generate.
+
+Scores caption words against a precomputed IDF table (hashtag_data.json):
+stopwords are dropped, each remaining word scores tf * idf (words missing
+from the table get default_idf, which stays below STRONG_SCORE), adjacent
+pairs of strong words become compound tags (#streetphotography) when the
+compound itself is in the table or among the trending tags, hashtags
+already in the caption are kept, and words found in the curated trending
+dictionary pull in their tags. Everything is dict lookups over a handful
+of tokens, so a caption takes tens of microseconds.
+
+suggest() also reports a confidence: when it is high enough the caller
+can answer without the model, otherwise the candidates go to the model as
+hints. The same candidates are the fallback when the model is unavailable.
+"""
+import os
+import re
+import json
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hashtag_data.json')
+
+_WORD = re.compile(r'#?[^\W_]+', re.UNICODE)
+# Scores at or above this count as confident candidates (topical words sit at 2.6+ in the IDF table)
+STRONG_SCORE = 2.5
+
+
+class HashtagEngine:
+    def __init__(self, idf, stopwords, trending, default_idf=2.0):
+        self.idf = idf
+        self.stopwords = frozenset(stopwords)
+        self.trending = trending
+        self.default_idf = default_idf
+        self.max_idf = max(idf.values(), default=default_idf)
+        self.compounds = {tag for tags in trending.values() for tag in tags}
+
+    @classmethod
+    def load(cls, path=DATA_PATH):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['idf'], data['stopwords'], data['trending'], data.get('default_idf', 2.0))
+
+    def _tokens(self, text):
+        existing, words = [], []
+        for token in _WORD.findall(text.lower()):
+            if token.startswith('#'):
+                if len(token) > 2:
+                    existing.append(token)
+            elif len(token) > 2 and not token.isdigit() and token not in self.stopwords:
+                words.append(token)
+        return existing, words
+
+    def suggest(self, text, count=7):
+        """Returns (hashtags best first, confidence 0..1)."""
+        existing, words = self._tokens(text or '')
+        idf, default_idf = self.idf, self.default_idf
+        scores = {}
+        for word in words:
+            tag = '#' + word
+            scores[tag] = scores.get(tag, 0.0) + idf.get(word, default_idf)
+        # Adjacent topical words make compound tags, weaker than either alone, but only
+        # compounds people actually use (in the table or trending); they add no confidence
+        compounds = set()
+        for first, second in zip(words, words[1:]):
+            weight = min(idf.get(first, 0.0), idf.get(second, 0.0))
+            compound = first + second
+            if weight >= STRONG_SCORE and (compound in idf or '#' + compound in self.compounds):
+                tag = '#' + compound
+                scores[tag] = max(scores.get(tag, 0.0), weight * 0.9)
+                compounds.add(tag)
+        curated = 0
+        for word in words:
+            for rank, tag in enumerate(self.trending.get(word, ())):
+                boost = idf.get(word, default_idf) * (1.0 - 0.1 * rank)
+                if tag not in scores:
+                    curated += 1
+                compounds.discard(tag)
+                scores[tag] = max(scores.get(tag, 0.0), boost)
+        for tag in existing:
+            scores[tag] = self.max_idf + 1.0
+
+        ranked = sorted(scores, key=scores.get, reverse=True)[:count]
+        if not ranked:
+            return [], 0.0
+        known = sum(1 for word in words if word in idf)
+        coverage = known / len(words) if words else 1.0
+        strong = sum(1 for tag in ranked if scores[tag] >= STRONG_SCORE and tag not in compounds)
+        confidence = min(1.0, strong / count) * (0.5 + 0.5 * coverage) * (1.0 if curated else 0.85)
+        return ranked, round(confidence, 3)
+
+    @staticmethod
+    def hint(tags):
+        """Prompt fragment handing local candidates to the model."""
+        if not tags:
+            return ''
+        return ("Candidate hashtags from our keyword engine (use the relevant ones, replace weak ones): "
+                + ', '.join(tags) + '\n')
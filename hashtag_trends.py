@@ -0,0 +1,346 @@
+import os
+import time
+import heapq
+import pickle
+import hashlib
+import threading
+from array import array
+
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes run a single worker, so compaction goes unlocked
+    fcntl = None
+
+# ------------------------
+# Trending Configuration
+# ------------------------
+FORMAT_VERSION = 1
+STATE_FILE = "trends.pkl"
+DELTA_PREFIX = "delta-"
+MAX_TAG_CHARS = 64
+
+
+def normalize_tag(tag):
+    """"#Travel " -> "#travel"; returns None for anything that is not a usable hashtag."""
+    tag = (tag or "").strip().lower()
+    if not tag.startswith("#") or len(tag) < 2 or len(tag) > MAX_TAG_CHARS:
+        return None
+    return tag
+
+
+class CountMinSketch:
+    """depth x width counters; estimates never undercount and overcount by ~total*e/width at most."""
+
+    def __init__(self, width=2048, depth=4, table=None):
+        self.width = width
+        self.depth = depth
+        self.table = array("I", table) if table is not None else array("I", bytes(4 * width * depth))
+
+    def cells(self, key):
+        # Double hashing: one blake2b digest gives every row's column
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        width = self.width
+        return [row * width + (h1 + row * h2) % width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Counts key and returns its new estimate."""
+        table = self.table
+        estimate = None
+        for cell in self.cells(key):
+            table[cell] += count
+            if estimate is None or table[cell] < estimate:
+                estimate = table[cell]
+        return estimate
+
+    def estimate(self, key, cells=None):
+        table = self.table
+        return min(table[cell] for cell in (cells or self.cells(key)))
+
+    def merge(self, other):
+        table = self.table
+        for cell, value in enumerate(other.table):
+            if value:
+                table[cell] += value
+
+
+class TopK:
+    """The k keys with the highest estimates; a lazy min-heap finds the one to evict."""
+
+    def __init__(self, k=100, counts=None):
+        self.k = k
+        self.counts = {}
+        self.heap = []
+        for key, count in (counts or {}).items():
+            self.offer(key, count)
+
+    def offer(self, key, estimate):
+        counts = self.counts
+        if key not in counts and len(counts) >= self.k:
+            floor, floor_key = self._floor()
+            if estimate <= floor:
+                return
+            heapq.heappop(self.heap)
+            del counts[floor_key]
+        counts[key] = estimate
+        heapq.heappush(self.heap, (estimate, key))
+        # Every update leaves a stale entry behind; rebuild before the heap outgrows k by much
+        if len(self.heap) > 4 * self.k:
+            self.heap = [(count, key) for key, count in counts.items()]
+            heapq.heapify(self.heap)
+
+    def _floor(self):
+        heap, counts = self.heap, self.counts
+        while counts.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0]
+
+
+class Bucket:
+    """Counts for one time slice: a sketch for estimates, a TopK for the candidate tags."""
+
+    def __init__(self, width, depth, top_k, table=None, top=None, total=0):
+        self.sketch = CountMinSketch(width, depth, table)
+        self.top = TopK(top_k, top)
+        self.total = total
+
+    def record(self, tag):
+        self.top.offer(tag, self.sketch.add(tag))
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+        self.total += other.total
+        candidates = set(self.top.counts) | set(other.top.counts)
+        self.top = TopK(self.top.k, {tag: self.sketch.estimate(tag) for tag in candidates})
+
+    def dump(self):
+        return {"table": self.sketch.table.tobytes(), "top": dict(self.top.counts), "total": self.total}
+
+
+class TrendCounter:
+    """Rolling hashtag counts over `buckets` slices of `bucket_seconds`, shared by all workers through `path`.
+
+    Each worker counts into its own in-memory buckets. flush() writes them out as a delta file and
+    then, if no other worker holds the lock, compacts every delta into the shared state file
+    (expired slices are dropped there). trending() reads that state file (reloaded when it changes)
+    plus the worker's own buckets, unflushed or flushed but not yet compacted, so it never touches
+    the database.
+    """
+
+    def __init__(self, path, bucket_seconds=300, buckets=12, width=2048, depth=4, top_k=100,
+                 interval=60, lock_path=None):
+        self.path = path
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+        self.width = width
+        self.depth = depth
+        self.top_k = top_k
+        self.interval = interval
+        self.lock_path = lock_path or os.path.join(path, "compact.lock")
+        self.local = {}
+        # Delta name -> buckets this worker flushed that the state file does not account for yet
+        self.pending = {}
+        self.merged = {}
+        self._merged_mtime = None
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stats = {
+            "recorded": 0,
+            "flushes": 0,
+            "compactions": 0,
+            "deltas_merged": 0,
+            "last_compaction_at": None,
+            "errors": 0,
+        }
+        os.makedirs(path, exist_ok=True)
+
+    def _new_bucket(self, dumped=None):
+        return Bucket(self.width, self.depth, self.top_k, **(dumped or {}))
+
+    def _bucket_start(self, now):
+        return int(now // self.bucket_seconds) * self.bucket_seconds
+
+    def _expired_before(self, now):
+        return self._bucket_start(now) - (self.buckets - 1) * self.bucket_seconds
+
+    # --- Recording -------------------------------------------------------
+    def record(self, tags, now=None):
+        """Counts one /generate result; repeated tags within it count once."""
+        tags = {tag for tag in map(normalize_tag, tags or ()) if tag}
+        if not tags:
+            return
+        now = time.time() if now is None else now
+        start = self._bucket_start(now)
+        with self._lock:
+            bucket = self.local.get(start)
+            if bucket is None:
+                bucket = self.local[start] = self._new_bucket()
+                oldest = self._expired_before(now)
+                for expired in [s for s in self.local if s < oldest]:
+                    del self.local[expired]
+            for tag in tags:
+                bucket.record(tag)
+            bucket.total += 1
+            self.stats["recorded"] += 1
+
+    # --- Disk: deltas and compaction -------------------------------------
+    def _write(self, path, payload):
+        partial = f"{path}.{os.getpid()}.tmp"
+        with open(partial, "wb") as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(partial, path)
+
+    def _config(self):
+        return {"version": FORMAT_VERSION, "bucket_seconds": self.bucket_seconds, "width": self.width, "depth": self.depth}
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                payload = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            print(f"[ERROR] Ignoring unreadable trends file {path}: {e}")
+            return None
+        if payload.get("config") != self._config():
+            print(f"[WARN] Ignoring trends file {path} written with different settings.")
+            return None
+        return payload
+
+    def flush(self, now=None):
+        """Writes this worker's counts as a delta file and tries to compact; returns True if it compacted."""
+        with self._lock:
+            local, self.local = self.local, {}
+        if local:
+            name = f"{DELTA_PREFIX}{os.getpid()}-{time.time_ns()}.pkl"
+            self._write(os.path.join(self.path, name),
+                        {"config": self._config(), "buckets": {start: b.dump() for start, b in local.items()}})
+            with self._lock:
+                self.pending[name] = local
+                # Should compaction keep failing, slices outside the window still age out here
+                oldest = self._expired_before(time.time() if now is None else now)
+                for stale in [n for n, buckets in self.pending.items() if max(buckets) < oldest]:
+                    del self.pending[stale]
+            self.stats["flushes"] += 1
+        return self._compact_exclusive(now)
+
+    def _compact_exclusive(self, now=None):
+        """Compacts only if no other worker process holds the compaction lock file."""
+        if fcntl is None:
+            return self.compact(now)
+        with open(self.lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            try:
+                return self.compact(now)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def compact(self, now=None):
+        """Merges every delta file into the state file and drops slices outside the window."""
+        now = time.time() if now is None else now
+        state_path = os.path.join(self.path, STATE_FILE)
+        state = self._read(state_path) if os.path.exists(state_path) else None
+        buckets = {start: self._new_bucket(dumped) for start, dumped in (state or {}).get("buckets", {}).items()}
+        # Deltas merged last time but not yet deleted (crash in between) must not count twice
+        already_merged = set((state or {}).get("merged", ()))
+        deltas = sorted(name for name in os.listdir(self.path) if name.startswith(DELTA_PREFIX) and name.endswith(".pkl"))
+        leftover = sorted(already_merged.intersection(deltas))
+        merged = list(leftover)
+        for name in deltas:
+            if name in already_merged:
+                continue
+            delta = self._read(os.path.join(self.path, name))
+            if delta is None:
+                # Left in place for the next compaction (or a human) rather than dropped
+                continue
+            for start, dumped in delta["buckets"].items():
+                if start in buckets:
+                    buckets[start].merge(self._new_bucket(dumped))
+                else:
+                    buckets[start] = self._new_bucket(dumped)
+            merged.append(name)
+        oldest = self._expired_before(now)
+        buckets = {start: bucket for start, bucket in buckets.items() if start >= oldest}
+        if merged or state is None or len(buckets) != len(state.get("buckets", {})):
+            self._write(state_path, {"config": self._config(), "merged": merged,
+                                     "buckets": {start: b.dump() for start, b in buckets.items()}})
+        # Only what the state file now accounts for: this round's deltas and the last round's leftovers
+        for name in merged:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+        self.stats["compactions"] += 1
+        self.stats["deltas_merged"] += len(merged) - len(leftover)
+        self.stats["last_compaction_at"] = now
+        return True
+
+    def _refresh_merged(self):
+        state_path = os.path.join(self.path, STATE_FILE)
+        try:
+            mtime = os.stat(state_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._merged_mtime:
+            return
+        # Checked before reading the state: a delta is only deleted after a state listing it was written
+        gone = {name for name in self.pending if not os.path.exists(os.path.join(self.path, name))}
+        state = self._read(state_path)
+        if state is not None:
+            self.merged = {start: self._new_bucket(dumped) for start, dumped in state["buckets"].items()}
+            gone.update(state.get("merged", ()))
+            for name in gone.intersection(self.pending):
+                del self.pending[name]
+        self._merged_mtime = mtime
+        self._cache.clear()
+
+    # --- Queries ---------------------------------------------------------
+    def trending(self, window_seconds=3600, limit=20, now=None, cache_seconds=5):
+        """Top tags over the last window_seconds: [{"tag", "count"}], count being a sketch estimate."""
+        now = time.time() if now is None else now
+        window_seconds = max(self.bucket_seconds, min(window_seconds, self.buckets * self.bucket_seconds))
+        with self._lock:
+            self._refresh_merged()
+            key = (window_seconds, limit)
+            cached = self._cache.get(key)
+            if cached and now - cached[0] < cache_seconds:
+                return cached[1]
+            oldest = self._bucket_start(now) - window_seconds + self.bucket_seconds
+            slices = [b for start, b in self.merged.items() if start >= oldest]
+            slices += [b for start, b in self.local.items() if start >= oldest]
+            slices += [b for local in self.pending.values() for start, b in local.items() if start >= oldest]
+            candidates = set()
+            for bucket in slices:
+                candidates.update(bucket.top.counts)
+            counts = {}
+            for tag in candidates:
+                # Every bucket shares width/depth, so the cells are computed once per tag
+                cells = slices[0].sketch.cells(tag)
+                counts[tag] = sum(bucket.sketch.estimate(tag, cells) for bucket in slices)
+            top = heapq.nlargest(limit, counts.items(), key=lambda item: (item[1], item[0]))
+            result = {
+                "window_seconds": window_seconds,
+                "generations": sum(bucket.total for bucket in slices),
+                "hashtags": [{"tag": tag, "count": count} for tag, count in top],
+            }
+            self._cache[key] = (now, result)
+            return result
+
+    # --- Background flushing ---------------------------------------------
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"[ERROR] Hashtag trends flush failed: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="hashtag-trends", daemon=True)
+            self._thread.start()
+        return self._thread
@@ -0,0 +1,193 @@
+"""Voice-note transcoding for the iSightU chat server.
+
+Uploads are piped into ffmpeg (stdin) and the Opus/Ogg result is read
+from its stdout into the media directory; no shell is involved, ffmpeg
+gets an argument list. A raw request body is streamed chunk by chunk and
+never staged on disk. Multipart uploads are parsed by werkzeug first,
+which spools files above 500 KB to a temporary file.
+
+At most `workers` ffmpeg processes run at once; up to `max_queue` further
+uploads wait for a slot and anything beyond that is refused with
+TranscoderBusy so callers can answer 503 instead of piling up processes.
+"""
+import os
+import struct
+import threading
+import subprocess
+
+
+class TranscoderBusy(Exception):
+    """Every ffmpeg slot is taken and the wait queue is full."""
+
+
+class TranscodeError(Exception):
+    """ffmpeg failed or the input was rejected."""
+
+
+class UploadTooLarge(TranscodeError):
+    pass
+
+
+class TranscoderPool:
+    """Bounded pool of ffmpeg subprocesses transcoding streamed audio to Opus.
+
+    sleep is the Socket.IO server's sleep so waiting for a slot or for
+    ffmpeg to exit yields to other green threads under eventlet. offload(fn,
+    *args) runs the blocking pipe writes and thread joins; pass one that uses
+    an OS thread pool when an eventlet hub runs over an unpatched stdlib.
+    """
+
+    def __init__(self, sleep, workers=2, max_queue=8, ffmpeg='ffmpeg', bitrate='32k',
+                 max_seconds=300, max_bytes=10 * 1024 * 1024, timeout=120, offload=None):
+        self.sleep = sleep
+        self.offload = offload or (lambda fn, *args: fn(*args))
+        self.workers = workers
+        self.max_queue = max_queue
+        self.ffmpeg = ffmpeg
+        self.bitrate = bitrate
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+        self.stats = {'completed': 0, 'failed': 0, 'rejected': 0}
+
+    def command(self):
+        return [
+            self.ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin',
+            '-i', 'pipe:0',
+            '-vn', '-t', str(self.max_seconds),
+            '-c:a', 'libopus', '-b:a', self.bitrate, '-ar', '48000', '-ac', '1',
+            '-f', 'ogg', 'pipe:1'
+        ]
+
+    def _acquire(self):
+        with self.lock:
+            if self.active >= self.workers and self.waiting >= self.max_queue:
+                self.stats['rejected'] += 1
+                raise TranscoderBusy(f'{self.active} transcodes running, {self.waiting} queued')
+            self.waiting += 1
+        try:
+            while True:
+                with self.lock:
+                    if self.active < self.workers:
+                        self.active += 1
+                        return
+                self.sleep(0.05)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    def _release(self):
+        with self.lock:
+            self.active -= 1
+
+    def transcode(self, chunks, out_path):
+        """Streams chunks (an iterable of bytes) through ffmpeg into out_path.
+
+        Returns {'bytes': size, 'duration': seconds or None}. The output is
+        written to out_path + '.part' and renamed once ffmpeg succeeds.
+        """
+        self._acquire()
+        try:
+            return self._run(chunks, out_path)
+        finally:
+            self._release()
+
+    def _run(self, chunks, out_path):
+        partial = out_path + '.part'
+        offload = self.offload
+        errors = []
+        try:
+            proc = subprocess.Popen(self.command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        except OSError as e:
+            self.stats['failed'] += 1
+            raise TranscodeError(f'cannot start ffmpeg: {e}')
+
+        with open(partial, 'wb') as out:
+            # Drain stdout/stderr concurrently so ffmpeg never blocks on a full pipe
+            copier = threading.Thread(target=_copy, args=(proc.stdout, out), daemon=True)
+            collector = threading.Thread(target=_tail, args=(proc.stderr, errors), daemon=True)
+            copier.start()
+            collector.start()
+            received = 0
+            try:
+                for chunk in chunks:
+                    received += len(chunk)
+                    if received > self.max_bytes:
+                        raise UploadTooLarge(f'upload exceeds {self.max_bytes} bytes')
+                    offload(proc.stdin.write, chunk)
+                offload(proc.stdin.close)
+                waited = 0.0
+                while proc.poll() is None:
+                    if waited > self.timeout:
+                        raise TranscodeError('ffmpeg timed out')
+                    self.sleep(0.02)
+                    waited += 0.02
+            except Exception as e:
+                # Includes the client going away mid-upload: never leave ffmpeg running
+                proc.kill()
+                offload(_finish, proc, copier, collector)
+                os.remove(partial)
+                self.stats['failed'] += 1
+                if isinstance(e, BrokenPipeError):
+                    raise TranscodeError(b''.join(errors).decode(errors='replace').strip() or 'ffmpeg closed its input')
+                raise
+            offload(_finish, proc, copier, collector)
+
+        if proc.returncode != 0 or received == 0:
+            os.remove(partial)
+            self.stats['failed'] += 1
+            raise TranscodeError(b''.join(errors).decode(errors='replace').strip() or 'empty upload')
+        os.replace(partial, out_path)
+        self.stats['completed'] += 1
+        return {'bytes': os.path.getsize(out_path), 'duration': opus_duration(out_path)}
+
+    def metrics(self):
+        """Gauges for chat_metrics collectors."""
+        return [
+            ('voice_transcodes_active', {}, self.active),
+            ('voice_transcodes_queued', {}, self.waiting),
+        ] + [('voice_transcodes_total', {'result': key}, value) for key, value in self.stats.items()]
+
+
+def _finish(proc, copier, collector):
+    try:
+        proc.stdin.close()
+    except OSError:
+        pass
+    proc.wait()
+    copier.join()
+    collector.join()
+
+
+def _copy(source, target):
+    for chunk in iter(lambda: source.read(64 * 1024), b''):
+        target.write(chunk)
+    source.close()
+
+
+def _tail(source, errors, limit=4096):
+    data = source.read()
+    errors.append(data[-limit:])
+    source.close()
+
+
+def opus_duration(path):
+    """Seconds of audio in an Ogg Opus file: last page granule minus the OpusHead pre-skip."""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(4096)
+            f.seek(max(0, os.path.getsize(path) - 65536))
+            tail = f.read()
+    except OSError:
+        return None
+    marker = head.find(b'OpusHead')
+    page = tail.rfind(b'OggS')
+    if marker < 0 or page < 0 or len(tail) < page + 14:
+        return None
+    pre_skip = struct.unpack_from('<H', head, marker + 10)[0]
+    granule = struct.unpack_from('<q', tail, page + 6)[0]
+    return round(max(0, granule - pre_skip) / 48000.0, 2)
@@ -0,0 +1,331 @@
+"""Durable per-chat message storage for the iSightU chat server.
+
+Each chat gets its own directory of append-only segment files:
+
+    <root>/<quoted chat id>/00000000000000000000.log   one compact JSON record per line
+    <root>/<quoted chat id>/00000000000000000000.idx   little-endian uint64 byte offset per record
+
+A message's offset is its position in the chat (0, 1, 2, ...); appended
+messages are stamped with seq = offset + 1, a per-chat sequence number that
+clients use as a sync cursor. The segment
+file name is the offset of its first message, so finding a message is a
+bisect over segment bases plus one index lookup. Sealed segments are read
+through mmap; only a small hot tail of recent messages per chat stays in RAM,
+and only for the ``max_open_chats`` most recently used chats.
+
+With shared=True several processes may append to the same chats: appends
+take an flock on the chat directory and every access first picks up records
+written by other processes.
+"""
+import os
+import sys
+import json
+import mmap
+import struct
+import bisect
+import threading
+from array import array
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from urllib.parse import quote, unquote
+
+try:
+    import fcntl
+except ImportError:  # no cross-process locking on Windows; use shared=False there
+    fcntl = None
+
+INDEX_ENTRY = struct.Struct('<Q')
+
+
+def _encode(message):
+    return json.dumps(message, separators=(',', ':'), ensure_ascii=False).encode('utf-8') + b'\n'
+
+
+class _ChatLog:
+    """Segments, index and hot tail of a single chat. Callers hold self.lock."""
+
+    def __init__(self, path, segment_max_messages, hot_tail):
+        self.path = path
+        self.segment_max_messages = segment_max_messages
+        self.lock = threading.RLock()
+        self.closed = False
+        self.bases = []
+        self.active_index = array('Q')
+        self.active_size = 0
+        self.count = 0
+        self.tail = deque(maxlen=hot_tail)
+
+    def _segment_path(self, base, ext):
+        return os.path.join(self.path, f'{base:020d}.{ext}')
+
+    def _load(self):
+        if not os.path.isdir(self.path):
+            return
+        self.bases = sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.log'))
+        if not self.bases:
+            return
+        base = self.bases[-1]
+        self.active_index = self._read_index(base)
+        self._recover(base)
+        self.count = base + len(self.active_index)
+
+    def _recover(self, base):
+        """Drops a torn trailing record left behind by a crash between the log and index writes."""
+        log_path = self._segment_path(base, 'log')
+        size = os.path.getsize(log_path)
+        if self.active_index:
+            with open(log_path, 'rb') as f:
+                f.seek(self.active_index[-1])
+                end = self.active_index[-1] + len(f.readline())
+        else:
+            end = 0
+        if size > end:
+            with open(log_path, 'r+b') as f:
+                f.truncate(end)
+        self.active_size = end
+
+    def sync(self):
+        """Catches up with segments and records appended by other processes."""
+        while True:
+            if not self.bases:
+                if not os.path.isdir(self.path):
+                    return
+                self.bases = sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.log'))
+                if not self.bases:
+                    return
+            base = self.bases[-1]
+            try:
+                entries = os.path.getsize(self._segment_path(base, 'idx')) // INDEX_ENTRY.size
+            except FileNotFoundError:
+                entries = 0
+            if entries > len(self.active_index):
+                self.active_index = self._read_index(base, repair=False)
+                self.active_size = os.path.getsize(self._segment_path(base, 'log'))
+            self.count = base + len(self.active_index)
+            if len(self.active_index) >= self.segment_max_messages and os.path.exists(self._segment_path(self.count, 'log')):
+                self.bases.append(self.count)
+                self.active_index = array('Q')
+                self.active_size = 0
+                continue
+            return
+
+    def _read_index(self, base, repair=True):
+        idx = array('Q')
+        try:
+            with open(self._segment_path(base, 'idx'), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return idx
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        if repair and usable != len(data):
+            with open(self._segment_path(base, 'idx'), 'r+b') as f:
+                f.truncate(usable)
+        idx.frombytes(data[:usable])
+        if sys.byteorder == 'big':
+            idx.byteswap()
+        return idx
+
+    def append(self, message):
+        if not self.bases or len(self.active_index) >= self.segment_max_messages:
+            os.makedirs(self.path, exist_ok=True)
+            self.bases.append(self.count)
+            self.active_index = array('Q')
+            self.active_size = 0
+        base = self.bases[-1]
+        message['seq'] = self.count + 1
+        record = _encode(message)
+        with open(self._segment_path(base, 'log'), 'ab') as f:
+            f.write(record)
+        with open(self._segment_path(base, 'idx'), 'ab') as f:
+            f.write(INDEX_ENTRY.pack(self.active_size))
+        self.active_index.append(self.active_size)
+        self.active_size += len(record)
+        offset = self.count
+        self.count += 1
+        self.tail.append((offset, message))
+        return offset
+
+
+class MessageLog:
+    """Append-only, segmented message store with cursor-based reads."""
+
+    def __init__(self, root, segment_max_messages=4096, hot_tail=50, max_mapped_segments=128, shared=False,
+                 max_open_chats=4096):
+        self.root = os.path.abspath(root)
+        self.shared = shared and fcntl is not None
+        self.segment_max_messages = segment_max_messages
+        self.hot_tail = hot_tail
+        self.max_mapped_segments = max_mapped_segments
+        self.max_open_chats = max_open_chats
+        self._chats = OrderedDict()
+        self._chats_lock = threading.Lock()
+        self._maps = OrderedDict()
+        self._maps_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def chat_path(self, chat_id):
+        """Directory of a chat; ValueError for ids that would not map to a directory directly under root."""
+        name = quote(chat_id, safe='') if isinstance(chat_id, str) else ''
+        # quote() leaves "." and ".." alone, which would resolve to root itself or its parent
+        if name in ('', '.', '..') or len(name) > 240:
+            raise ValueError(f'invalid chat id: {chat_id!r}')
+        path = os.path.join(self.root, name)
+        if os.path.dirname(os.path.normpath(path)) != self.root:
+            raise ValueError(f'invalid chat id: {chat_id!r}')
+        return path
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is not None:
+            try:
+                self._chats.move_to_end(chat_id)
+            except KeyError:  # evicted meanwhile; callers notice chat.closed and reopen
+                pass
+            return chat
+        with self._chats_lock:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = _ChatLog(self.chat_path(chat_id), self.segment_max_messages, self.hot_tail)
+                with self._exclusive(chat):
+                    chat._load()
+                self._chats[chat_id] = chat
+                if chat.count:
+                    chat.tail.extend(self._read_range(chat, max(0, chat.count - self.hot_tail), chat.count))
+                self._evict()
+        return chat
+
+    def _evict(self):
+        """Closes least recently used chats beyond max_open_chats; busy ones are skipped until next time."""
+        excess = len(self._chats) - self.max_open_chats
+        for chat_id in list(self._chats)[:max(0, excess)]:
+            chat = self._chats[chat_id]
+            if not chat.lock.acquire(blocking=False):
+                continue
+            try:
+                chat.closed = True
+                del self._chats[chat_id]
+            finally:
+                chat.lock.release()
+
+    @contextmanager
+    def _locked(self, chat_id):
+        """Yields the chat with its lock held, reopening it if it was evicted in between."""
+        while True:
+            chat = self._chat(chat_id)
+            with chat.lock:
+                if not chat.closed:
+                    yield chat
+                    return
+
+    def append(self, chat_id, message):
+        """Persists a message, stamping message['seq'], and returns its offset within the chat."""
+        with self._locked(chat_id) as chat, self._exclusive(chat):
+            self._refresh(chat)
+            return chat.append(message)
+
+    def count(self, chat_id):
+        with self._locked(chat_id) as chat:
+            self._refresh(chat)
+            return chat.count
+
+    def last(self, chat_id):
+        with self._locked(chat_id) as chat:
+            self._refresh(chat)
+            return chat.tail[-1][1] if chat.tail else None
+
+    def read(self, chat_id, before=None, limit=50):
+        """Returns (messages oldest-first, cursor for the next older page or None)."""
+        with self._locked(chat_id) as chat:
+            self._refresh(chat)
+            end = chat.count if before is None else max(0, min(before, chat.count))
+            start = max(0, end - limit)
+            if chat.tail and start >= chat.tail[0][0]:
+                page = [m for offset, m in chat.tail if start <= offset < end]
+            else:
+                page = [m for _, m in self._read_range(chat, start, end)]
+        return page, (start if start > 0 else None)
+
+    def read_since(self, chat_id, seq, limit=50):
+        """Returns (up to limit messages with a seq above `seq`, oldest-first; True if more remain)."""
+        with self._locked(chat_id) as chat:
+            self._refresh(chat)
+            start = max(0, seq)
+            end = min(chat.count, start + limit)
+            if start >= end:
+                return [], False
+            if chat.tail and start >= chat.tail[0][0]:
+                page = [m for offset, m in chat.tail if start <= offset < end]
+            else:
+                page = [m for _, m in self._read_range(chat, start, end)]
+            return page, end < chat.count
+
+    def chat_ids(self):
+        """Every chat with a directory under root, including ones not opened by this process."""
+        return [unquote(name) for name in os.listdir(self.root)
+                if os.path.isdir(os.path.join(self.root, name))]
+
+    # --- Multi-process support -------------------------------------------
+    @contextmanager
+    def _exclusive(self, chat):
+        """Holds the chat's cross-process append lock (no-op unless shared)."""
+        if not self.shared:
+            yield
+            return
+        os.makedirs(chat.path, exist_ok=True)
+        with open(os.path.join(chat.path, 'lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self, chat):
+        if not self.shared:
+            return
+        before = chat.count
+        chat.sync()
+        if chat.count > before:
+            chat.tail.extend(self._read_range(chat, max(before, chat.count - self.hot_tail), chat.count))
+
+    # --- Segment reads ---------------------------------------------------
+    def _map(self, path):
+        """Returns a cached read-only mapping of path, remapped if the file has grown."""
+        size = os.path.getsize(path)
+        with self._maps_lock:
+            cached = self._maps.get(path)
+            if cached and cached[0] == size:
+                self._maps.move_to_end(path)
+                return cached[1]
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self._maps[path] = (size, mapped)
+            # Evicted maps are not closed explicitly: a concurrent reader may still hold
+            # one, and the mapping is released once the last reference goes away.
+            while len(self._maps) > self.max_mapped_segments:
+                self._maps.popitem(last=False)
+            return mapped
+
+    def _read_range(self, chat, start, end):
+        result = []
+        offset = start
+        while offset < end:
+            i = bisect.bisect_right(chat.bases, offset) - 1
+            base = chat.bases[i]
+            if i == len(chat.bases) - 1:
+                index = chat.active_index
+                entries = len(index)
+            else:
+                # Sealed segments never change, so their index is mapped instead of loaded
+                index = self._map(chat._segment_path(base, 'idx'))
+                entries = len(index) // INDEX_ENTRY.size
+            stop = min(end, base + entries)
+            mapped = self._map(chat._segment_path(base, 'log'))
+            for o in range(offset, stop):
+                if index is chat.active_index:
+                    pos = index[o - base]
+                else:
+                    pos = INDEX_ENTRY.unpack_from(index, (o - base) * INDEX_ENTRY.size)[0]
+                line_end = mapped.find(b'\n', pos)
+                result.append((o, json.loads(mapped[pos:line_end])))
+            offset = stop
+        return result
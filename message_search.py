@@ -0,0 +1,278 @@
+"""Full-text message search for the iSightU chat server.
+
+An inverted index per chat maps every word to the messages of that chat
+containing it. Messages are identified by their per-chat seq and each
+posting list is a bytearray of delta-encoded varints, so a typical posting
+costs one or two bytes. Per message the index keeps only the timestamp;
+message bodies stay in the MessageLog and are read back for the page of
+hits being returned. A query only touches the posting lists of the chats
+the caller can see, so its cost follows the caller's chats, not the corpus.
+
+The last query word matches as a prefix (search-as-you-type) and hits are
+ranked newest first. A prefix expands to at most MAX_PREFIX_TERMS words;
+search() says when it had to cut the expansion short.
+
+One process owns the snapshot file (the first to lock it) and saves it
+chat by chat, yielding between chats, atomically and together with the
+seq each chat has reached; on startup catch_up() only indexes messages
+appended since the snapshot.
+"""
+import os
+import re
+import heapq
+import pickle
+import bisect
+import threading
+import time
+from array import array
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # no cross-process locking on Windows: every process saves
+    fcntl = None
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+MAX_TOKEN_CHARS = 32
+MIN_PREFIX_CHARS = 2
+MAX_PREFIX_TERMS = 200
+FORMAT_VERSION = 2
+
+
+def tokenize(text):
+    return [token for token in TOKEN_RE.findall((text or '').lower()) if len(token) <= MAX_TOKEN_CHARS]
+
+
+def _append_varint(buf, value):
+    while value >= 0x80:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _decode_postings(buf):
+    docs = []
+    doc = value = shift = 0
+    for byte in buf:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            doc += value
+            docs.append(doc)
+            value = shift = 0
+    return docs
+
+
+def _timestamp(message):
+    try:
+        return datetime.fromisoformat(message['timestamp']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return time.time()
+
+
+class MessageIndex:
+    """Per-chat inverted indexes over chat messages with compact posting lists."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        # chat id -> {word: delta-varint seqs}, plus the last seq appended to each list
+        self.postings = {}
+        self.last_seq = {}
+        # chat id -> timestamps by seq - 1; its length is the highest seq indexed
+        self.times = {}
+        # Sorted words of every chat, for prefix ranges
+        self.vocabulary = []
+        self.words = set()
+        self.docs = 0
+        self.dirty = False
+        self._owner = None
+
+    def __len__(self):
+        return self.docs
+
+    def cursor(self, chat_id):
+        """Highest seq indexed for a chat."""
+        return len(self.times.get(chat_id, ()))
+
+    # --- Indexing --------------------------------------------------------
+    def add(self, message):
+        """Indexes a just-appended message; returns False if it is not the chat's next seq
+        (already indexed, or an earlier message is missing and catch_up() has to run)."""
+        chat_id = message['chat_id']
+        seq = message.get('seq')
+        with self.lock:
+            if not seq or seq != self.cursor(chat_id) + 1:
+                return False
+            self._index(chat_id, seq, message)
+            return True
+
+    def _index(self, chat_id, seq, message):
+        postings = self.postings.get(chat_id)
+        if postings is None:
+            postings = self.postings[chat_id] = {}
+            self.last_seq[chat_id] = {}
+            self.times[chat_id] = array('d')
+        last_seq = self.last_seq[chat_id]
+        self.times[chat_id].append(_timestamp(message))
+        for token in set(tokenize(message.get('content'))):
+            buf = postings.get(token)
+            if buf is None:
+                buf = postings[token] = bytearray()
+                if token not in self.words:
+                    self.words.add(token)
+                    bisect.insort(self.vocabulary, token)
+            _append_varint(buf, seq - last_seq.get(token, 0))
+            last_seq[token] = seq
+        self.docs += 1
+        self.dirty = True
+
+    def catch_up(self, message_log, chat_ids=None, batch=500):
+        """Indexes everything the log holds beyond the index's cursors; returns how many messages."""
+        indexed = 0
+        for chat_id in (message_log.chat_ids() if chat_ids is None else chat_ids):
+            more = True
+            while more:
+                with self.lock:
+                    cursor = self.cursor(chat_id)
+                page, more = message_log.read_since(chat_id, cursor, batch)
+                with self.lock:
+                    for message in page:
+                        if message.get('seq') == self.cursor(chat_id) + 1:
+                            self._index(chat_id, message['seq'], message)
+                            indexed += 1
+        return indexed
+
+    # --- Queries ---------------------------------------------------------
+    def _prefix_terms(self, token):
+        """Indexed words starting with token (at most MAX_PREFIX_TERMS) and whether more were left out."""
+        start = bisect.bisect_left(self.vocabulary, token)
+        terms = []
+        for word in self.vocabulary[start:start + MAX_PREFIX_TERMS + 1]:
+            if not word.startswith(token):
+                break
+            terms.append(word)
+        return terms[:MAX_PREFIX_TERMS], len(terms) > MAX_PREFIX_TERMS
+
+    @staticmethod
+    def _match(postings, exact, terms):
+        """Seqs of one chat containing every exact word and, if terms is not None, one of the terms."""
+        candidates = None
+        # Rarest words first keeps the intersection small
+        for token in sorted(exact, key=lambda t: len(postings.get(t, b''))):
+            buf = postings.get(token)
+            if not buf:
+                return ()
+            seqs = set(_decode_postings(buf))
+            candidates = seqs if candidates is None else candidates & seqs
+            if not candidates:
+                return ()
+        if terms is not None:
+            seqs = set()
+            for word in terms:
+                buf = postings.get(word)
+                if buf:
+                    seqs.update(_decode_postings(buf))
+            candidates = seqs if candidates is None else candidates & seqs
+        return candidates or ()
+
+    def search(self, query, chat_ids, offset=0, limit=20):
+        """Returns ([(chat_id, seq)] newest first, total hits, truncated) within chat_ids.
+
+        truncated is True when the last word matched more than MAX_PREFIX_TERMS
+        indexed words and only the first of them (alphabetically) were searched."""
+        tokens = tokenize(query)
+        if not tokens:
+            return [], 0, False
+        last = tokens[-1]
+        exact = set(tokens)
+        with self.lock:
+            terms, truncated = None, False
+            if len(last) >= MIN_PREFIX_CHARS and tokens.count(last) == 1:
+                exact.discard(last)
+                terms, truncated = self._prefix_terms(last)
+                if not terms:
+                    return [], 0, False
+            hits = []
+            for chat_id in set(chat_ids):
+                postings = self.postings.get(chat_id)
+                if not postings:
+                    continue
+                times = self.times[chat_id]
+                hits.extend((times[seq - 1], chat_id, seq) for seq in self._match(postings, exact, terms))
+            page = heapq.nlargest(offset + limit, hits)[offset:]
+            return [(chat_id, seq) for _, chat_id, seq in page], len(hits), truncated
+
+    # --- Persistence -----------------------------------------------------
+    def _owns_path(self):
+        """Only one process writes the snapshot: the first to lock it keeps the lock for its lifetime."""
+        if self._owner is None:
+            if fcntl is None:
+                self._owner = True
+                return True
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            lock_file = open(f'{self.path}.lock', 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._owner = lock_file
+        return True
+
+    def save(self, pause=None):
+        """Writes the index atomically; a no-op when nothing changed since the last save or
+        another process owns the snapshot. Each chat is pickled under the lock on its own,
+        and pause() (if given) runs between chats so a large save yields to other green threads."""
+        if not self.path or not self._owns_path():
+            return False
+        with self.lock:
+            if not self.dirty:
+                return False
+            self.dirty = False
+            chat_ids = list(self.times)
+        partial = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(partial, 'wb') as f:
+                pickle.dump({'version': FORMAT_VERSION, 'chats': len(chat_ids)}, f)
+                for i, chat_id in enumerate(chat_ids):
+                    with self.lock:
+                        # Times, postings and last seqs of one chat are always consistent with each other
+                        record = pickle.dumps((chat_id, self.times[chat_id], self.postings[chat_id],
+                                               self.last_seq[chat_id]), protocol=pickle.HIGHEST_PROTOCOL)
+                    f.write(record)
+                    if pause and i % 50 == 49:
+                        pause()
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(partial, self.path)
+        except BaseException:
+            self.dirty = True
+            raise
+        return True
+
+    def load(self):
+        """Loads a saved index; returns False (leaving the index empty) if there is none usable."""
+        if not self.path or not os.path.exists(self.path):
+            return False
+        postings, last_seq, times = {}, {}, {}
+        try:
+            with open(self.path, 'rb') as f:
+                header = pickle.load(f)
+                if not isinstance(header, dict) or header.get('version') != FORMAT_VERSION:
+                    return False
+                for _ in range(header['chats']):
+                    chat_id, times[chat_id], postings[chat_id], last_seq[chat_id] = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+            print(f"[ERROR] Ignoring unreadable message index {self.path}: {e}")
+            return False
+        with self.lock:
+            self.postings = postings
+            self.last_seq = last_seq
+            self.times = times
+            self.words = {word for chat_postings in postings.values() for word in chat_postings}
+            self.vocabulary = sorted(self.words)
+            self.docs = sum(len(chat_times) for chat_times in times.values())
+            self.dirty = False
+        return True
@@ -0,0 +1,70 @@
+"""Coalesced presence fan-out for the iSightU chat server.
+
+Online/offline changes are collected per user for a short window and only
+the final state is published, so a reconnect storm or a flapping mobile
+connection produces at most one update per user per window, and none at
+all when the user ends the window in the state it started in.
+
+Nothing is remembered across windows: with several workers a user's
+changes can land on different coalescers, and a worker-local "last
+published" state would go stale and swallow real changes.
+"""
+import threading
+
+
+class PresenceCoalescer:
+    """publish(phone, payload) is called once per window with the latest state.
+
+    update() must only be called for real transitions (first device online,
+    last device gone), so the state before a window is the opposite of its
+    first change. start_task / sleep are the Socket.IO server's
+    background-task primitives, so the flush runs as a green thread under
+    eventlet; on_error(phone, exc) is told about failed publishes.
+    """
+
+    def __init__(self, publish, start_task, sleep, window=2.0, on_error=None):
+        self.publish = publish
+        self.start_task = start_task
+        self.sleep = sleep
+        self.window = window
+        self.on_error = on_error
+        # phone -> (is_online before the window, newest payload)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flush_scheduled = False
+        self.stats = {'changes': 0, 'published': 0, 'suppressed': 0}
+
+    def update(self, phone, payload):
+        """Records the newest presence payload for phone; it goes out at the end of the window."""
+        with self.lock:
+            self.stats['changes'] += 1
+            entry = self.pending.get(phone)
+            before = entry[0] if entry else not payload['is_online']
+            self.pending[phone] = (before, payload)
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        if self.window <= 0:
+            self.flush()
+        else:
+            self.start_task(self._flush_later)
+
+    def _flush_later(self):
+        self.sleep(self.window)
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flush_scheduled = False
+        for phone, (before, payload) in pending.items():
+            if payload['is_online'] == before:
+                # Flapped back within the window: watchers never saw the intermediate state
+                self.stats['suppressed'] += 1
+                continue
+            self.stats['published'] += 1
+            try:
+                self.publish(phone, payload)
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(phone, e)
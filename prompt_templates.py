@@ -0,0 +1,84 @@
+import re
+import json
+
+# ------------------------
+# Prompt Templates
+# ------------------------
+# SearchHistory rows for image generations store a template version plus its parameters
+# instead of the rendered prompt. A published version must never change its text: rows
+# reference it forever, so a new wording needs a new version.
+IMAGE_TEMPLATE = "image-v1"
+IMAGE_PARAMS = ("category", "theme", "look", "color_tone", "usage", "custom_prompt")
+ARTIST = "a world-class digital artist and photo-manipulation expert"
+
+
+def _image_v1(params):
+    category = params.get("category"); theme = params.get("theme"); look = params.get("look")
+    color_tone = params.get("color_tone"); usage = params.get("usage"); custom_prompt = params.get("custom_prompt")
+    return (
+        f"You are {ARTIST}.\n"
+        f"Your task is to transform the person in the reference photo according to the user's request. "
+        f"**The most important rule is to strictly maintain their exact face, features, expression, and identity. DO NOT change their face.**\n\n"
+        f"--- Main Category ---\n"
+        f"The desired category is: **{category}**.\n\n"
+        f"--- Main Theme ---\n"
+        f"The desired theme is: **{theme}**.\n\n"
+        f"--- Desired Look ---\n"
+        f"The final image must have a **{look}** look.\n\n"
+        f"--- Color & Tone ---\n"
+        f"Apply this specific color grade and mood: **{color_tone}**.\n\n"
+        f"--- Image Usage ---\n"
+        f"The image will be used for: **{usage}**.\n\n"
+        + (f"--- Additional User Instructions ---\n{custom_prompt}\n\n" if custom_prompt else "") +
+        f"--- Final Instruction ---\n"
+        f"Combine all elements. Change the clothing and background to be 100% appropriate for the **{theme}** and **{look}**. "
+        f"**Repeat: Keep the subject's original face and identity perfectly recognizable.**"
+    )
+
+
+TEMPLATES = {IMAGE_TEMPLATE: (_image_v1, IMAGE_PARAMS)}
+
+
+def render_prompt(template, params):
+    """Full prompt text for a template version and its parameters."""
+    if template not in TEMPLATES:
+        raise ValueError(f"unknown prompt template {template!r}")
+    return TEMPLATES[template][0](params or {})
+
+
+def pack_params(params):
+    """Compact JSON for SearchHistory.prompt_params; empty values are dropped (templates treat them as absent)."""
+    return json.dumps({key: value for key, value in params.items() if value not in (None, "")},
+                      separators=(",", ":"), ensure_ascii=False)
+
+
+def _patterns(template):
+    """Regexes matching a template's output, built by rendering it with marker values."""
+    renderer, names = TEMPLATES[template]
+    patterns = []
+    # The last parameter (custom_prompt) is an optional section: one pattern with it, one without
+    for present in (names, names[:-1]):
+        markers = {name: f"\x00{name}\x00" for name in present}
+        text = re.escape(renderer(markers))
+        for name in present:
+            # The first occurrence captures, repeats must match the same value
+            marker = re.escape(markers[name])
+            text = text.replace(marker, f"(?P<{name}>.*?)", 1).replace(marker, f"(?P={name})")
+        patterns.append(re.compile(text, re.DOTALL))
+    return patterns
+
+
+_PATTERNS = {}
+
+
+def parse_prompt(template, text):
+    """Parameters that render back to exactly `text`, or None if the text did not come from the template."""
+    if template not in _PATTERNS:
+        _PATTERNS[template] = _patterns(template)
+    for pattern in _PATTERNS[template]:
+        match = pattern.fullmatch(text or "")
+        if match:
+            params = match.groupdict()
+            if render_prompt(template, params) == text:
+                return params
+    return None
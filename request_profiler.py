@@ -0,0 +1,272 @@
+"""Opt-in per-request profiling for the CreatorsAI API.
+
+A request is profiled when it carries ``X-Profile: 1`` and passes the
+authorize() check (app.py uses the ADMIN_TOKEN), or when it is drawn by
+``sample_rate``. For a profiled request:
+
+* a sampler thread reads the request thread's stack through
+  sys._current_frames() every ``interval`` seconds and counts folded
+  stacks (``outer;inner;leaf count``, the flamegraph.pl / speedscope
+  input format);
+* span() blocks in the app plus SQLAlchemy cursor executions and JSON
+  encoding are timed into a stage breakdown.
+
+The finished profile is written as JSON to ``directory``, which keeps only
+the newest ``ring_size`` files, and its id is returned in X-Profile-Id.
+When a request is not profiled, the cost is one header lookup (plus one
+random() call when sampling is on). span() then returns a shared no-op.
+
+Under eventlet workers, all green threads share one OS thread, so the
+samples show whichever request is running at that moment. Profile with
+sync workers when exact stacks matter.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import threading
+from contextlib import contextmanager, nullcontext
+
+from flask import g, request
+from flask.json.provider import DefaultJSONProvider
+
+MAX_STACK_DEPTH = 96
+MAX_SAMPLES = 20000
+_NO_SPAN = nullcontext()
+
+
+def _os_threading():
+    """Real OS threading even when eventlet has patched the stdlib: the sampler must run while the request blocks."""
+    try:
+        from eventlet import patcher
+        if patcher.is_monkey_patched("thread"):
+            return patcher.original("threading"), patcher.original("_thread").get_ident
+    except ImportError:
+        pass
+    return threading, threading.get_ident
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class _Sampler:
+    def __init__(self, target, interval):
+        self.target = target
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        os_threading, _ = _os_threading()
+        self._stop = os_threading.Event()
+        self._thread = os_threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        stacks = self.stacks
+        while not self._stop.wait(self.interval) and self.samples < MAX_SAMPLES:
+            frame = sys._current_frames().get(self.target)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None and len(names) < MAX_STACK_DEPTH:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            key = ";".join(reversed(names))
+            stacks[key] = stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class _Profile:
+    def __init__(self, reason, interval):
+        self.id = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+        self.reason = reason
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+        _, get_ident = _os_threading()
+        self.sampler = _Sampler(get_ident(), interval)
+
+    def add_span(self, name, started, detail=None):
+        now = time.perf_counter()
+        span = {"name": name, "start_ms": round((started - self.started) * 1000, 3), "duration_ms": round((now - started) * 1000, 3)}
+        if detail:
+            span["detail"] = detail
+        self.spans.append(span)
+
+    def finish(self, response):
+        self.sampler.stop()
+        duration = time.perf_counter() - self.started
+        stages = {}
+        for span in self.spans:
+            stage = stages.setdefault(span["name"], {"count": 0, "total_ms": 0.0})
+            stage["count"] += 1
+            stage["total_ms"] = round(stage["total_ms"] + span["duration_ms"], 3)
+        return {
+            "id": self.id,
+            "reason": self.reason,
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code if response is not None else None,
+            "started_at": self.started_at,
+            "duration_ms": round(duration * 1000, 3),
+            "stages": stages,
+            "spans": self.spans,
+            "samples": self.sampler.samples,
+            "sample_interval_ms": self.sampler.interval * 1000,
+            "stacks": self.sampler.stacks,
+        }
+
+
+class RequestProfiler:
+    def __init__(self, directory, ring_size=50, sample_rate=0.0, interval=0.005, authorize=None, enabled=True):
+        self.directory = directory
+        self.ring_size = ring_size
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.authorize = authorize or (lambda: False)
+        self.enabled = enabled
+        self._write_lock = threading.Lock()
+        if enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    # --- Flask / SQLAlchemy hooks ----------------------------------------
+    def init_app(self, app, engine=None):
+        """Installs the request hooks; does nothing unless the profiler is enabled."""
+        if not self.enabled:
+            return
+        app.before_request(self._before)
+        app.after_request(self._after)
+        app.teardown_request(self._teardown)
+        app.json = _ProfilingJSONProvider(app, self)
+        if engine is not None:
+            from sqlalchemy import event
+            event.listen(engine, "before_cursor_execute", self._before_cursor)
+            event.listen(engine, "after_cursor_execute", self._after_cursor)
+
+    def _before(self):
+        reason = None
+        if request.headers.get("X-Profile"):
+            if not self.authorize():
+                return None
+            reason = "header"
+        elif self.sample_rate and random.random() < self.sample_rate:
+            reason = "sampled"
+        if reason:
+            g._profile = _Profile(reason, self.interval)
+        return None
+
+    def _after(self, response):
+        profile = g.pop("_profile", None)
+        if profile is not None:
+            record = profile.finish(response)
+            try:
+                self._store(record)
+                response.headers["X-Profile-Id"] = record["id"]
+            except OSError as e:
+                print(f"[ERROR] Could not store profile {record['id']}: {e}")
+        return response
+
+    def _teardown(self, _error):
+        # Requests that died before after_request still have to stop their sampler
+        profile = g.pop("_profile", None)
+        if profile is not None:
+            profile.sampler.stop()
+
+    def _before_cursor(self, conn, cursor, statement, parameters, context, executemany):
+        if self.active():
+            conn.info.setdefault("_profile_started", []).append(time.perf_counter())
+
+    def _after_cursor(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("_profile_started")
+        if started and self.active():
+            g._profile.add_span("sql", started.pop(), " ".join(statement.split())[:120])
+
+    # --- Spans ------------------------------------------------------------
+    def active(self):
+        try:
+            return "_profile" in g
+        except RuntimeError:  # outside a request (background threads)
+            return False
+
+    def span(self, name):
+        """Times a stage of the current request when it is being profiled; a shared no-op otherwise."""
+        if not self.enabled or not self.active():
+            return _NO_SPAN
+        return self._span(g._profile, name)
+
+    @contextmanager
+    def _span(self, profile, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            profile.add_span(name, started)
+
+    # --- Ring on disk -----------------------------------------------------
+    def _path(self, profile_id):
+        if not profile_id or "/" in profile_id or profile_id.startswith("."):
+            return None
+        return os.path.join(self.directory, f"{profile_id}.json")
+
+    def _store(self, record):
+        path = self._path(record["id"])
+        partial = f"{path}.{os.getpid()}.tmp"
+        with open(partial, "w") as f:
+            json.dump(record, f)
+        os.replace(partial, path)
+        with self._write_lock:
+            # Ids start with a nanosecond timestamp, so name order is age order across workers
+            names = sorted(name for name in os.listdir(self.directory) if name.endswith(".json"))
+            for name in names[:max(0, len(names) - self.ring_size)]:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def list(self):
+        summaries = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            if not name.endswith(".json"):
+                continue
+            record = self.load(name[:-5])
+            if record:
+                summaries.append({key: record[key] for key in ("id", "reason", "method", "path", "status", "started_at", "duration_ms", "stages", "samples")})
+        return summaries
+
+    def load(self, profile_id):
+        path = self._path(profile_id)
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (TypeError, OSError, ValueError):
+            return None
+
+    @staticmethod
+    def folded(record):
+        """flamegraph.pl / speedscope "folded" text; spans are added as a synthetic stages;<name> root."""
+        lines = [f"{stack} {count}" for stack, count in sorted(record["stacks"].items())]
+        interval_ms = record.get("sample_interval_ms") or 1
+        for name, stage in sorted(record["stages"].items()):
+            weight = int(round(stage["total_ms"] / interval_ms))
+            if weight:
+                lines.append(f"[stages];{name} {weight}")
+        return "\n".join(lines) + "\n"
+
+
+class _ProfilingJSONProvider(DefaultJSONProvider):
+    """Times jsonify() as a "json" span when the request is being profiled."""
+
+    def __init__(self, app, profiler):
+        super().__init__(app)
+        self.profiler = profiler
+
+    def dumps(self, obj, **kwargs):
+        with self.profiler.span("json"):
+            return super().dumps(obj, **kwargs)
@@ -0,0 +1,284 @@
+import os
+import re
+import time
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes: every worker sweeps, which is still safe
+    fcntl = None
+
+# ------------------------
+# Retention Configuration
+# ------------------------
+MB = 1024 * 1024
+HOUR = 3600
+
+# Quota per plan, in bytes of all of an owner's files; files referenced by SearchHistory
+# count towards it but are never evicted. "anonymous" covers uploads made without a JWT,
+# "default" covers unknown plans and "legacy" (unset: no quota, age only) covers files
+# named before owners were encoded, whose uploader is unknown.
+DEFAULT_PLAN_QUOTAS = {
+    "anonymous": 50 * MB,
+    "free": 200 * MB,
+    "pro": 2000 * MB,
+    "default": 200 * MB,
+}
+
+# Files are attributed to a user through the "u<id>_" prefix added at write time.
+OWNER_PATTERN = re.compile(r"^(?:gen_)?u(\d+)_")
+# Uploads without a JWT are "<uuid4 hex>_<name>"; anything else unowned predates the prefix.
+ANONYMOUS_PATTERN = re.compile(r"^[0-9a-f]{32}_")
+
+
+def parse_quotas(raw):
+    """Parses "free=200,pro=2000" (megabytes) on top of the default quotas."""
+    quotas = dict(DEFAULT_PLAN_QUOTAS)
+    for item in (raw or "").split(","):
+        if "=" not in item:
+            continue
+        plan, mb = item.split("=", 1)
+        try:
+            quotas[plan.strip()] = int(float(mb) * MB)
+        except ValueError:
+            print(f"[WARN] Ignoring invalid retention quota: {item!r}")
+    return quotas
+
+
+def owner_of(filename):
+    """Returns the user id encoded in a stored filename, or None for anonymous files."""
+    match = OWNER_PATTERN.match(filename)
+    return int(match.group(1)) if match else None
+
+
+def quota_group(filename):
+    """The owner's user id, "anonymous" or "legacy": whose quota a stored file counts against."""
+    owner = owner_of(filename)
+    if owner is not None:
+        return owner
+    return "anonymous" if ANONYMOUS_PATTERN.match(filename) else "legacy"
+
+
+class RetentionSweeper:
+    """Age + per-plan-quota garbage collector for the upload folders.
+
+    Each sweep rescans the folders (sleeping between batches) and loads the
+    referenced set in full; both fit in memory at the sizes this app sees.
+    A file's age is counted from its last use (atime bumped by touch(), or
+    mtime), so files that keep being served are not expired.
+
+    folders: {"uploads": "/abs/path", "generated": "/abs/path"}
+    max_age: {"uploads": seconds, "generated": seconds}
+    referenced_files: callable returning the set of filenames that must never be deleted
+    plan_lookup: callable taking a set of user ids and returning {user_id: plan}
+    """
+
+    def __init__(self, folders, max_age, quotas, referenced_files, plan_lookup,
+                 batch_size=500, pause=0.05, interval=900, dry_run=False, lock_path=None, access_resolution=300):
+        self.folders = folders
+        self.max_age = max_age
+        self.quotas = quotas
+        self.referenced_files = referenced_files
+        self.plan_lookup = plan_lookup
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.dry_run = dry_run
+        self.lock_path = lock_path
+        self.access_resolution = access_resolution
+        self._sweep_lock = threading.Lock()
+        self._thread = None
+        self.stats = {
+            "sweeps": 0,
+            "files_scanned": 0,
+            "files_deleted": 0,
+            "bytes_reclaimed": 0,
+            "delete_errors": 0,
+            "last_sweep_at": None,
+            "last_sweep_seconds": None,
+            "last_sweep_bytes_reclaimed": 0,
+            "last_sweep_dry_run": dry_run,
+        }
+
+    def touch(self, folder, filename):
+        """Records a read of an existing file in its atime, so quota eviction is LRU across all workers.
+
+        atime is bumped at most once per access_resolution seconds so reads do not all become
+        metadata writes; mtime is kept so the file's write time is not lost."""
+        if folder not in self.folders or os.path.basename(filename) != filename or filename.startswith("."):
+            return
+        path = os.path.join(self.folders[folder], filename)
+        try:
+            st = os.stat(path)
+            now = time.time_ns()
+            if now - st.st_atime_ns >= self.access_resolution * 1_000_000_000:
+                os.utime(path, ns=(now, st.st_mtime_ns))
+        except OSError:
+            pass
+
+    # --- Scanning --------------------------------------------------------
+    def _scan(self):
+        """Lists every file in batches, sleeping between batches to keep the worker responsive."""
+        entries = []
+        seen = 0
+        for folder, path in self.folders.items():
+            try:
+                iterator = os.scandir(path)
+            except FileNotFoundError:
+                continue
+            with iterator:
+                for entry in iterator:
+                    try:
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    last_used = max(st.st_mtime, st.st_atime)
+                    entries.append({
+                        "folder": folder,
+                        "name": entry.name,
+                        "path": entry.path,
+                        "size": st.st_size,
+                        "mtime": st.st_mtime,
+                        "last_used": last_used,
+                        "owner": owner_of(entry.name),
+                        "group": quota_group(entry.name),
+                    })
+                    seen += 1
+                    if seen % self.batch_size == 0:
+                        time.sleep(self.pause)
+        return entries
+
+    def plan(self, now=None):
+        """Works out which files would be deleted, without touching the disk."""
+        now = now or time.time()
+        entries = self._scan()
+        referenced = self.referenced_files()
+        owners = {e["owner"] for e in entries if e["owner"] is not None}
+        plans = self.plan_lookup(owners) if owners else {}
+
+        evict = []
+        kept_referenced = 0
+        groups = {}
+        for e in entries:
+            e["referenced"] = e["name"] in referenced
+            if e["referenced"]:
+                kept_referenced += 1
+            else:
+                max_age = self.max_age.get(e["folder"])
+                if max_age is not None and now - e["last_used"] > max_age:
+                    e["reason"] = "age"
+                    evict.append(e)
+                    continue
+            groups.setdefault(e["group"], []).append(e)
+
+        usage = {}
+        for group, files in groups.items():
+            if isinstance(group, int):
+                plan = plans.get(group, "default")
+                quota = self.quotas.get(plan, self.quotas.get("default"))
+            else:
+                plan = group
+                quota = self.quotas.get(group)
+            used = sum(f["size"] for f in files)
+            referenced_bytes = sum(f["size"] for f in files if f["referenced"])
+            usage[str(group)] = {"plan": plan, "bytes": used, "referenced_bytes": referenced_bytes, "quota": quota}
+            if quota is None or used <= quota:
+                continue
+            # Least recently used unreferenced files first until the owner is back under quota
+            for f in sorted((f for f in files if not f["referenced"]), key=lambda f: f["last_used"]):
+                if used <= quota:
+                    break
+                f["reason"] = "quota"
+                evict.append(f)
+                used -= f["size"]
+
+        return {
+            "generated_at": now,
+            "files_scanned": len(entries),
+            "referenced_kept": kept_referenced,
+            "evict_count": len(evict),
+            "evict_bytes": sum(e["size"] for e in evict),
+            "usage": usage,
+            "evict": [
+                {"folder": e["folder"], "name": e["name"], "size": e["size"], "reason": e["reason"]}
+                for e in evict
+            ],
+        }
+
+    def report(self):
+        """What the next sweep would delete and why; unlike sweep(dry_run=True) it leaves the sweep stats alone."""
+        report = self.plan()
+        report["dry_run"] = True
+        return report
+
+    # --- Sweeping --------------------------------------------------------
+    def sweep(self, dry_run=None):
+        """Runs one full pass; returns the plan with the bytes actually reclaimed."""
+        dry_run = self.dry_run if dry_run is None else dry_run
+        with self._sweep_lock:
+            started = time.time()
+            report = self.plan(now=started)
+            reclaimed = 0
+            deleted = 0
+            if not dry_run:
+                for i, e in enumerate(report["evict"]):
+                    path = os.path.join(self.folders[e["folder"]], e["name"])
+                    try:
+                        os.remove(path)
+                        reclaimed += e["size"]
+                        deleted += 1
+                    except FileNotFoundError:
+                        pass
+                    except OSError as err:
+                        self.stats["delete_errors"] += 1
+                        print(f"[ERROR] Retention could not delete {path}: {err}")
+                    if (i + 1) % self.batch_size == 0:
+                        time.sleep(self.pause)
+
+            elapsed = time.time() - started
+            self.stats["sweeps"] += 1
+            self.stats["files_scanned"] += report["files_scanned"]
+            self.stats["files_deleted"] += deleted
+            self.stats["bytes_reclaimed"] += reclaimed
+            self.stats["last_sweep_at"] = started
+            self.stats["last_sweep_seconds"] = round(elapsed, 3)
+            self.stats["last_sweep_bytes_reclaimed"] = reclaimed
+            self.stats["last_sweep_dry_run"] = dry_run
+            report["dry_run"] = dry_run
+            report["bytes_reclaimed"] = reclaimed
+            report["files_deleted"] = deleted
+            report["duration_seconds"] = round(elapsed, 3)
+            return report
+
+    def _sweep_exclusive(self):
+        """Sweeps only if no other worker process holds the sweep lock file."""
+        if fcntl is None or not self.lock_path:
+            return self.sweep()
+        with open(self.lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return None
+            try:
+                return self.sweep()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _run(self):
+        while True:
+            try:
+                report = self._sweep_exclusive()
+                if report:
+                    print(f"[INFO] Retention sweep: {report['files_deleted']} files, "
+                          f"{report['bytes_reclaimed']} bytes reclaimed (dry_run={report['dry_run']})")
+            except Exception as e:
+                print(f"[ERROR] Retention sweep failed: {e}")
+            time.sleep(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="retention-sweeper", daemon=True)
+            self._thread.start()
+        return self._thread